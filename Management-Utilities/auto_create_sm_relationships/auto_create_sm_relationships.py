@@ -147,6 +147,7 @@ import urllib3
 from urllib3.util import Retry
 import logging
 import boto3
+import botocore
 #
 # Define a custom exception so we can gracefully exit the program if too many
 # snapmirror relationships have been created.
@@ -162,30 +163,86 @@ class TooManySMs(Exception):
 
 
 ################################################################################
-# This function returns the value assigned to the "protect_volume" tag
-# associated with the ARN passed in. If none is found, it returns an empty
+# This function returns the value assigned to the "protect_volume" tag that
+# is in the array of tags passed in. If none is found, it returns an empty
 # string.
 ################################################################################
-def getVolumeProtectTagValue(fsxClient, arn):
+def getVolumeProtectTagValue(tags):
 
-    if not arn == "":
-        tags = fsxClient.list_tags_for_resource(ResourceARN=arn)
-        for tag in tags['Tags']:
-            if(tag['Key'].lower() == "protect_volume"):
-                return(tag['Value'].lower())
+    for tag in tags:
+        if(tag['Key'].lower() == "protect_volume"):
+            return(tag['Value'].lower())
     return("")
 
 ################################################################################
-# This function returns the ARN of the volume that has the UUID passed in. It
-# returns an empty string if the UUID is not found.
+# This function returns the tags of all the AWS volumes passed in, indexed by
+# their ARN. describe_volumes normally includes the tags of each volume, so
+# they are used when it does. For any volume it didn't include them for, the
+# tags of all the FSx volumes in the region are fetched in bulk, up to 100
+# volumes per call, with the Resource Groups Tagging API, and only if that
+# isn't allowed, are they fetched one volume at a time.
 ################################################################################
-def getVolumeARN(awsVolumes, volumeUUID):
-    
+def getVolumeTags(fsxClient, awsVolumes, regionName):
+
     global logger
 
+    volumeTags = {}
+    missing = []
     for awsVolume in awsVolumes:
-        if awsVolume['OntapConfiguration']['UUID'] == volumeUUID:
-            return(awsVolume['ResourceARN'])
+        if 'Tags' in awsVolume:
+            volumeTags[awsVolume['ResourceARN']] = awsVolume['Tags']
+        else:
+            missing.append(awsVolume['ResourceARN'])
+
+    if len(missing) > 0:
+        try:
+            taggingClient = boto3.client('resourcegroupstaggingapi', region_name=regionName)
+            taggedVolumes = {}
+            paginationToken = ''
+            #
+            # The initial amount of time to sleep if there is a rate limit exception.
+            sleep = .125
+            while True:
+                try:
+                    data = taggingClient.get_resources(ResourceTypeFilters=['fsx:volume'], ResourcesPerPage=100, PaginationToken=paginationToken)
+                except botocore.exceptions.ClientError as err:
+                    if err.response['Error']['Code'] not in ['TooManyRequestsException', 'ThrottlingException']:
+                        raise err
+                    sleep = sleep * 2   # Exponential backoff.
+                    if sleep > 5:
+                        raise err
+                    logger.warning(f'Rate Limit fault while getting the tagged volumes in {regionName}. Sleeping for {sleep} seconds.')
+                    time.sleep(sleep)
+                    continue
+                sleep = .125
+                for resource in data['ResourceTagMappingList']:
+                    taggedVolumes[resource['ResourceARN']] = resource['Tags']
+                paginationToken = data.get('PaginationToken', '')
+                if paginationToken == '':
+                    break
+            for arn in missing:
+                volumeTags[arn] = taggedVolumes.get(arn, [])
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] not in ['AccessDeniedException', 'AccessDenied']:
+                raise err
+            logger.warning(f'Not allowed to use the Resource Groups Tagging API in {regionName}, so getting the tags of {len(missing)} volumes one at a time.')
+            for arn in missing:
+                volumeTags[arn] = fsxClient.list_tags_for_resource(ResourceARN=arn)['Tags']
+
+    return(volumeTags)
+
+################################################################################
+# This function returns the ARN of the volume that has the UUID passed in,
+# using the AWS volumes indexed by their UUID. It returns an empty string if
+# the UUID is not found.
+################################################################################
+def getVolumeARN(awsVolumesByUUID, volumeUUID):
+    
+    global logger
+
+    awsVolume = awsVolumesByUUID.get(volumeUUID)
+    if awsVolume != None:
+        return(awsVolume['ResourceARN'])
     logger.warning(f'Failed to get ARN for volume with UUID={volumeUUID}.')
     return("")
 
@@ -423,6 +480,12 @@ def lambda_handler(event, context):
                     awsVolumes += data['Volumes']
                     nextToken = data.get('NextToken')
                 #
+                # Index the ONTAP volumes by their UUID, and get all their
+                # tags at once, so looking them up doesn't take any API calls.
+                awsVolumes = [awsVolume for awsVolume in awsVolumes if 'OntapConfiguration' in awsVolume]
+                awsVolumesByUUID = {awsVolume['OntapConfiguration']['UUID']: awsVolume for awsVolume in awsVolumes}
+                volumeTags = getVolumeTags(fsxClient, awsVolumes, regionName)
+                #
                 # Loop on all the file systems in the region.
                 for fsxn in fsxs:
                     #
@@ -435,8 +498,8 @@ def lambda_handler(event, context):
                         for ontapVolume in ontapVolumes:
                             if ontapVolume['type'].lower() == "rw" and not ontapVolume['snapmirror']['destinations']['is_ontap']:
                                 volumeUUID = ontapVolume['uuid']
-                                volumeARN = getVolumeARN(awsVolumes, volumeUUID)
-                                protectTag = getVolumeProtectTagValue(fsxClient, volumeARN)
+                                volumeARN = getVolumeARN(awsVolumesByUUID, volumeUUID)
+                                protectTag = getVolumeProtectTagValue(volumeTags.get(volumeARN, []))
 
                                 if protectAll and protectTag != "skip" or not protectAll and protectTag == "protect":
                                     volumeName = ontapVolume['name']
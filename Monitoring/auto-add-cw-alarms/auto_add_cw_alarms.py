@@ -12,8 +12,8 @@
 # function with the thought being that you will create a EventBridge schedule
 # to invoke it periodically.
 #
-# It will scan all regions looking for FSxN volumes and file systems
-# and since CloudWatch can't send SNS messages across regions, it assumes
+# It will scan all regions, several at a time, looking for FSxN volumes and
+# file systems and since CloudWatch can't send SNS messages across regions, it assumes
 # that the specified SNS topic exist in each region for the specified
 # account ID.
 #
@@ -61,6 +61,9 @@ defaultSSDThreshold=90
 # Setting it to 100 will disable the creation of the alarm.
 defaultVolumeThreshold=80
 #
+# Define the maximum number of regions to scan at the same time.
+regionConcurrency=8
+#
 #
 ################################################################################
 # You can't change the following variables from the command line or environment
@@ -99,6 +102,21 @@ import getopt
 import sys
 import time
 import json
+import threading
+import concurrent.futures
+
+################################################################################
+# This function prints a message. While a region is being processed, the
+# messages are collected instead, so they can be printed together, in the
+# order the regions were listed, once it is done.
+################################################################################
+regionOutput = threading.local()
+def log(message):
+    messages = getattr(regionOutput, 'messages', None)
+    if messages == None:
+        print(message)
+    else:
+        messages.append(message)
 
 ################################################################################
 # This function adds the SSD Utilization CloudWatch alarm.
@@ -122,7 +140,7 @@ def add_ssd_alarm(cw, fsId, alarmName, alarmDescription, threshold, region):
             Dimensions=[{'Name': 'FileSystemId', 'Value': fsId}, {'Name': 'StorageTier', 'Value': 'SSD'}, {'Name': 'DataType', 'Value': 'All'}]
         )
     else:
-        print(f'Would have added SSD alarm for {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}')
+        log(f'Would have added SSD alarm for {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}')
 
 ################################################################################
 # This function adds the CPU Utilization CloudWatch alarm.
@@ -146,7 +164,7 @@ def add_cpu_alarm(cw, fsId, alarmName, alarmDescription, threshold, region):
             Dimensions=[{'Name': 'FileSystemId', 'Value': fsId}]
         )
     else:
-        print(f'Would have added CPU alarm for {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}.')
+        log(f'Would have added CPU alarm for {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}.')
 
 ################################################################################
 # This function adds the Volume utilization CloudWatch alarm.
@@ -168,7 +186,7 @@ def add_volume_alarm(cw, volumeId, alarmName, alarmDescription, fsId, threshold,
                      {"Id":"m1","ReturnData":False,"MetricStat":{"Metric":{"Namespace":"AWS/FSx","MetricName":"StorageCapacity","Dimensions":[{"Name":"VolumeId","Value": volumeId},{"Name":"FileSystemId","Value":fsId}]},"Period":300,"Stat":"Average"}}]
         )
     else:
-        print(f'Would have added volume alarm for {volumeId} {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}.')
+        log(f'Would have added volume alarm for {volumeId} {fsId} with name {alarmName} with thresold of {threshold} in {region} with action {action}.')
 
 
 ################################################################################
@@ -178,41 +196,24 @@ def delete_alarm(cw, alarmName):
     if not dryRun:
         cw.delete_alarms(AlarmNames=[alarmName])
     else:
-        print(f'Would have deleted alarm {alarmName}.')
-
-################################################################################
-# This function checks to see if the alarm already exists.
-################################################################################
-def contains_alarm(alarmName, alarms):
-    for alarm in alarms:
-        if(alarm['AlarmName'] == alarmName):
-            return True
-    return False
-
-################################################################################
-# This function checks to see if a volume exists.
-################################################################################
-def contains_volume(volumeId, volumes):
-    for volume in volumes:
-        if(volume['VolumeId'] == volumeId):
-            return True
-    return False
+        log(f'Would have deleted alarm {alarmName}.')
 
 ################################################################################
-# This function checks to see if a file system exists.
+# This function returns the value assigned to the "alarm_threshold" tag
+# that is in the array of tags passed in. If none is found, it returns the
+# default threshold set above.
 ################################################################################
-def contains_fs(fsId, fss):
-    for fs in fss:
-        if(fs['FileSystemId'] == fsId):
-            return True
-    return False
+def getAlarmThresholdTagValue(tags):
+    for tag in tags:
+        if(tag['Key'].lower() == "alarm_threshold"):
+            return(tag['Value'])
+    return(defaultVolumeThreshold)
 
 ################################################################################
-# This function returns the value assigned to the "alarm_threshold" tag
-# associated with the arn passed in. If none is found, it returns the default
-# threshold set above.
+# This function returns the tags associated with the arn passed in, or None
+# if the resource no longer exists.
 ################################################################################
-def getAlarmThresholdTagValue(fsx, arn):
+def getResourceTags(fsx, arn):
     #
     # If there are a lot of volumes, we could get hit by the AWS rate limit,
     # so we will sleep for a short period of time and then retry. We will
@@ -225,25 +226,87 @@ def getAlarmThresholdTagValue(fsx, arn):
     # we try to get the tags for the volume.
     while True:
         try:
-            tags = fsx.list_tags_for_resource(ResourceARN=arn)
-            for tag in tags['Tags']:
-                if(tag['Key'].lower() == "alarm_threshold"):
-                    return(tag['Value'])
-            return(defaultVolumeThreshold)
+            return(fsx.list_tags_for_resource(ResourceARN=arn)['Tags'])
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == 'ResourceNotFound':
-                return(100) # Return 100 so we don't try to create an alarm.
+                return(None)
 
             if e.response['Error']['Code'] == 'TooManyRequestsException' or e.response['Error']['Code'] == 'ThrottlingException':
                 sleep = sleep * 2
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting tags. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting tags. Sleeping for {sleep} seconds.")
+                time.sleep(sleep)
+            else:
+                log(f"boto3 client error: {json.dumps(e.response)}")
+                raise e
+
+################################################################################
+# This function will return the tags of all the FSx volumes in the region
+# that have, or have had, tags, indexed by their ARN, using the Resource
+# Groups Tagging API. It returns up to 100 volumes per call. It will also
+# handle the case where we get a rate limit exception.
+################################################################################
+def getTaggedVolumes(tagging):
+    #
+    # The initial amount of time to sleep if there is a rate limit exception.
+    sleep=.125
+    tags = {}
+    paginationToken = ''
+    while True:
+        try:
+            response = tagging.get_resources(ResourceTypeFilters=['fsx:volume'], ResourcesPerPage=100, PaginationToken=paginationToken)
+            for resource in response['ResourceTagMappingList']:
+                tags[resource['ResourceARN']] = resource['Tags']
+            paginationToken = response.get('PaginationToken', '')
+            sleep=.125
+            if paginationToken == '':
+                break
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'TooManyRequestsException' or e.response['Error']['Code'] == 'ThrottlingException':
+                sleep = sleep * 2   # Exponential backoff.
+                if sleep > 5:
+                    raise e
+                log(f"Warning: Rate Limit fault while getting the tagged volumes. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
+    return tags
+
+################################################################################
+# This function returns the tags of all the volumes passed in, indexed by
+# their ARN, or None for any volume that no longer exists. describe_volumes
+# normally includes the tags of each volume, so they are used when it does.
+# For any volume it didn't include them for, the tags of all the volumes in
+# the region are fetched in bulk with the Resource Groups Tagging API, and
+# only if that isn't allowed, are they fetched one volume at a time.
+################################################################################
+def getVolumeTags(fsx, volumes, region, session, boto3Config):
+    volumeTags = {}
+    missing = []
+    for volume in volumes:
+        if 'Tags' in volume:
+            volumeTags[volume['ResourceARN']] = volume['Tags']
+        else:
+            missing.append(volume['ResourceARN'])
+
+    if len(missing) > 0:
+        try:
+            tagging = session.client('resourcegroupstaggingapi', region_name=region, config=boto3Config)
+            taggedVolumes = getTaggedVolumes(tagging)
+            for arn in missing:
+                volumeTags[arn] = taggedVolumes.get(arn, [])
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ['AccessDeniedException', 'AccessDenied']:
+                log(f"boto3 client error: {json.dumps(e.response)}")
+                raise e
+            log(f"Warning: Not allowed to use the Resource Groups Tagging API in {region}, so getting the tags of {len(missing)} volumes one at a time.")
+            for arn in missing:
+                volumeTags[arn] = getResourceTags(fsx, arn)
+
+    return volumeTags
+
 ################################################################################
 # This function returns the value assigned to the "CPU_alarm_threshold" tag
 # that is in the array of tags passed in. if it doesn't find that tag it
@@ -300,10 +363,10 @@ def getFss(fsx):
                 sleep = sleep * 2   # Exponential backoff.
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting initial file system list. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting initial file system list. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
     while nextToken:
@@ -317,10 +380,10 @@ def getFss(fsx):
                 sleep = sleep * 2   # Exponential backoff.
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting additional file systems. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting additional file systems. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
     return fss
 
@@ -345,10 +408,10 @@ def getVolumes(fsx):
                 sleep = sleep * 2   # Exponential backoff.
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting the initial list of volumes. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting the initial list of volumes. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
     while nextToken:
@@ -362,10 +425,10 @@ def getVolumes(fsx):
                 sleep = sleep * 2   # Exponential backoff.
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting additional volumes. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting additional volumes. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
     return volumes
@@ -391,10 +454,10 @@ def getAlarms(cw):
                 sleep = sleep * 2
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting the initial list of alarms. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting the initial list of alarms. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
     while nextToken:
@@ -408,14 +471,147 @@ def getAlarms(cw):
                 sleep = sleep * 2   # Exponential backoff.
                 if sleep > 5:
                     raise e
-                print(f"Warning: Rate Limit fault while getting additional alarms. Sleeping for {sleep} seconds.")
+                log(f"Warning: Rate Limit fault while getting additional alarms. Sleeping for {sleep} seconds.")
                 time.sleep(sleep)
             else:
-                print(f"boto3 client error: {json.dumps(e.response)}")
+                log(f"boto3 client error: {json.dumps(e.response)}")
                 raise e
 
     return alarms
 
+################################################################################
+# This function checks all the FSx for ONTAP file systems and volumes in a
+# region, adding any alarms they are missing, and deleting any alarms for
+# file systems and volumes that no longer exist. It returns the number of
+# alarms added and deleted.
+################################################################################
+def process_region(region, boto3Config):
+    log(f'Scanning {region}')
+    #
+    # Creating clients from the default session isn't thread safe, so each
+    # region uses its own session.
+    session = boto3.session.Session()
+    fsx = session.client('fsx', region_name=region, config=boto3Config)
+    cw = session.client('cloudwatch', region_name=region, config=boto3Config)
+    added = 0
+    deleted = 0
+    #
+    # Get all the file systems, volumes and alarm in the region.
+    fss     = getFss(fsx)
+    volumes = getVolumes(fsx)
+    alarms  = getAlarms(cw)
+    #
+    # Index them by name, or ID, so checking if an alarm, volume or
+    # file system exists doesn't require scanning all of them.
+    alarmsByName = {alarm['AlarmName']: alarm for alarm in alarms}
+    volumesById  = {volume['VolumeId']: volume for volume in volumes}
+    fssById      = {fs['FileSystemId']: fs for fs in fss}
+    volumeTags   = getVolumeTags(fsx, volumes, region, session, boto3Config)
+    #
+    # Scan for filesystems without CPU Utilization Alarm.
+    for fs in fss:
+        if(fs['FileSystemType'] == "ONTAP"):
+            threshold = int(getCPUAlarmThresholdTagValue(fs['Tags']))
+            if(threshold != 100):
+                fsId = fs['FileSystemId']
+                fsName = fsId.replace('fs-', 'FsxId')
+                alarmName = alarmPrefixCPU + fsId
+                alarmDescription = f"CPU utilization alarm for file system {fsName}{customerId} in region {region}."
+
+                if(alarmName not in alarmsByName and onlyFilesystemId == None or
+                   alarmName not in alarmsByName and onlyFilesystemId != None and onlyFilesystemId == fsId):
+                    log(f'Adding CPU Alarm for {fs["FileSystemId"]}')
+                    add_cpu_alarm(cw, fsId, alarmName, alarmDescription, threshold, region)
+                    added += 1
+    #
+    # Scan for CPU alarms without a FSxN filesystem.
+    for alarm in alarms:
+        alarmName = alarm['AlarmName']
+        if(alarmName[:len(alarmPrefixCPU)] == alarmPrefixCPU):
+            fsId = alarmName[len(alarmPrefixCPU):]
+            if(fsId not in fssById and onlyFilesystemId == None or
+               fsId not in fssById and onlyFilesystemId != None and onlyFilesystemId == fsId):
+                log("Deleting alarm: " + alarmName + " in region " + region)
+                delete_alarm(cw, alarmName)
+                deleted += 1
+    #
+    # Scan for filesystems without SSD Utilization Alarm.
+    for fs in fss:
+        if(fs['FileSystemType'] == "ONTAP"):
+            threshold = int(getSSDAlarmThresholdTagValue(fs['Tags']))
+            if(threshold != 100):
+                fsId = fs['FileSystemId']
+                fsName = fsId.replace('fs-', 'FsxId')
+                alarmName = alarmPrefixSSD + fsId
+                alarmDescription = f"SSD utilization alarm for file system {fsName}{customerId} in region {region}."
+
+                if(alarmName not in alarmsByName and onlyFilesystemId == None or
+                   alarmName not in alarmsByName and onlyFilesystemId != None and onlyFilesystemId == fsId):
+                    log(f'Adding SSD Alarm for {fsId}')
+                    add_ssd_alarm(cw, fs['FileSystemId'], alarmName, alarmDescription, threshold, region)
+                    added += 1
+    #
+    # Scan for SSD alarms without a FSxN filesystem.
+    for alarm in alarms:
+        alarmName = alarm['AlarmName']
+        if(alarmName[:len(alarmPrefixSSD)] == alarmPrefixSSD):
+            fsId = alarmName[len(alarmPrefixSSD):]
+            if(fsId not in fssById and onlyFilesystemId == None or
+               fsId not in fssById and onlyFilesystemId != None and onlyFilesystemId == fsId):
+                log("Deleteing alarm: " + alarmName + " in region " + region)
+                delete_alarm(cw, alarmName)
+                deleted += 1
+    #
+    # Scan for volumes without alarms.
+    for volume in volumes:
+        if(volume['VolumeType'] == "ONTAP"):
+            volumeId = volume['VolumeId']
+            volumeName = volume['Name']
+            volumeARN = volume['ResourceARN']
+            fsId = volume['FileSystemId']
+
+            #
+            # If the volume no longer exists, set the threshold to 100 so we don't try to create an alarm.
+            tags = volumeTags.get(volumeARN)
+            threshold = int(getAlarmThresholdTagValue(tags)) if tags != None else 100
+
+            if(threshold != 100):   # No alarm if the value is set to 100.
+                alarmName = alarmPrefixVolume + volumeId
+                fsName = fsId.replace('fs-', 'FsxId')
+                alarmDescription = f"Volume utilization alarm for volumeId {volumeId}{customerId}, File System Name: {fsName}, Volume Name: {volumeName} in region {region}."
+                if(alarmName not in alarmsByName and onlyFilesystemId == None or
+                   alarmName not in alarmsByName and onlyFilesystemId != None and onlyFilesystemId == fsId):
+                    log(f'Adding volume utilization alarm for {volumeName} in region {region}.')
+                    add_volume_alarm(cw, volumeId, alarmName, alarmDescription, fsId, threshold, region)
+                    added += 1
+    #
+    # Scan for volume alarms without volumes.
+    for alarm in alarms:
+        alarmName = alarm['AlarmName']
+        if(alarmName[:len(alarmPrefixVolume)] == alarmPrefixVolume):
+            volumeId = alarmName[len(alarmPrefixVolume):]
+            if(volumeId not in volumesById and onlyFilesystemId == None or
+               volumeId not in volumesById and onlyFilesystemId != None and onlyFilesystemId == getFileSystemId(alarm)):
+                log("Deleteing alarm: " + alarmName + " in region " + region)
+                delete_alarm(cw, alarmName)
+                deleted += 1
+
+    return (added, deleted)
+
+################################################################################
+# This function runs process_region() for a region, in its own thread,
+# collecting the messages it logs instead of printing them. It returns the
+# messages, the result, and the exception it raised, if any.
+################################################################################
+def run_region(region, boto3Config):
+    regionOutput.messages = []
+    try:
+        return (regionOutput.messages, process_region(region, boto3Config), None)
+    except Exception as err:
+        return (regionOutput.messages, None, err)
+    finally:
+        regionOutput.messages = None
+
 ################################################################################
 # This is the main logic of the program. It loops on all the regions then all
 # the fsx volumes within the region, checking to see if any of them already
@@ -449,95 +645,32 @@ def lambda_handler(event, context):
             regions += [region['RegionName']]
 
     fsxRegions = boto3.Session().get_available_regions('fsx')
-    for region in regions:
-        if region in fsxRegions:
-            print(f'Scanning {region}')
-            fsx = boto3.client('fsx', region_name=region, config=boto3Config)
-            cw = boto3.client('cloudwatch', region_name=region, config=boto3Config)
-            #
-            # Get all the file systems, volumes and alarm in the region.
-            fss     = getFss(fsx)
-            volumes = getVolumes(fsx)
-            alarms  = getAlarms(cw)
-            #
-            # Scan for filesystems without CPU Utilization Alarm.
-            for fs in fss:
-                if(fs['FileSystemType'] == "ONTAP"):
-                    threshold = int(getCPUAlarmThresholdTagValue(fs['Tags']))
-                    if(threshold != 100):
-                        fsId = fs['FileSystemId']
-                        fsName = fsId.replace('fs-', 'FsxId')
-                        alarmName = alarmPrefixCPU + fsId
-                        alarmDescription = f"CPU utilization alarm for file system {fsName}{customerId} in region {region}."
-
-                        if(not contains_alarm(alarmName, alarms) and onlyFilesystemId == None or
-                           not contains_alarm(alarmName, alarms) and onlyFilesystemId != None and onlyFilesystemId == fsId):
-                            print(f'Adding CPU Alarm for {fs["FileSystemId"]}')
-                            add_cpu_alarm(cw, fsId, alarmName, alarmDescription, threshold, region)
-            #
-            # Scan for CPU alarms without a FSxN filesystem.
-            for alarm in alarms:
-                alarmName = alarm['AlarmName']
-                if(alarmName[:len(alarmPrefixCPU)] == alarmPrefixCPU):
-                    fsId = alarmName[len(alarmPrefixCPU):]
-                    if(not contains_fs(fsId, fss) and onlyFilesystemId == None or
-                       not contains_fs(fsId, fss) and onlyFilesystemId != None and onlyFilesystemId == fsId):
-                        print("Deleting alarm: " + alarmName + " in region " + region)
-                        delete_alarm(cw, alarmName)
-            #
-            # Scan for filesystems without SSD Utilization Alarm.
-            for fs in fss:
-                if(fs['FileSystemType'] == "ONTAP"):
-                    threshold = int(getSSDAlarmThresholdTagValue(fs['Tags']))
-                    if(threshold != 100):
-                        fsId = fs['FileSystemId']
-                        fsName = fsId.replace('fs-', 'FsxId')
-                        alarmName = alarmPrefixSSD + fsId
-                        alarmDescription = f"SSD utilization alarm for file system {fsName}{customerId} in region {region}."
-
-                        if(not contains_alarm(alarmName, alarms) and onlyFilesystemId == None or
-                           not contains_alarm(alarmName, alarms) and onlyFilesystemId != None and onlyFilesystemId == fsId):
-                            print(f'Adding SSD Alarm for {fsId}')
-                            add_ssd_alarm(cw, fs['FileSystemId'], alarmName, alarmDescription, threshold, region)
-            #
-            # Scan for SSD alarms without a FSxN filesystem.
-            for alarm in alarms:
-                alarmName = alarm['AlarmName']
-                if(alarmName[:len(alarmPrefixSSD)] == alarmPrefixSSD):
-                    fsId = alarmName[len(alarmPrefixSSD):]
-                    if(not contains_fs(fsId, fss) and onlyFilesystemId == None or
-                       not contains_fs(fsId, fss) and onlyFilesystemId != None and onlyFilesystemId == fsId):
-                        print("Deleteing alarm: " + alarmName + " in region " + region)
-                        delete_alarm(cw, alarmName)
-            #
-            # Scan for volumes without alarms.
-            for volume in volumes:
-                if(volume['VolumeType'] == "ONTAP"):
-                    volumeId = volume['VolumeId']
-                    volumeName = volume['Name']
-                    volumeARN = volume['ResourceARN']
-                    fsId = volume['FileSystemId']
-
-                    threshold = int(getAlarmThresholdTagValue(fsx, volumeARN))
-
-                    if(threshold != 100):   # No alarm if the value is set to 100.
-                        alarmName = alarmPrefixVolume + volumeId
-                        fsName = fsId.replace('fs-', 'FsxId')
-                        alarmDescription = f"Volume utilization alarm for volumeId {volumeId}{customerId}, File System Name: {fsName}, Volume Name: {volumeName} in region {region}."
-                        if(not contains_alarm(alarmName, alarms) and onlyFilesystemId == None or
-                           not contains_alarm(alarmName, alarms) and onlyFilesystemId != None and onlyFilesystemId == fsId):
-                            print(f'Adding volume utilization alarm for {volumeName} in region {region}.')
-                            add_volume_alarm(cw, volumeId, alarmName, alarmDescription, fsId, threshold, region)
-            #
-            # Scan for volume alarms without volumes.
-            for alarm in alarms:
-                alarmName = alarm['AlarmName']
-                if(alarmName[:len(alarmPrefixVolume)] == alarmPrefixVolume):
-                    volumeId = alarmName[len(alarmPrefixVolume):]
-                    if(not contains_volume(volumeId, volumes) and onlyFilesystemId == None or
-                       not contains_volume(volumeId, volumes) and onlyFilesystemId != None and onlyFilesystemId == getFileSystemId(alarm)):
-                        print("Deleteing alarm: " + alarmName + " in region " + region)
-                        delete_alarm(cw, alarmName)
+    scanRegions = [region for region in regions if region in fsxRegions]
+    #
+    # Process the regions concurrently, each with its own clients. Each
+    # region's messages are collected while it is processed, and printed
+    # once it is done, in the order the regions were listed, so the output
+    # is the same no matter which region finishes first. A failure in one
+    # region doesn't stop the others from being processed.
+    failedRegions = []
+    totalAdded = 0
+    totalDeleted = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, regionConcurrency)) as executor:
+        futures = [executor.submit(run_region, region, boto3Config) for region in scanRegions]
+        for (region, future) in zip(scanRegions, futures):
+            (messages, result, err) = future.result()
+            for message in messages:
+                print(message)
+            if err != None:
+                print(f"Error: Failed to process region {region}: {err}")
+                failedRegions.append(region)
+            else:
+                totalAdded += result[0]
+                totalDeleted += result[1]
+
+    print(f"{'Would have added' if dryRun else 'Added'} {totalAdded} and deleted {totalDeleted} alarms in {len(scanRegions) - len(failedRegions)} regions.")
+    if len(failedRegions) > 0:
+        raise Exception(f"Failed to process the following regions: {', '.join(failedRegions)}.")
 
     return
 
@@ -545,7 +678,7 @@ def lambda_handler(event, context):
 # This function is used to print out the usage of the script.
 ################################################################################
 def usage():
-    print('Usage: auto_add_cw_alarms [-h|--help] [-d|--dryRun] [[-c|--customerID customerID] [[-a|--accountID aws_account_id] [[-s|--SNSTopic SNS_Topic_Name] [[-r|--region region] [[-C|--CPUThreshold threshold] [[-S|--SSDThreshold threshold] [[-V|--VolumeThreshold threshold] [-F|--FileSystemID FileSystemID]')
+    print('Usage: auto_add_cw_alarms [-h|--help] [-d|--dryRun] [[-c|--customerID customerID] [[-a|--accountID aws_account_id] [[-s|--SNSTopic SNS_Topic_Name] [[-r|--region region] [[-C|--CPUThreshold threshold] [[-S|--SSDThreshold threshold] [[-V|--VolumeThreshold threshold] [-F|--FileSystemID FileSystemID] [-p|--regionConcurrency number]')
 
 ################################################################################
 # Main logic starts here.
@@ -563,6 +696,7 @@ onlyFilesystemId = None
 defaultCPUThreshold    = int(os.environ.get('defaultCPUThreshold',    defaultCPUThreshold))
 defaultSSDThreshold    = int(os.environ.get('defaultSSDThreshold',    defaultSSDThreshold))
 defaultVolumeThreshold = int(os.environ.get('defaultVolumeThreshold', defaultVolumeThreshold))
+regionConcurrency      = int(os.environ.get('regionConcurrency',      regionConcurrency))
 regionsEnv = os.environ.get('regions', '')
 if regionsEnv != '':
     regions = regionsEnv.split(',')
@@ -570,9 +704,9 @@ if regionsEnv != '':
 # Check to see if we are bring run from a command line or a Lmabda function.
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') == None:
     argumentList = sys.argv[1:]
-    options = "hc:a:s:dr:C:S:V:F:"
+    options = "hc:a:s:dr:C:S:V:F:p:"
 
-    longOptions = ["help", "customerID=", "accountID=", "SNSTopic=", "dryRun", "region=", "CPUThreshold=", "SSDThreshold=", "VolumeThreshold=", "FileSystemID="]
+    longOptions = ["help", "customerID=", "accountID=", "SNSTopic=", "dryRun", "region=", "CPUThreshold=", "SSDThreshold=", "VolumeThreshold=", "FileSystemID=", "regionConcurrency="]
     skip = False
     try:
         arguments, values = getopt.getopt(argumentList, options, longOptions)
@@ -599,6 +733,8 @@ if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') == None:
                 regions += [currentValue]
             elif currentArgument in ("-F", "--FileSystemID"):
                 onlyFilesystemId = currentValue
+            elif currentArgument in ("-p", "--regionConcurrency"):
+                regionConcurrency = int(currentValue)
 
     except getopt.error as err:
         print(str(err))
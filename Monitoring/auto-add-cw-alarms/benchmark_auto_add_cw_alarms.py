@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+################################################################################
+# This program is used to measure how long the auto_add_cw_alarms.py program
+# takes to reconcile the CloudWatch alarms with the FSx for ONTAP file
+# systems and volumes in a region. It generates a synthetic inventory of
+# file systems, volumes and alarms, some of the volumes and file systems
+# missing their alarms, and some of the alarms left over from volumes and
+# file systems that no longer exist, and then reports:
+#   o How long the whole lambda_handler() function takes to run against
+#     fakes of the FSx, CloudWatch and Resource Groups Tagging services
+#     serving that inventory, in one or more regions, along with the number
+#     of each AWS API call made. Some latency can be added to every API call
+#     to show the effect of scanning the regions concurrently. By default, the volumes' tags are returned with the volumes, like
+#     describe_volumes does, but they can be left out, so the program has to
+#     get them from the Resource Groups Tagging API, or, if it isn't allowed
+#     to use it, from each volume.
+#   o How long just checking which alarms to add, and delete, takes when done
+#     with the linear scans the program used to use, for comparison.
+# It also checks that both decide to add, and delete, the same alarms.
+#
+# It doesn't make any AWS API calls, so it can be run anywhere that has the
+# same Python packages installed as the Lambda function.
+#
+# Usage: benchmark_auto_add_cw_alarms.py [-f fileSystems] [-v volumes]
+#            [-a alarms] [-r regions] [-L latency] [-p concurrency] [-s seed]
+#            [-t] [-d] [-n]
+################################################################################
+
+import argparse
+import collections
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+#
+# Setting AWS_LAMBDA_FUNCTION_NAME prevents the program from running when it
+# is imported.
+os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "benchmark_auto_add_cw_alarms"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import auto_add_cw_alarms     # pylint: disable=C0413
+
+region = "us-west-2"
+accountId = "123456789012"
+
+################################################################################
+# This function returns a synthetic inventory of file systems, volumes and
+# alarms. About 5% of the volumes, and file systems, have a tag that disables
+# their alarm, and about 5% have lost their alarms. A few of the alarms are
+# for volumes, and file systems, that no longer exist. The rest of the alarms,
+# up to 'numAlarms', weren't created by the program.
+################################################################################
+def generateInventory(numFss, numVolumes, numAlarms, seed):
+    rng = random.Random(seed)
+    fss = []
+    volumes = []
+    tags = {}
+    alarms = []
+
+    def volumeAlarm(volumeId, fsId):
+        dimensions = [{'Name': 'VolumeId', 'Value': volumeId}, {'Name': 'FileSystemId', 'Value': fsId}]
+        return {'AlarmName': auto_add_cw_alarms.alarmPrefixVolume + volumeId,
+                'Metrics': [{'Id': 'm1', 'MetricStat': {'Metric': {'Namespace': 'AWS/FSx', 'MetricName': 'StorageCapacity', 'Dimensions': dimensions}}}]}
+
+    for i in range(numFss):
+        fsId = f"fs-{rng.getrandbits(68):017x}"
+        fsTags = []
+        if rng.random() < 0.05:
+            fsTags.append({'Key': 'CPU_Alarm_Threshold', 'Value': '100'})
+        if rng.random() < 0.05:
+            fsTags.append({'Key': 'SSD_Alarm_Threshold', 'Value': '100'})
+        fss.append({'FileSystemId': fsId, 'FileSystemType': 'ONTAP', 'Tags': fsTags})
+        for prefix in [auto_add_cw_alarms.alarmPrefixCPU, auto_add_cw_alarms.alarmPrefixSSD]:
+            if rng.random() >= 0.05:
+                alarms.append({'AlarmName': prefix + fsId})
+
+    for i in range(numVolumes):
+        fsId = fss[i % numFss]['FileSystemId']
+        volumeId = f"fsvol-{rng.getrandbits(68):017x}"
+        arn = f"arn:aws:fsx:{region}:{accountId}:volume/{fsId}/{volumeId}"
+        volumes.append({'VolumeId': volumeId, 'Name': f"vol_{i}", 'ResourceARN': arn, 'FileSystemId': fsId, 'VolumeType': 'ONTAP'})
+        tags[arn] = [{'Key': 'alarm_threshold', 'Value': '100'}] if rng.random() < 0.05 else []
+        if rng.random() >= 0.05:
+            alarms.append(volumeAlarm(volumeId, fsId))
+    #
+    # Add the alarms for volumes, and file systems, that have been deleted.
+    for i in range(max(1, numVolumes // 50)):
+        alarms.append(volumeAlarm(f"fsvol-{rng.getrandbits(68):017x}", fss[i % numFss]['FileSystemId']))
+    for i in range(max(1, numFss // 10)):
+        alarms.append({'AlarmName': auto_add_cw_alarms.alarmPrefixCPU + f"fs-{rng.getrandbits(68):017x}"})
+        alarms.append({'AlarmName': auto_add_cw_alarms.alarmPrefixSSD + f"fs-{rng.getrandbits(68):017x}"})
+
+    for i in range(len(alarms), numAlarms):
+        alarms.append({'AlarmName': f"Other-Alarm-{i}"})
+    rng.shuffle(alarms)
+
+    return (fss, volumes, tags, alarms)
+
+################################################################################
+# This class counts API calls. It is shared by the fake AWS clients of all
+# the regions, which are called from several threads. Each call is delayed
+# by 'latency' seconds, to simulate the network.
+################################################################################
+class APICallCounter:
+    def __init__(self, latency):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.latency = latency
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+################################################################################
+# These classes are fakes of the AWS clients auto_add_cw_alarms.py uses. They
+# count the calls made to them, return the inventory in pages, like the real
+# services do, and record the alarms that are added and deleted.
+################################################################################
+class FakeAWSClient:
+    def __init__(self, serviceName, apiCalls):
+        self.serviceName = serviceName
+        self.apiCalls = apiCalls
+
+    def count(self, operation):
+        self.apiCalls.count(f"{self.serviceName} {operation}")
+
+    @staticmethod
+    def page(items, key, pageSize, NextToken=None):    # pylint: disable=C0103
+        start = int(NextToken) if NextToken != None else 0
+        response = {key: items[start:start + pageSize]}
+        if start + pageSize < len(items):
+            response['NextToken'] = str(start + pageSize)
+        return response
+
+    @staticmethod
+    def clientError(code, operation):
+        return auto_add_cw_alarms.botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class FakeFSxClient(FakeAWSClient):
+    def __init__(self, apiCalls, fss, volumes, tags, includeTags):
+        super().__init__("fsx", apiCalls)
+        self.fss = fss
+        self.volumes = [{**volume, 'Tags': tags[volume['ResourceARN']]} for volume in volumes] if includeTags else volumes
+        self.tags = tags
+
+    def describe_file_systems(self, NextToken=None):    # pylint: disable=C0103
+        self.count("DescribeFileSystems")
+        return self.page(self.fss, 'FileSystems', 100, NextToken)
+
+    def describe_volumes(self, NextToken=None):    # pylint: disable=C0103
+        self.count("DescribeVolumes")
+        return self.page(self.volumes, 'Volumes', 100, NextToken)
+
+    def list_tags_for_resource(self, ResourceARN):    # pylint: disable=C0103
+        self.count("ListTagsForResource")
+        return {'Tags': self.tags[ResourceARN]}
+
+class FakeTaggingClient(FakeAWSClient):
+    def __init__(self, apiCalls, tags, allowed):
+        super().__init__("resourcegroupstaggingapi", apiCalls)
+        self.resources = [{'ResourceARN': arn, 'Tags': resourceTags} for (arn, resourceTags) in tags.items() if len(resourceTags) > 0]
+        self.allowed = allowed
+
+    def get_resources(self, ResourceTypeFilters, ResourcesPerPage, PaginationToken=''):    # pylint: disable=C0103,W0613
+        self.count("GetResources")
+        if not self.allowed:
+            raise self.clientError('AccessDeniedException', 'GetResources')
+        response = self.page(self.resources, 'ResourceTagMappingList', ResourcesPerPage, PaginationToken if PaginationToken != '' else None)
+        response['PaginationToken'] = response.pop('NextToken', '')
+        return response
+
+class FakeCloudWatchClient(FakeAWSClient):
+    def __init__(self, apiCalls, alarms):
+        super().__init__("cloudwatch", apiCalls)
+        self.alarms = alarms
+        self.added = set()
+        self.deleted = set()
+
+    def describe_alarms(self, NextToken=None):    # pylint: disable=C0103
+        self.count("DescribeAlarms")
+        return self.page(self.alarms, 'MetricAlarms', 100, NextToken)
+
+    def put_metric_alarm(self, AlarmName, **kwargs):    # pylint: disable=C0103,W0613
+        self.count("PutMetricAlarm")
+        self.added.add(AlarmName)
+
+    def delete_alarms(self, AlarmNames):    # pylint: disable=C0103
+        self.count("DeleteAlarms")
+        self.deleted.update(AlarmNames)
+
+################################################################################
+# This function runs the lambda_handler() function against the fake services,
+# with the same inventory in each of 'numRegions' regions, and returns the
+# alarms it added and deleted in each region.
+################################################################################
+def benchmarkLambdaHandler(fss, volumes, tags, alarms, includeTags, taggingAllowed, numRegions, latency, regionConcurrency):
+    apiCalls = APICallCounter(latency)
+    regionNames = [region] + [f"test-region-{i}" for i in range(1, numRegions)]
+    clients = {}
+    for regionName in regionNames:
+        clients[regionName] = {
+            'fsx': FakeFSxClient(apiCalls, fss, volumes, tags, includeTags),
+            'cloudwatch': FakeCloudWatchClient(apiCalls, alarms),
+            'resourcegroupstaggingapi': FakeTaggingClient(apiCalls, tags, taggingAllowed)
+        }
+
+    class FakeSession:
+        def get_available_regions(self, serviceName):    # pylint: disable=W0613
+            return regionNames
+
+        def client(self, serviceName, region_name=None, config=None):    # pylint: disable=W0613
+            return clients[region_name][serviceName]
+
+    auto_add_cw_alarms.boto3.Session = FakeSession
+    auto_add_cw_alarms.boto3.session.Session = FakeSession
+    auto_add_cw_alarms.SNStopic = "benchmark"
+    auto_add_cw_alarms.accountId = accountId
+    auto_add_cw_alarms.customerId = ''
+    auto_add_cw_alarms.regions = list(regionNames)
+    auto_add_cw_alarms.regionConcurrency = regionConcurrency
+    #
+    # The program reports every alarm it adds, and deletes, so don't let that slow it down.
+    output = io.StringIO()
+    startTime = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        auto_add_cw_alarms.lambda_handler(None, None)
+    elapsed = time.perf_counter() - startTime
+
+    print(f"{'lambda_handler':<40} {elapsed:8.3f} s  {numRegions} region{'s' if numRegions > 1 else ''}, at most {regionConcurrency} at a time")
+    print(f"{'':<40} {output.getvalue().splitlines()[-1]}")
+    print("API calls:")
+    for (name, count) in sorted(apiCalls.counts.items()):
+        print(f"  {name:<40} {count:8,}")
+    print("")
+    return [(clients[regionName]['cloudwatch'].added, clients[regionName]['cloudwatch'].deleted) for regionName in regionNames]
+
+################################################################################
+# This function decides which alarms to add, and delete, the way the program
+# used to, by scanning the lists of alarms, volumes and file systems each
+# time it needs to know if one exists. It returns the alarms to add and
+# delete.
+################################################################################
+def legacyReconcile(fss, volumes, tags, alarms):
+    def contains_alarm(alarmName, alarms):
+        for alarm in alarms:
+            if(alarm['AlarmName'] == alarmName):
+                return True
+        return False
+
+    def contains_volume(volumeId, volumes):
+        for volume in volumes:
+            if(volume['VolumeId'] == volumeId):
+                return True
+        return False
+
+    def contains_fs(fsId, fss):
+        for fs in fss:
+            if(fs['FileSystemId'] == fsId):
+                return True
+        return False
+
+    added = set()
+    deleted = set()
+    for (prefix, getThreshold) in [(auto_add_cw_alarms.alarmPrefixCPU, auto_add_cw_alarms.getCPUAlarmThresholdTagValue),
+                                   (auto_add_cw_alarms.alarmPrefixSSD, auto_add_cw_alarms.getSSDAlarmThresholdTagValue)]:
+        for fs in fss:
+            if int(getThreshold(fs['Tags'])) != 100 and not contains_alarm(prefix + fs['FileSystemId'], alarms):
+                added.add(prefix + fs['FileSystemId'])
+        for alarm in alarms:
+            if alarm['AlarmName'].startswith(prefix) and not contains_fs(alarm['AlarmName'][len(prefix):], fss):
+                deleted.add(alarm['AlarmName'])
+
+    prefix = auto_add_cw_alarms.alarmPrefixVolume
+    for volume in volumes:
+        threshold = 100 if any(tag['Key'].lower() == "alarm_threshold" and tag['Value'] == '100' for tag in tags[volume['ResourceARN']]) else 0
+        if threshold != 100 and not contains_alarm(prefix + volume['VolumeId'], alarms):
+            added.add(prefix + volume['VolumeId'])
+    for alarm in alarms:
+        if alarm['AlarmName'].startswith(prefix) and not contains_volume(alarm['AlarmName'][len(prefix):], volumes):
+            deleted.add(alarm['AlarmName'])
+
+    return (added, deleted)
+
+################################################################################
+# Main logic
+################################################################################
+parser = argparse.ArgumentParser(description="Measure how long the auto_add_cw_alarms.py program takes to reconcile the alarms in one or more regions.")
+parser.add_argument("-f", "--fileSystems", type=int, default=50, help="The number of file systems to generate. Default is 50.")
+parser.add_argument("-v", "--volumes", type=int, default=5000, help="The number of volumes to generate. Default is 5,000.")
+parser.add_argument("-a", "--alarms", type=int, default=15000, help="The total number of alarms to generate, including the ones not created by the program. Default is 15,000.")
+parser.add_argument("-r", "--regions", type=int, default=1, help="The number of regions, each with the same inventory. Default is 1.")
+parser.add_argument("-L", "--latency", type=float, default=0, help="The latency, in milliseconds, to add to each AWS API call. Default is 0.")
+parser.add_argument("-p", "--regionConcurrency", type=int, default=auto_add_cw_alarms.regionConcurrency, help=f"The maximum number of regions to scan at the same time. Default is {auto_add_cw_alarms.regionConcurrency}.")
+parser.add_argument("-s", "--seed", type=int, default=1, help="The seed for the random number generator. Default is 1.")
+parser.add_argument("-t", "--noVolumeTags", action="store_true", help="Don't return the volumes' tags with the volumes, so they have to be fetched separately.")
+parser.add_argument("-d", "--denyTagging", action="store_true", help="Don't allow the use of the Resource Groups Tagging API, so the tags have to be fetched one volume at a time. Only matters with --noVolumeTags.")
+parser.add_argument("-n", "--noLegacy", action="store_true", help="Don't time the linear scans the program used to use, which can take a long time with a large inventory.")
+args = parser.parse_args()
+
+(fss, volumes, tags, alarms) = generateInventory(max(1, args.fileSystems), args.volumes, args.alarms, args.seed)
+print(f"Generated {len(fss):,} file systems, {len(volumes):,} volumes and {len(alarms):,} alarms.\n")
+
+results = benchmarkLambdaHandler(fss, volumes, tags, alarms, not args.noVolumeTags, not args.denyTagging, max(1, args.regions), args.latency / 1000, args.regionConcurrency)
+(added, deleted) = results[0]
+if any(result != results[0] for result in results):
+    print("Warning: The alarms added, or deleted, differ between the regions.")
+
+if not args.noLegacy:
+    startTime = time.perf_counter()
+    (legacyAdded, legacyDeleted) = legacyReconcile(fss, volumes, tags, alarms)
+    elapsed = time.perf_counter() - startTime
+    print(f"{'Linear scans (old way, one region)':<40} {elapsed:8.3f} s  would add {len(legacyAdded):,} and delete {len(legacyDeleted):,} alarms")
+    if legacyAdded != added or legacyDeleted != deleted:
+        print(f"Warning: The alarms added, or deleted, differ from the old way: {len(added ^ legacyAdded):,} added and {len(deleted ^ legacyDeleted):,} deleted differ.")
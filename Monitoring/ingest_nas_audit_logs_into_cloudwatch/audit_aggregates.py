@@ -0,0 +1,238 @@
+################################################################################
+# This module keeps the aggregates of the audit events, for the
+# ingest_audit_log.py program. That is, the number of events, and the values
+# of some of their fields with the most events, per file system per time
+# interval. It is part of the ingest_audit_log.py Lambda function, so it has
+# to be included in the same deployment package.
+################################################################################
+#
+import array
+import collections
+import datetime
+import heapq
+import json
+import threading
+
+################################################################################
+# This class is a count-min sketch. It estimates how many times each key has
+# been added, using a fixed amount of memory no matter how many different
+# keys there are. The estimates are never too low, and are too high by at
+# most a small fraction of the total count, with a high probability. The
+# counters are in arrays of 64 bit integers, so the default size uses 512 KiB.
+################################################################################
+class CountMinSketch:
+    def __init__(self, width=16384, depth=4):
+        self.width = width
+        self.rows = [array.array('q', bytes(8 * width)) for i in range(depth)]
+
+    ############################################################################
+    # This method adds 'count' to a key, and returns the key's new estimate.
+    # The index into each row is derived from a single hash of the key. Only
+    # the counters that would otherwise be below the new estimate are
+    # increased (a "conservative update"), which makes the estimates of the
+    # keys that are added less often much more accurate.
+    ############################################################################
+    def add(self, key, count=1):
+        keyHash = hash(key)
+        (hash1, hash2) = (keyHash & 0xffffffff, ((keyHash >> 32) & 0xffffffff) | 1)
+        width = self.width
+        indexes = [(hash1 + i * hash2) % width for i in range(len(self.rows))]
+        estimate = min(row[index] for (row, index) in zip(self.rows, indexes)) + count
+        for (row, index) in zip(self.rows, indexes):
+            if row[index] < estimate:
+                row[index] = estimate
+        return estimate
+
+################################################################################
+# This class keeps track of the 'size' keys that have been added the most,
+# using a count-min sketch to estimate the count of every key, and a min
+# heap of the current top keys, so a key only has to be compared against the
+# smallest of them. The heap is updated lazily, so it can hold out of date
+# entries, which are skipped, and it is rebuilt if it grows too large.
+################################################################################
+class HeavyHitters:
+    def __init__(self, size=10, width=16384, depth=4):
+        self.size = size
+        self.sketch = CountMinSketch(width, depth)
+        self.counts = {}     # The estimated count of each of the top keys.
+        self.heap = []       # (count, key) tuples, with the smallest count first.
+
+    def add(self, key, count=1):
+        estimate = self.sketch.add(key, count)
+        counts = self.counts
+        if key not in counts:
+            if len(counts) >= self.size:
+                #
+                # Find the smallest of the top keys, skipping any out of date heap entries.
+                while counts.get(self.heap[0][1]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+                if estimate <= self.heap[0][0]:
+                    return
+                del counts[heapq.heappop(self.heap)[1]]
+        counts[key] = estimate
+        heapq.heappush(self.heap, (estimate, key))
+        if len(self.heap) > 8 * self.size:
+            self.heap = [(count, key) for (key, count) in counts.items()]
+            heapq.heapify(self.heap)
+
+    ############################################################################
+    # This method returns the top keys, and their estimated counts, as a list
+    # of [key, count] lists, largest first.
+    ############################################################################
+    def top(self):
+        return [[key, count] for (key, count) in sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))]
+
+################################################################################
+# The fields that can be aggregated:
+#   user: The SubjectUserName data field.
+#   ip: The SubjectIP data field.
+#   path: The path from the ObjectName, or FileName, data field.
+#   event: The event name.
+################################################################################
+aggregateFieldNames = ['user', 'ip', 'path', 'event']
+
+################################################################################
+# This function returns the values of the aggregated fields of an audit
+# event, as a list in the same order as 'fields'. A field that the event
+# doesn't have is an empty string.
+################################################################################
+def getAggregateFields(event, fields):
+    values = {'event': event['System'].get('EventName') or ''}
+    dataFields = (event.get('EventData') or {}).get('Data') or []
+    if isinstance(dataFields, dict):
+        dataFields = [dataFields]
+    for data in dataFields:
+        name = data.get('@Name')
+        if name == 'SubjectUserName':
+            values['user'] = data.get('#text') or ''
+        elif name == 'SubjectIP':
+            values['ip'] = data.get('#text') or ''
+        elif name == 'ObjectName' or name == 'FileName':
+            values['path'] = (data.get('#text') or '').partition(';')[2]
+    return [values.get(field, '') for field in fields]
+
+################################################################################
+# This class aggregates the audit events, from all the audit files processed
+# during an invocation of the Lambda function, into summaries per file system
+# per time interval. For each interval it counts the events and keeps the top
+# 'topN' values of each of the 'fields' (user, ip, path and event), using a
+# HeavyHitters object, so the memory used doesn't depend on how many
+# different users or paths there are. The events are added by AuditFileCounter
+# objects, one per audit file, from several threads at once. Since the files
+# of each SVM are processed in time order, once a file system has more than
+# 'maxOpenIntervals' intervals being aggregated, its oldest is assumed to be
+# complete, and 'onSummary' is called with its summary. The rest are
+# summarized when the aggregator is closed, at the end of the invocation.
+################################################################################
+class AuditAggregator:
+    maxOpenIntervals = 8
+
+    def __init__(self, fields, intervalSeconds, topN, onSummary):
+        self.fields = fields
+        self.intervalMs = intervalSeconds * 1000
+        self.topN = topN
+        self.onSummary = onSummary
+        self.intervals = {}      # The interval being aggregated for each (file system, start time in milliseconds).
+        self.lock = threading.Lock()
+        self.summaries = 0
+
+    ############################################################################
+    # This method adds the events counted from an audit file, for a file
+    # system and interval. 'counts' has a Counter of the values of each of
+    # the fields. Since the counts are added to the same HeavyHitters objects,
+    # a value that is spread across several audit files is counted as a
+    # whole, and the onSummary calls are serialized by the lock.
+    ############################################################################
+    def add(self, fs, start, svms, fileName, events, counts):
+        with self.lock:
+            interval = self.intervals.get((fs, start))
+            if interval == None:
+                openStarts = sorted(openStart for (openFs, openStart) in self.intervals if openFs == fs)
+                if len(openStarts) >= self.maxOpenIntervals and start > openStarts[0]:
+                    self.summarize(fs, openStarts[0])
+                interval = {'svms': set(), 'files': set(), 'events': 0, 'top': [HeavyHitters(self.topN) for field in self.fields]}
+                self.intervals[(fs, start)] = interval
+            interval['svms'].update(svms)
+            interval['files'].add(fileName)
+            interval['events'] += events
+            for (heavyHitters, fieldCounts) in zip(interval['top'], counts):
+                for (value, count) in fieldCounts.items():
+                    heavyHitters.add(value, count)
+
+    def close(self):
+        with self.lock:
+            for (fs, start) in sorted(self.intervals, key=lambda key: (key[1], key[0])):
+                self.summarize(fs, start)
+
+    def summarize(self, fs, start):
+        interval = self.intervals.pop((fs, start))
+        self.summaries += 1
+        self.onSummary({
+            'type': 'AuditSummary',
+            'fs': fs,
+            'svms': sorted(interval['svms']),
+            'intervalStart': datetime.datetime.fromtimestamp(start / 1000, tz=datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'intervalSeconds': self.intervalMs // 1000,
+            'files': len(interval['files']),
+            'events': interval['events'],
+            'top': {field: heavyHitters.top() for (field, heavyHitters) in zip(self.fields, interval['top'])}
+        }, start)
+
+################################################################################
+# This class counts the values of the aggregated fields of the events from an
+# audit file, exactly, by file system and interval, and adds the counts to
+# the AuditAggregator every 'maxEvents' events, and when it is flushed. This
+# way the lock on the aggregator is only taken once in a while, and the
+# HeavyHitters are updated once per value, instead of once per event.
+################################################################################
+class AuditFileCounter:
+    def __init__(self, aggregator, auditLogName, maxEvents=10000):
+        self.aggregator = aggregator
+        self.auditLogName = auditLogName
+        self.maxEvents = maxEvents
+        self.numEvents = 0
+        self.intervals = {}
+
+    def add(self, event, timestamp):
+        start = timestamp - timestamp % self.aggregator.intervalMs
+        (fs, _, svm) = (event['System'].get('Computer') or '').partition('/')
+        interval = self.intervals.get((fs, start))
+        if interval == None:
+            interval = {'svms': set(), 'events': 0, 'counts': [collections.Counter() for field in self.aggregator.fields]}
+            self.intervals[(fs, start)] = interval
+        interval['svms'].add(svm)
+        interval['events'] += 1
+        for (counts, value) in zip(interval['counts'], getAggregateFields(event, self.aggregator.fields)):
+            counts[value] += 1
+        self.numEvents += 1
+        if self.numEvents >= self.maxEvents:
+            self.flush()
+
+    def flush(self):
+        for ((fs, start), interval) in sorted(self.intervals.items(), key=lambda item: item[0][1]):
+            self.aggregator.add(fs, start, interval['svms'], self.auditLogName, interval['events'], interval['counts'])
+        self.intervals = {}
+        self.numEvents = 0
+
+################################################################################
+# This function returns the CloudWatch events for an aggregate summary. With
+# the 'json' output, it is a single event with the summary as a JSON object.
+# With the 'emf' output, it is an event in the CloudWatch Embedded Metric
+# Format for each of the top values, so they are also available as the
+# 'TopOperations' metric, with the file system, field and value as the
+# dimensions.
+################################################################################
+def formatAggregateSummary(summary, timestamp, aggregateOutput='json', emfNamespace='FSxN/AuditLogs'):
+    encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+    if aggregateOutput == 'json':
+        return [{'timestamp': timestamp, 'message': encoder.encode(summary)}]
+
+    cwEvents = []
+    metricDirectives = [{'Namespace': emfNamespace, 'Dimensions': [['fs', 'Field', 'Value']], 'Metrics': [{'Name': 'TopOperations', 'Unit': 'Count'}]}]
+    for (field, top) in summary['top'].items():
+        for (value, count) in top:
+            cwEvents.append({'timestamp': timestamp, 'message': encoder.encode({
+                '_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': metricDirectives},
+                'fs': summary['fs'], 'svms': summary['svms'], 'Field': field, 'Value': value, 'TopOperations': count,
+                'intervalStart': summary['intervalStart'], 'intervalSeconds': summary['intervalSeconds']})})
+    return cwEvents
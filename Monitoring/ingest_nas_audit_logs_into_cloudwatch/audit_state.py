@@ -0,0 +1,341 @@
+################################################################################
+# This module keeps track of how far the ingest_audit_log.py program has
+# gotten processing the audit log files of each SVM, and which invocation
+# of the Lambda function is processing each of them, so several of them can
+# run at the same time. It is part of the ingest_audit_log.py Lambda
+# function, so it has to be included in the same deployment package.
+################################################################################
+#
+import datetime
+import json
+import os
+import random
+import re
+import time
+import boto3
+import botocore
+
+################################################################################
+# The format of the audit log file names. For example:
+#   audit_fsx_D2024-09-24-T13-00-03_0000000000.xml
+# Since an SVM name can have underscores in it, and even "_D", the time is
+# taken from the last "_D" that is followed by one.
+################################################################################
+auditFileNameRegex = re.compile(r'^audit_(.+)_D(\d{4})-(\d{2})-(\d{2})-T(\d{2})-(\d{2})-(\d{2})(?:_\d+)?\.(?:xml|evtx)$')
+
+################################################################################
+# This function returns the name of the SVM an audit log file is for, or
+# None if the filename isn't in the format of an audit log file.
+################################################################################
+def getAuditFileSvm(filename):
+    match = auditFileNameRegex.match(filename)
+    return match.group(1) if match != None else None
+
+################################################################################
+# This function returns the epoch time from the filename. It assumes the
+# filename is in the format of:
+#   audit_fsx_D2024-09-24-T13-00-03_0000000000.xml
+################################################################################
+def getEpoch(filename):
+    (year, month, day, hour, minute, second) = [int(value) for value in auditFileNameRegex.match(filename).groups()[1:]]
+
+    return datetime.datetime(year, month, day, hour, minute, second).timestamp()
+
+################################################################################
+# This exception is raised when a state object can't be written because it
+# has been changed since it was read.
+################################################################################
+class StateConflict(Exception):
+    pass
+
+################################################################################
+# This exception is raised when another invocation of the Lambda function
+# has taken over the lease on the audit file this one is processing.
+################################################################################
+class LeaseLost(Exception):
+    pass
+
+################################################################################
+# This class stores state objects in an S3 bucket. If 'conditionalWrites' is
+# set, writes are conditional on the object not having changed since it was
+# read, using its ETag, or not existing yet, so concurrent invocations of the
+# Lambda function can't overwrite each other's changes. Otherwise, since
+# older versions of boto3 don't support conditional writes, the objects are
+# simply overwritten.
+################################################################################
+class S3StateStore:
+    conflictErrors = ['PreconditionFailed', 'ConditionalRequestConflict']
+
+    def __init__(self, s3Client, bucketName, prefix, conditionalWrites):
+        self.s3Client = s3Client
+        self.bucketName = bucketName
+        self.prefix = prefix
+        self.conditionalWrites = conditionalWrites
+
+    ############################################################################
+    # This method returns the state object and its version, or (None, None)
+    # if it doesn't exist.
+    ############################################################################
+    def read(self, name):
+        try:
+            response = self.s3Client.get_object(Bucket=self.bucketName, Key=self.prefix + name)
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] == "NoSuchKey":
+                return (None, None)
+            raise err
+
+        return (json.loads(response['Body'].read().decode('utf-8')), response['ETag'])
+
+    ############################################################################
+    # This method writes the state object, provided it is still at the
+    # version passed in, and returns its new version. It raises StateConflict
+    # if it isn't.
+    ############################################################################
+    def write(self, name, state, version):
+        if not self.conditionalWrites:
+            condition = {}
+        elif version != None:
+            condition = {'IfMatch': version}
+        else:
+            condition = {'IfNoneMatch': '*'}
+        try:
+            response = self.s3Client.put_object(Bucket=self.bucketName, Key=self.prefix + name, Body=json.dumps(state).encode('UTF-8'), **condition)
+        except botocore.exceptions.ParamValidationError as err:
+            if len(condition) == 0:
+                raise err
+            raise Exception(f"This version of boto3 ({boto3.__version__}) doesn't support S3 conditional writes, which are needed when concurrentInvocations is set. Either upgrade boto3, for example by adding a layer with a newer version of it to the Lambda function, or unset concurrentInvocations.") from err
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in self.conflictErrors:
+                raise StateConflict(f'{self.prefix + name} was changed by someone else.') from err
+            raise err
+
+        return response['ETag']
+
+################################################################################
+# This class stores state objects as files in a local directory, with the
+# same conditional writes as the S3StateStore. It can be used to test
+# running several copies of this script at the same time on one machine.
+################################################################################
+class LocalStateStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    ############################################################################
+    # This method returns the state object and its version, or (None, None)
+    # if it doesn't exist.
+    ############################################################################
+    def read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return (None, None)
+
+        return (data['state'], data['version'])
+
+    ############################################################################
+    # This method writes the state object, provided it is still at the
+    # version passed in, and returns its new version. It raises StateConflict
+    # if it isn't. A lock file makes the check and the write atomic.
+    ############################################################################
+    def write(self, name, state, version):
+        import fcntl    # pylint: disable=C0415
+
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'w', encoding='utf-8') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            (currentState, currentVersion) = self.read(name)
+            if currentVersion != version:
+                raise StateConflict(f'{path} was changed by someone else.')
+            newVersion = (version or 0) + 1
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'version': newVersion, 'state': state}, f)
+            os.replace(path + '.tmp', path)
+
+        return newVersion
+
+################################################################################
+# This class reads and updates the states kept in a state store. There is a
+# state for each FSxN, named after it, that holds:
+#   auditSvms: The SVMs on the FSxN that have auditing configured, and when
+#     they were last looked for. See getAuditSvms() in ingest_audit_log.py.
+# And a state for each of those SVMs, named "<FSxN>/<SVM>", that holds:
+#   lastEpoch: The epoch time of the last audit file that, it and all the
+#     ones before it, have been fully processed.
+#   lastFile: The name of that file.
+#   files: The audit files after lastFile that are being, or have been,
+#     processed. For each one it holds:
+#       lease: Which invocation of the Lambda function is processing it,
+#         and when that lease expires.
+#       checkpoint: How far into the file processing has gotten. That is,
+#         the offset just past the last event that was sent, and the number
+#         of events sent from the file so far.
+#       done: Set once the whole file has been processed.
+# 'workerId' identifies this invocation of the Lambda function in the
+# leases it takes, which last 'leaseDuration' seconds. If an SVM doesn't
+# have a state yet, it is started from what older versions of this script,
+# which only processed a single SVM per FSxN, stored for it. That is either
+# the FSxN's own state, or its entry in 'legacyLastFileRead', the single
+# stats file even older versions used.
+################################################################################
+class StateManager:
+    maxAttempts = 10
+
+    def __init__(self, stateStore, workerId, leaseDuration, legacyLastFileRead=None, vserverName=None):
+        self.stateStore = stateStore
+        self.workerId = workerId
+        self.leaseDuration = leaseDuration
+        self.legacyLastFileRead = legacyLastFileRead or {}
+        self.vserverName = vserverName
+
+    ############################################################################
+    # This method returns a state, and its version, from the state store.
+    ############################################################################
+    def read(self, name):
+        (state, version) = self.stateStore.read(f"{name}.json")
+        if '/' not in name:
+            return (state if state != None else {}, version)
+
+        if state == None:
+            state = self.getLegacySvmState(*name.split('/', 1))
+        state.setdefault('files', {})
+        return (state, version)
+
+    ############################################################################
+    # This method returns the state to start an SVM with from the state older
+    # versions of this script stored for the FSxN it is on. Since those only
+    # ever processed one SVM, the state is only used if the last file
+    # processed is from this SVM. The oldest versions only stored the time of
+    # the last file processed, so that is used if this SVM is the only one
+    # with auditing configured on the FSxN, or the only one vserverName is
+    # set to, since it must then be the one that was processed.
+    ############################################################################
+    def getLegacySvmState(self, fsxn, svm):
+        fsxnState = self.stateStore.read(f"{fsxn}.json")[0]
+        auditSvmNames = [auditSvm['svm'] for auditSvm in ((fsxnState or {}).get('auditSvms') or {}).get('svms', [])]
+        onlySvm = auditSvmNames == [svm] or self.vserverName == [svm]
+        for legacyState in [fsxnState, self.legacyLastFileRead.get(fsxn)]:
+            if legacyState == None:
+                continue
+            if not isinstance(legacyState, dict):
+                legacyState = {'lastEpoch': legacyState}
+            lastFile = legacyState.get('lastFile')
+            if lastFile != None and getAuditFileSvm(lastFile) == svm:
+                return {'lastEpoch': legacyState.get('lastEpoch'), 'lastFile': lastFile,
+                        'files': {name: fileState for (name, fileState) in legacyState.get('files', {}).items() if getAuditFileSvm(name) == svm}}
+            if lastFile == None and legacyState.get('lastEpoch') != None and onlySvm:
+                return {'lastEpoch': legacyState['lastEpoch']}
+
+        return {}
+
+    ############################################################################
+    # This method updates a state. The 'update' function is passed the
+    # current state, changes it, and returns a tuple of whether the state
+    # should be written, and a value to return. Since other invocations of
+    # the Lambda function can change the state at the same time, if the
+    # state changes between reading and writing it, it is read, and
+    # updated, again.
+    ############################################################################
+    def update(self, name, update):
+        for attempt in range(self.maxAttempts):
+            (state, version) = self.read(name)
+            (changed, result) = update(state)
+            if not changed:
+                return result
+            try:
+                self.stateStore.write(f"{name}.json", state, version)
+                return result
+            except StateConflict:
+                time.sleep(random.uniform(0.05, 0.25) * (attempt + 1))
+
+        raise Exception(f"Unable to update the state of {name} after {self.maxAttempts} attempts.")
+
+    ############################################################################
+    # This method returns True if another invocation of the Lambda function
+    # holds an unexpired lease on an audit file.
+    ############################################################################
+    def leasedByOther(self, fileState):
+        lease = fileState.get('lease')
+        return lease != None and lease['owner'] != self.workerId and lease['expires'] > time.time()
+
+    ############################################################################
+    # This method takes a lease on the first audit file, from the list passed
+    # in, that isn't done, and isn't being processed by another invocation of
+    # the Lambda function. Always taking the first one ensures that every
+    # file before a leased one has been leased too, so lastFile can only be
+    # advanced past files that are done. 'source' is the FSxN and SVM the
+    # files are from, as "<FSxN>/<SVM>". It returns the file, and its
+    # checkpoint, or (None, None) if there aren't any files left to process.
+    ############################################################################
+    def leaseNextFile(self, source, files):
+        def update(state):
+            fileStates = state['files']
+            changed = False
+            #
+            # Forget any files that have been removed from the volume before they were done.
+            if len(files) > 0:
+                names = set(file['name'] for file in files)
+                for name in list(fileStates):
+                    if name not in names and name < files[-1]['name'] and not self.leasedByOther(fileStates[name]):
+                        print(f"Warning: {name} on {source} no longer exists.")
+                        del fileStates[name]
+                        changed = True
+                changed = advanceLastFile(state) or changed
+
+            for file in files:
+                if state.get('lastEpoch') != None and getEpoch(file['name']) <= state['lastEpoch']:
+                    continue
+                fileState = fileStates.get(file['name'], {})
+                if fileState.get('done') or self.leasedByOther(fileState):
+                    continue
+                fileState['lease'] = {'owner': self.workerId, 'expires': time.time() + self.leaseDuration}
+                fileStates[file['name']] = fileState
+                return (True, (file, fileState.get('checkpoint')))
+
+            return (changed, (None, None))
+
+        return self.update(source, update)
+
+    ############################################################################
+    # This method records the progress made processing an audit file. It
+    # saves the checkpoint, and renews the lease, unless 'release' is set, in
+    # which case the lease is given up. If the file is done, lastFile is
+    # advanced, if possible. It raises LeaseLost if another invocation of the
+    # Lambda function has taken over the file.
+    ############################################################################
+    def saveFileProgress(self, source, fileName, checkpoint=None, done=False, release=False):
+        def update(state):
+            fileState = state['files'].get(fileName)
+            if fileState == None or self.leasedByOther(fileState) or (fileState.get('lease') or {}).get('owner') != self.workerId:
+                raise LeaseLost(f"Lost the lease on {fileName} on {source}.")
+            if checkpoint != None:
+                fileState['checkpoint'] = checkpoint
+            if done:
+                state['files'][fileName] = {'done': True}
+                advanceLastFile(state)
+            elif release:
+                fileState.pop('lease')
+            else:
+                fileState['lease']['expires'] = time.time() + self.leaseDuration
+            return (True, None)
+
+        self.update(source, update)
+
+################################################################################
+# This function advances lastFile, and lastEpoch, past all the files at the
+# start of the list of files that are done. It returns True if it did.
+################################################################################
+def advanceLastFile(state):
+    fileStates = state['files']
+    changed = False
+    for name in sorted(fileStates):
+        if not fileStates[name].get('done'):
+            break
+        state['lastEpoch'] = getEpoch(name)
+        state['lastFile'] = name
+        del fileStates[name]
+        changed = True
+
+    return changed
@@ -0,0 +1,876 @@
+#!/bin/python3
+################################################################################
+# This program is used to measure how fast the ingest_audit_log.py program
+# can process NAS audit events. It generates a synthetic ONTAP XML audit log
+# file, with a configurable number of events, or size, and mix of events,
+# and then reports:
+#   o How fast the whole lambda_handler() function can ingest the file, and
+#     optionally several copies of it, for one or more SVMs, from a local
+#     fake of the ONTAP API into a fake of CloudWatch Logs, along with the peak memory used
+#     and the number of each ONTAP and AWS API call made.
+#   o How fast the events can be parsed from the file, and, optionally, from
+#     an EVTX version of it, and the size of the EVTX version compared to
+#     the XML one. Note that since most of the values in an EVTX file are
+#     stored as UTF-16 strings, it is typically a little larger.
+#   o How fast the parsed events can be formatted into CloudWatch events,
+#     compared to the way it used to be done, and how fast, and how large,
+#     each of the output formats is, optionally with only some of the fields.
+#   o How fast the whole file can be parsed and formatted.
+#   o How fast the multipart responses from ONTAP, when reading the file,
+#     can be decoded, compared to the requests_toolbelt decoder that used to
+#     be used, if it is installed.
+#
+# It doesn't make any AWS or ONTAP API calls, so it can be run anywhere
+# that has the same Python packages installed as the Lambda function. The
+# optional configuration variables of the program, like outputFormat or
+# logStreamStrategy, can be set as environment variables to see how they
+# affect the end to end run.
+#
+# Usage: benchmark_ingest_audit_log.py [-e events | -z MiB] [-m mix] [-n files]
+#            [-S svms] [-L latency] [-x] [-l] [-f file] [-s seed] [-o fields]
+################################################################################
+
+import argparse
+import collections
+import datetime
+import fnmatch
+import http.server
+import io
+import json
+import os
+import random
+import re
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+import zlib
+#
+# Setting AWS_LAMBDA_FUNCTION_NAME prevents the program from calling its
+# lambda_handler() function when it is imported.
+os.environ["AWS_LAMBDA_FUNCTION_NAME"] = "benchmark_ingest_audit_log"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ingest_audit_log     # pylint: disable=C0413
+import evtx_reader          # pylint: disable=C0413
+
+################################################################################
+# The mix of events to generate. The second value is the relative weight.
+################################################################################
+eventMix = [
+    ("Open Object", 30),
+    ("Read Object", 25),
+    ("Get Object Attributes", 20),
+    ("Write Object", 10),
+    ("Set Object Attributes", 5),
+    ("Close Object", 5),
+    ("Delete Object", 3),
+    ("Rename Object", 2)
+]
+
+################################################################################
+# This function returns a single synthetic audit event in the same XML
+# format that ONTAP uses.
+################################################################################
+def generateEvent(rng, eventTime, eventName):
+    user = rng.randrange(200)
+    path = f"/share{rng.randrange(10)}/dir{rng.randrange(100)}/file{rng.randrange(10000)}.txt"
+    result = "Audit Success" if rng.random() < 0.95 else "Audit Failure"
+    data = [
+        f'<Data Name="SubjectIP" IPVersion="4">10.0.{user // 100}.{user % 100}</Data>',
+        f'<Data Name="SubjectUnix" Uid="{1000 + user}" Gid="100" Local="false"></Data>',
+        f'<Data Name="SubjectUserSid">S-1-5-21-3623811015-3361044348-30300820-{1000 + user}</Data>',
+        '<Data Name="SubjectUserIsLocal">false</Data>',
+        '<Data Name="SubjectDomainName">CORP</Data>',
+        f'<Data Name="SubjectUserName">user{user}</Data>',
+        '<Data Name="ObjectServer">Security</Data>',
+        '<Data Name="ObjectType">File</Data>',
+        f'<Data Name="HandleID">00000000000{rng.randrange(1000):03d};00;00000040;0a1b2c3d</Data>',
+        f'<Data Name="ObjectName">(vol1);{path}</Data>',
+        '<Data Name="AccessList">%%4416 %%4423</Data>',
+        '<Data Name="AccessMask">81</Data>',
+        '<Data Name="DesiredAccess">Read Data; List Directory; Read Attributes</Data>',
+        '<Data Name="Attributes">Open a non-directory</Data>'
+    ]
+    if eventName == "Get Object Attributes":
+        data.append('<Data Name="InformationRequested">File Type; File Size; Last Modified Time</Data>')
+        data.append('<Data Name="InformationSet"></Data>')
+    elif eventName == "Rename Object":
+        data.append(f'<Data Name="OldPath">{path}</Data>')
+        data.append(f'<Data Name="NewPath">{path}.old</Data>')
+
+    systemTime = eventTime.strftime("%Y-%m-%dT%H:%M:%S.") + f"{eventTime.microsecond:06d}000Z"
+    return ('<Event><System><Provider Name="NetApp-Security-Auditing" Guid="{3CB2A168-FE19-4A4E-BDAD-DCF422F13473}"/>'
+            f'<EventID>4663</EventID><EventName>{eventName}</EventName><Version>101.3</Version><Source>CIFS</Source>'
+            f'<Level>0</Level><Opcode>0</Opcode><Keywords>0x8020000000000000</Keywords><Result>{result}</Result>'
+            f'<TimeCreated SystemTime="{systemTime}"/><Correlation/><Channel>Security</Channel>'
+            '<Computer>fs-0123456789abcdef0/fsx</Computer><ComputerUUID>4b9c8e26-8b6e-11ef-a6d4-0242ac120002/4f5d0f1c-8b6e-11ef-a6d4-0242ac120002</ComputerUUID>'
+            f'<Security/></System><EventData>{"".join(data)}</EventData></Event>\n')
+
+################################################################################
+# This function parses an event mix in the form "name=weight,name=weight"
+# into a list of (name, weight) tuples.
+################################################################################
+def parseEventMix(mix):
+    eventMix = []
+    for item in mix.split(','):
+        (name, _, weight) = item.rpartition('=')
+        if name.strip() == "" or not weight.strip().isdigit():
+            raise ValueError(f"Invalid event mix item '{item}'. It should be name=weight.")
+        eventMix.append((name.strip(), int(weight)))
+
+    return eventMix
+
+################################################################################
+# This function writes a synthetic audit log file with the specified number
+# of events, or, if 'maxBytes' is set, with as many events as fit in that
+# many bytes. It returns the size of the file in bytes and the number of
+# events in it.
+################################################################################
+def generateAuditFile(fileName, numEvents, seed, mix, maxBytes=None):
+    rng = random.Random(seed)
+    eventNames = [name for (name, weight) in mix]
+    weights = [weight for (name, weight) in mix]
+    eventTime = datetime.datetime(2024, 9, 22, 21, 0, 0, tzinfo=datetime.timezone.utc)
+    trailer = '</Events>\n'
+    with open(fileName, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<Events xmlns="http://www.netapp.com/audit">\n')
+        fileSize = f.tell()
+        i = 0
+        while maxBytes != None or i < numEvents:
+            eventTime += datetime.timedelta(microseconds=rng.randrange(5000))
+            event = generateEvent(rng, eventTime, rng.choices(eventNames, weights)[0])
+            if maxBytes != None:
+                fileSize += len(event)    # The events are all ASCII.
+                if fileSize + len(trailer) > maxBytes:
+                    break
+            f.write(event)
+            i += 1
+        f.write(trailer)
+
+    return (os.path.getsize(fileName), i)
+
+################################################################################
+# This class writes audit events to a file in the EVTX format, the binary
+# format ONTAP can write the audit logs in instead of XML. Each event is
+# stored as an instance of a template, one for each different structure of
+# event, along with the values to substitute into it. The values are stored
+# as strings, except for the time, event ID, keywords and SID which are
+# stored in their binary form, as they are in the EVTX files ONTAP writes.
+################################################################################
+class EvtxWriter:
+    valueTypes = {('TimeCreated', '@SystemTime'): 0x11, ('EventID', None): 0x06, ('Keywords', None): 0x15, ('SubjectUserSid', None): 0x13}
+
+    def __init__(self, f):
+        self.f = f
+        self.f.write(bytes(4096))
+        self.numChunks = 0
+        self.recordId = 1
+        self.startChunk()
+
+    ############################################################################
+    # This method starts a new chunk, with its own names and templates.
+    ############################################################################
+    def startChunk(self):
+        self.chunk = bytearray(evtx_reader.evtxChunkHeaderSize)
+        self.names = {}
+        self.templates = {}
+        self.firstRecordId = self.recordId
+        self.lastRecordOffset = 0
+
+    ############################################################################
+    # This method writes the current chunk, if it has any records in it.
+    ############################################################################
+    def finishChunk(self):
+        if self.recordId == self.firstRecordId:
+            return
+        chunk = self.chunk
+        freeSpaceOffset = len(chunk)
+        chunk[0:8] = evtx_reader.evtxChunkSignature
+        struct.pack_into('<QQQQIIII', chunk, 8, self.firstRecordId, self.recordId - 1, self.firstRecordId, self.recordId - 1,
+                         128, self.lastRecordOffset, freeSpaceOffset, zlib.crc32(chunk[evtx_reader.evtxChunkHeaderSize:]))
+        struct.pack_into('<I', chunk, 124, zlib.crc32(chunk[0:120] + chunk[128:evtx_reader.evtxChunkHeaderSize]))
+        self.f.write(chunk + bytes(evtx_reader.evtxChunkSize - len(chunk)))
+        self.numChunks += 1
+
+    ############################################################################
+    # This method finishes the file by writing the last chunk and the header.
+    ############################################################################
+    def close(self):
+        self.finishChunk()
+        header = bytearray(128)
+        header[0:8] = evtx_reader.evtxFileSignature
+        struct.pack_into('<QQQIHHHH', header, 8, 0, max(self.numChunks - 1, 0), self.recordId, 128, 2, 3, 4096, self.numChunks)
+        struct.pack_into('<I', header, 124, zlib.crc32(header[0:120]))
+        self.f.seek(0)
+        self.f.write(header)
+
+    ############################################################################
+    # This method adds an event, passed as an ElementTree element, starting a
+    # new chunk if it doesn't fit in the current one.
+    ############################################################################
+    def writeEvent(self, element, fileTime):
+        (structure, values) = self.getStructure(element)
+        for attempt in range(2):
+            (start, names, templates) = (len(self.chunk), dict(self.names), dict(self.templates))
+            self.encodeRecord(structure, values, fileTime)
+            if len(self.chunk) <= evtx_reader.evtxChunkSize:
+                self.lastRecordOffset = start
+                self.recordId += 1
+                return
+            #
+            # It didn't fit, so undo it and try again in a new chunk.
+            del self.chunk[start:]
+            (self.names, self.templates) = (names, templates)
+            self.finishChunk()
+            self.startChunk()
+        raise Exception("An event is too large to fit in an EVTX chunk.")
+
+    ############################################################################
+    # This method returns the structure of an element, as a tuple that can be
+    # used as the key of its template, and the values to substitute into it.
+    ############################################################################
+    def getStructure(self, element, values=None):
+        if values == None:
+            values = []
+        tag = element.tag.rsplit('}', 1)[-1]
+        key = tag if tag != 'Data' else element.get('Name')
+        attributes = []
+        for (name, value) in element.attrib.items():
+            attributes.append((name, len(values), self.valueTypes.get((key, '@' + name), 0x01)))
+            values.append((value, attributes[-1][2]))
+        text = None
+        if element.text != None and element.text.strip() != '':
+            text = (len(values), self.valueTypes.get((key, None), 0x01))
+            values.append((element.text.strip(), text[1]))
+        children = tuple(self.getStructure(child, values)[0] for child in element)
+
+        return ((tag, tuple(attributes), text, children), values)
+
+    ############################################################################
+    # This method appends a reference to a name, and the name itself if it
+    # hasn't been used in the chunk yet.
+    ############################################################################
+    def encodeName(self, name):
+        chunk = self.chunk
+        offset = self.names.get(name)
+        if offset != None:
+            chunk += struct.pack('<I', offset)
+            return
+        offset = len(chunk) + 4
+        self.names[name] = offset
+        encoded = name.encode('utf-16-le')
+        chunk += struct.pack('<IIHH', offset, 0, zlib.crc32(encoded) & 0xffff, len(name)) + encoded + b'\x00\x00'
+
+    ############################################################################
+    # This method appends an element of a template.
+    ############################################################################
+    def encodeElement(self, structure):
+        (tag, attributes, text, children) = structure
+        chunk = self.chunk
+        start = len(chunk)
+        chunk += struct.pack('<BHI', 0x41 if len(attributes) > 0 else 0x01, 0, 0)
+        self.encodeName(tag)
+        if len(attributes) > 0:
+            attributesStart = len(chunk)
+            chunk += bytes(4)
+            for (i, (name, index, valueType)) in enumerate(attributes):
+                chunk += bytes([0x46 if i < len(attributes) - 1 else 0x06])
+                self.encodeName(name)
+                chunk += struct.pack('<BHB', 0x0e, index, valueType)
+            struct.pack_into('<I', chunk, attributesStart, len(chunk) - attributesStart - 4)
+        if text == None and len(children) == 0:
+            chunk += b'\x03'
+        else:
+            chunk += b'\x02'
+            if text != None:
+                chunk += struct.pack('<BHB', 0x0e, text[0], text[1])
+            for child in children:
+                self.encodeElement(child)
+            chunk += b'\x04'
+        struct.pack_into('<I', chunk, start + 3, len(chunk) - start - 7)
+
+    ############################################################################
+    # This method appends an event record.
+    ############################################################################
+    def encodeRecord(self, structure, values, fileTime):
+        chunk = self.chunk
+        start = len(chunk)
+        chunk += evtx_reader.evtxRecordSignature + struct.pack('<IQQ', 0, self.recordId, fileTime)
+        chunk += b'\x0f\x01\x01\x00'
+        templateOffset = self.templates.get(structure)
+        templateId = zlib.crc32(repr(structure).encode('utf-8'))
+        if templateOffset == None:
+            templateOffset = len(chunk) + 10
+            self.templates[structure] = templateOffset
+            chunk += struct.pack('<BBII', 0x0c, 0x01, templateId, templateOffset)
+            chunk += struct.pack('<II', 0, templateId) + templateId.to_bytes(4, 'little') * 3 + bytes(4)
+            chunk += b'\x0f\x01\x01\x00'
+            self.encodeElement(structure)
+            chunk += b'\x00'
+            struct.pack_into('<I', chunk, templateOffset + 20, len(chunk) - templateOffset - 24)
+        else:
+            chunk += struct.pack('<BBII', 0x0c, 0x01, templateId, templateOffset)
+        encodedValues = [encodeEvtxValue(value, valueType) for (value, valueType) in values]
+        chunk += struct.pack('<I', len(values))
+        for (value, (text, valueType)) in zip(encodedValues, values):
+            chunk += struct.pack('<HBx', len(value), valueType)
+        for value in encodedValues:
+            chunk += value
+        chunk += struct.pack('<I', len(chunk) - start + 4)
+        struct.pack_into('<I', chunk, start + 4, len(chunk) - start)
+
+################################################################################
+# This function returns the binary form of a value for an EVTX record.
+################################################################################
+def encodeEvtxValue(value, valueType):
+    if valueType == 0x11:
+        return struct.pack('<Q', getFileTime(value))
+    if valueType == 0x06:
+        return struct.pack('<H', int(value))
+    if valueType == 0x15:
+        return struct.pack('<Q', int(value, 16))
+    if valueType == 0x13:
+        fields = value.split('-')
+        subAuthorities = [int(field) for field in fields[3:]]
+        return (bytes([int(fields[1]), len(subAuthorities)]) + int(fields[2]).to_bytes(6, 'big') +
+                struct.pack(f'<{len(subAuthorities)}I', *subAuthorities))
+    return value.encode('utf-16-le')
+
+################################################################################
+# This function converts a time, in the format ONTAP uses in the XML audit
+# logs, into a Windows FILETIME, which is the number of 100ns intervals since
+# the start of 1601.
+################################################################################
+def getFileTime(systemTime):
+    seconds = int(datetime.datetime.strptime(systemTime[0:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp())
+    fraction = systemTime[20:].rstrip('Z').ljust(7, '0')[0:7] if systemTime[19:20] == '.' else '0'
+    return (seconds + 11644473600) * 10000000 + int(fraction)
+
+################################################################################
+# This function writes an EVTX version of an XML audit log file and returns
+# its size in bytes.
+################################################################################
+def convertToEvtx(xmlFileName, evtxFileName):
+    with open(evtxFileName, "wb") as f:
+        writer = EvtxWriter(f)
+        for (action, element) in ET.iterparse(xmlFileName):
+            if element.tag.rsplit('}', 1)[-1] == 'Event':
+                systemTime = element.find('{*}System/{*}TimeCreated').get('SystemTime')
+                writer.writeEvent(element, getFileTime(systemTime))
+                element.clear()
+        writer.close()
+
+    return os.path.getsize(evtxFileName)
+
+################################################################################
+# This function returns the chunks of the file, as they would be read from
+# ONTAP.
+################################################################################
+def readChunks(fileName, blockSize=1024*1024):
+    with open(fileName, "rb") as f:
+        while True:
+            chunk = f.read(blockSize)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+################################################################################
+# This function returns the file as a list of multipart responses, in the
+# same format ONTAP uses when a file is read, one per block. Each response
+# is returned as a tuple of its Content-Type header and its body.
+################################################################################
+def createMultipartResponses(fileName, blockSize=1024*1024):
+    return [createMultipartResponse(chunk) for chunk in readChunks(fileName, blockSize)]
+
+################################################################################
+# This function returns a multipart response, in the same format ONTAP uses
+# when a file is read, for a chunk of a file. It is returned as a tuple of
+# its Content-Type header and its body.
+################################################################################
+def createMultipartResponse(chunk):
+    boundary = "aK8s3nD0q1vX7yZ2"
+    body = (f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="bytes_read"\r\n\r\n{len(chunk)}'
+            f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="data"\r\nContent-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+    body += chunk + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    return (f"multipart/form-data; boundary={boundary}", body)
+
+################################################################################
+# This is how readFileRange() used to decode the responses from ONTAP. It
+# is used as the baseline to compare against.
+################################################################################
+def legacyDecode(contentType, data):
+    from requests_toolbelt.multipart import decoder     # pylint: disable=C0415
+    boundary = data[4:20].decode('utf-8')
+    multipart_data = decoder.MultipartDecoder(data, f"multipart/form-data; boundary={boundary}")
+    bytesRead = 0
+    chunks = []
+    firstPart = True
+    for part in multipart_data.parts:
+        if(firstPart):
+            bytesRead = int(part.text)
+            firstPart = False
+        else:
+            chunks.append(part.content)
+
+    return (bytesRead, chunks)
+
+################################################################################
+# This is how readFileRange() now decodes the responses from ONTAP.
+################################################################################
+def decode(contentType, data):
+    parts = ingest_audit_log.decodeMultipart(data, ingest_audit_log.getMultipartBoundary(contentType, data))
+    bytesRead = int(bytes(next(parts, b'0')))
+    return (bytesRead, list(parts))
+
+################################################################################
+# This is how createCWEvent() used to format the events. It is used as the
+# baseline to compare against.
+################################################################################
+def legacyCreateCWEvent(event):
+    ignoredDataFields = ["ObjectServer", "HandleID", "InformationRequested", "AccessList", "AccessMask", "DesiredAccess", "Attributes", "DirHandleID", "SearchFilter", "SearchPattern", "SubjectPort", "OldDirHandle", "NewDirHandle"]
+    year = int(event['System']['TimeCreated']['@SystemTime'].split('-')[0])
+    month = int( event['System']['TimeCreated']['@SystemTime'].split('-')[1])
+    day =  int(event['System']['TimeCreated']['@SystemTime'].split('-')[2].split('T')[0])
+    hour =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[0])
+    minute =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[1])
+    second =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[0])
+    msecond = event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[1].split('Z')[0]
+    t = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).timestamp()
+    msecond = int(msecond)/(10 ** (len(msecond) - 3))
+    t = int(t * 1000 + msecond)
+    cwData  = f"Date={event['System']['TimeCreated']['@SystemTime']}, "
+    cwData += f"Event={event['System']['EventName'].replace(' ', '-')}, "
+    cwData += f"fs={event['System']['Computer'].split('/')[0]}, "
+    cwData += f"svm={event['System']['Computer'].split('/')[1]}, "
+    cwData += f"Result={event['System']['Result'].replace(' ', '-')}"
+    for data in event['EventData']['Data']:
+        if data['@Name'] not in ignoredDataFields:
+            if data['@Name'] == 'SubjectIP':
+                cwData += f", IP={data['#text']}"
+            elif data['@Name'] == 'SubjectUnix':
+                cwData += f", UnixID={data['@Uid']}, GroupID={data['@Gid']}"
+            elif data['@Name'] == 'SubjectUserSid':
+                cwData += f", UserSid={data['#text']}"
+            elif data['@Name'] == 'SubjectUserName':
+                cwData += f", UserName={data['#text']}"
+            elif data['@Name'] == 'SubjectDomainName':
+                cwData += f", Domain={data['#text']}"
+            elif data['@Name'] == 'ObjectName' or data['@Name'] == 'FileName':
+                cwData += f", volume={data['#text'].split(';')[0].replace('(', '').replace(')', '')}, name={data['#text'].split(';')[1]}"
+            elif data['@Name'] == 'InformationSet':
+                if data.get('#text') == None:
+                    cwData += ", InformationSet=Null"
+                else:
+                    cwData += f", InformationSet={data['#text']}"
+            else:
+                cwData += f", {data['@Name']}={data['#text']}"
+
+    return {'timestamp': t, 'message': cwData}
+
+################################################################################
+# This function prints the results of a benchmark.
+################################################################################
+def report(name, numEvents, elapsed, numBytes=None):
+    line = f"{name:<40} {elapsed:8.2f} s {numEvents/elapsed:12,.0f} events/s {elapsed/numEvents*1e6:8.2f} us/event"
+    if numBytes != None:
+        line += f" {numBytes/elapsed/1024/1024:8.1f} MiB/s"
+    print(line)
+
+################################################################################
+# This class counts API calls. It is shared by the fake ONTAP server and the
+# fake AWS clients, which are called from several threads.
+################################################################################
+class APICallCounter:
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+################################################################################
+# This class handles the requests to the fake ONTAP server. It implements
+# just enough of the ONTAP REST API for ingest_audit_log.py. That is,
+# finding the SVMs with auditing configured, looking up their audit volumes,
+# listing the audit files on them, and reading them, with the same multipart
+# framing ONTAP uses. Each SVM writes its audit logs to the "audit" directory
+# of its own volume. All the audit files are backed by the same generated
+# file.
+################################################################################
+class FakeOntapRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):    # pylint: disable=W0622
+        pass
+
+    def sendBody(self, contentType, body):
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):    # pylint: disable=C0103
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        match = re.fullmatch(r"/api/storage/volumes/([^/]+)/files/audit(/(.+))?", path)
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        if path == "/api/protocols/audit":
+            server.apiCalls.count("ONTAP GET /protocols/audit")
+            records = [{"svm": {"name": svm}, "enabled": True, "log_path": f"/{svm}_audit/audit"} for svm in server.svms.values()]
+            self.sendBody("application/json", json.dumps({"records": records, "num_records": len(records)}).encode('utf-8'))
+        elif path == "/api/storage/volumes":
+            server.apiCalls.count("ONTAP GET /storage/volumes")
+            records = [{"uuid": uuid, "name": f"{svm}_audit", "svm": {"name": svm}, "nas": {"path": f"/{svm}_audit"}} for (uuid, svm) in server.svms.items()]
+            self.sendBody("application/json", json.dumps({"records": records, "num_records": len(records)}).encode('utf-8'))
+        elif match != None and match.group(1) in server.svms and match.group(2) == None:
+            server.apiCalls.count("ONTAP GET /storage/volumes/{uuid}/files/{dir} (list)")
+            nameQuery = query.get("name", "*")
+            fileNames = server.fileNames[server.svms[match.group(1)]]
+            if ".." in nameQuery:
+                (low, high) = nameQuery.split("..", 1)
+                names = [name for name in fileNames if low <= name <= high]
+            else:
+                names = [name for name in fileNames if fnmatch.fnmatchcase(name, nameQuery)]
+            records = [{"name": name, "type": "file", "size": server.fileSize} for name in sorted(names)]
+            self.sendBody("application/json", json.dumps({"records": records, "num_records": len(records)}).encode('utf-8'))
+        elif match != None and match.group(1) in server.svms and match.group(3) in server.fileNames[server.svms[match.group(1)]]:
+            server.apiCalls.count("ONTAP GET /storage/volumes/{uuid}/files/{path} (read)")
+            with open(server.auditFileName, "rb") as f:
+                f.seek(int(query.get("byte_offset", 0)))
+                chunk = f.read(int(query.get("length", server.fileSize)))
+            self.sendBody(*createMultipartResponse(chunk))
+        else:
+            server.apiCalls.count("ONTAP other")
+            self.send_error(404)
+
+################################################################################
+# This function starts the fake ONTAP server, in its own thread, serving
+# 'numFiles' audit files, with the contents of 'auditFileName', for each of
+# 'numSvms' SVMs. Each request is delayed by 'latency' seconds, to simulate
+# the network.
+################################################################################
+def startFakeOntapServer(auditFileName, numFiles, numSvms, latency, apiCalls):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeOntapRequestHandler)
+    server.daemon_threads = True
+    server.auditFileName = auditFileName
+    server.fileSize = os.path.getsize(auditFileName)
+    extension = os.path.splitext(auditFileName)[1]
+    server.svms = {f"9a6f4c1e-8b6e-11ef-a6d4-0242ac12{i:04x}": "fsx" if i == 0 else f"fsx{i + 1}" for i in range(numSvms)}
+    server.fileNames = {svm: [f"audit_{svm}_D2024-09-22-T{i // 60:02d}-{i % 60:02d}-00_0000000000{extension}" for i in range(numFiles)] for svm in server.svms.values()}
+    server.latency = latency
+    server.apiCalls = apiCalls
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+################################################################################
+# These classes are fakes of the AWS clients ingest_audit_log.py uses. They
+# count the calls made to them, and the CloudWatch Logs one checks that each
+# batch of events is one CloudWatch would accept.
+################################################################################
+class FakeAWSClient:
+    def __init__(self, serviceName, apiCalls):
+        self.serviceName = serviceName
+        self.apiCalls = apiCalls
+
+    def count(self, operation):
+        self.apiCalls.count(f"{self.serviceName} {operation}")
+
+    @staticmethod
+    def clientError(code, operation):
+        return ingest_audit_log.botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class FakeSecretsManagerClient(FakeAWSClient):
+    def __init__(self, apiCalls, fileSystemId):
+        super().__init__("secretsmanager", apiCalls)
+        self.fileSystemId = fileSystemId
+
+    def get_secret_value(self, SecretId):    # pylint: disable=C0103,W0613
+        self.count("GetSecretValue")
+        return {'SecretString': json.dumps({self.fileSystemId: "password"})}
+
+class FakeFSxClient(FakeAWSClient):
+    def __init__(self, apiCalls, fileSystemId):
+        super().__init__("fsx", apiCalls)
+        self.fileSystemId = fileSystemId
+
+    def describe_file_systems(self, **kwargs):    # pylint: disable=W0613
+        self.count("DescribeFileSystems")
+        dnsName = f"management.{self.fileSystemId}.fsx.us-west-2.amazonaws.com"
+        return {'FileSystems': [{'FileSystemId': self.fileSystemId, 'OntapConfiguration': {'Endpoints': {'Management': {'DNSName': dnsName}}}}]}
+
+class FakeS3Client(FakeAWSClient):
+    def __init__(self, apiCalls):
+        super().__init__("s3", apiCalls)
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):    # pylint: disable=C0103
+        self.count("GetObject")
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise self.clientError("NoSuchKey", "GetObject")
+            (body, etag) = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):    # pylint: disable=C0103
+        self.count("PutObject")
+        with self.lock:
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == '*' and current != None) or (IfMatch != None and (current == None or current[1] != IfMatch)):
+                raise self.clientError("PreconditionFailed", "PutObject")
+            etag = f'"{random.getrandbits(64):016x}"'
+            self.objects[(Bucket, Key)] = (Body, etag)
+        return {'ETag': etag}
+
+class FakeCloudWatchLogsClient(FakeAWSClient):
+    class exceptions:    # pylint: disable=C0103
+        class ResourceAlreadyExistsException(ingest_audit_log.botocore.exceptions.ClientError):
+            pass
+        class ResourceNotFoundException(ingest_audit_log.botocore.exceptions.ClientError):
+            pass
+        class InvalidParameterException(ingest_audit_log.botocore.exceptions.ClientError):
+            pass
+
+    def __init__(self, apiCalls):
+        super().__init__("logs", apiCalls)
+        self.logStreams = set()
+        self.eventsReceived = 0
+        self.summariesReceived = 0
+        self.bytesReceived = 0
+        self.lock = threading.Lock()
+
+    def create_log_stream(self, logGroupName, logStreamName):
+        self.count("CreateLogStream")
+        with self.lock:
+            if (logGroupName, logStreamName) in self.logStreams:
+                raise self.exceptions.ResourceAlreadyExistsException({'Error': {'Code': 'ResourceAlreadyExistsException'}}, "CreateLogStream")
+            self.logStreams.add((logGroupName, logStreamName))
+        return {}
+
+    def put_log_events(self, logGroupName, logStreamName, logEvents):
+        self.count("PutLogEvents")
+        with self.lock:
+            if (logGroupName, logStreamName) not in self.logStreams:
+                raise self.exceptions.ResourceNotFoundException({'Error': {'Code': 'ResourceNotFoundException'}}, "PutLogEvents")
+        batchBytes = sum(len(event['message'].encode('utf-8')) + 26 for event in logEvents)
+        timestamps = [event['timestamp'] for event in logEvents]
+        if (len(logEvents) == 0 or len(logEvents) > 10000 or batchBytes > 1024*1024 or
+            timestamps != sorted(timestamps) or timestamps[-1] - timestamps[0] > 24*60*60*1000):
+            raise self.exceptions.InvalidParameterException({'Error': {'Code': 'InvalidParameterException'}}, "PutLogEvents")
+        with self.lock:
+            if logStreamName.endswith('/aggregates'):
+                self.summariesReceived += len(logEvents)
+            else:
+                self.eventsReceived += len(logEvents)
+            self.bytesReceived += batchBytes
+        return {}
+
+################################################################################
+# This function returns the peak resident set size of this process, in bytes.
+################################################################################
+def getPeakRSS():
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRSS if sys.platform == "darwin" else maxRSS * 1024
+
+################################################################################
+# This function runs the lambda_handler() function against a fake ONTAP
+# server serving 'numFiles' copies of the audit file for each of 'numSvms'
+# SVMs, and fakes of the AWS services, and reports how fast it ingested the
+# events.
+################################################################################
+def benchmarkLambdaHandler(auditFileName, fileSize, numEvents, numFiles, numSvms, latency):
+    apiCalls = APICallCounter()
+    server = startFakeOntapServer(auditFileName, numFiles, numSvms, latency, apiCalls)
+    serverUrl = f"http://127.0.0.1:{server.server_address[1]}"
+    fileSystemId = "fs-0123456789abcdef0"
+    s3Client = FakeS3Client(apiCalls)
+    cwLogsClient = FakeCloudWatchLogsClient(apiCalls)
+    clients = {
+        'secretsmanager': FakeSecretsManagerClient(apiCalls, fileSystemId),
+        'fsx': FakeFSxClient(apiCalls, fileSystemId),
+        's3': s3Client,
+        'logs': cwLogsClient
+    }
+    def fakeClient(service_name, region_name=None, **kwargs):    # pylint: disable=W0613
+        return clients[service_name]
+
+    class FakeSession:
+        def client(self, service_name, region_name=None, **kwargs):
+            return fakeClient(service_name, region_name, **kwargs)
+    #
+    # Send the requests for the FSxN to the fake ONTAP server instead.
+    class LocalPoolManager(ingest_audit_log.urllib3.PoolManager):
+        def request(self, method, url, *args, **kwargs):    # pylint: disable=W0221
+            return super().request(method, re.sub(r'^https://[^/]+', serverUrl, url), *args, **kwargs)
+
+    ingest_audit_log.boto3.client = fakeClient
+    ingest_audit_log.boto3.session.Session = FakeSession
+    ingest_audit_log.urllib3.PoolManager = LocalPoolManager
+    for (name, value) in [('logGroupName', '/fsx/audit_logs'), ('fsxRegion', 'us-west-2'),
+                          ('secretRegion', 'us-west-2'), ('secretArn', 'arn:aws:secretsmanager:us-west-2:123456789012:secret:benchmark'),
+                          ('s3BucketRegion', 'us-west-2'), ('s3BucketName', 'benchmark'), ('statsName', 'lastFileRead')]:
+        os.environ[name] = value
+
+    rssBefore = getPeakRSS()
+    startTime = time.perf_counter()
+    ingest_audit_log.lambda_handler(None, None)
+    elapsed = time.perf_counter() - startTime
+    server.shutdown()
+
+    print("")
+    totalFiles = numFiles * numSvms
+    report(f"lambda_handler ({totalFiles} file{'s' if totalFiles > 1 else ''})", numEvents * totalFiles, elapsed, fileSize * totalFiles)
+    if cwLogsClient.eventsReceived != numEvents * totalFiles:
+        print(f"Warning: CloudWatch received {cwLogsClient.eventsReceived:,} events instead of {numEvents * totalFiles:,}.")
+    if cwLogsClient.summariesReceived > 0:
+        print(f"{'':<40} {cwLogsClient.summariesReceived:,} aggregate summary events sent to CloudWatch")
+    print(f"{'':<40} {cwLogsClient.bytesReceived/elapsed/1024/1024:.1f} MiB/s sent to CloudWatch")
+    print(f"{'':<40} peak RSS {getPeakRSS()/1024/1024:.1f} MiB ({rssBefore/1024/1024:.1f} MiB before)")
+    print("API calls:")
+    for (name, count) in sorted(apiCalls.counts.items()):
+        print(f"  {name:<60} {count:8,}")
+    print("")
+
+################################################################################
+# Main logic
+################################################################################
+parser = argparse.ArgumentParser(description="Measure how fast the ingest_audit_log.py program can process NAS audit events.")
+parser.add_argument("-e", "--events", type=int, default=1000000, help="The number of events to generate. Default is 1,000,000.")
+parser.add_argument("-z", "--size", type=float, help="The size of the audit file to generate, in MiB, instead of a number of events.")
+parser.add_argument("-m", "--mix", help="The mix of events to generate, as a comma separated list of name=weight. Default is " + ",".join(f"{name}={weight}" for (name, weight) in eventMix) + ".")
+parser.add_argument("-n", "--files", type=int, default=1, help="The number of audit files the fake ONTAP server serves, all copies of the generated one, for the lambda_handler benchmark. Default is 1.")
+parser.add_argument("-S", "--svms", type=int, default=1, help="The number of SVMs with auditing configured the fake ONTAP server has, each with its own copies of the audit files, for the lambda_handler benchmark. Default is 1.")
+parser.add_argument("-L", "--latency", type=float, default=0, help="The latency, in milliseconds, to add to each request to the fake ONTAP server. Default is 0.")
+parser.add_argument("-x", "--evtx", action="store_true", help="Also create an EVTX version of the audit file, compare parsing it to parsing the XML version, and have the fake ONTAP server serve it instead.")
+parser.add_argument("-l", "--lambdaOnly", action="store_true", help="Only run the lambda_handler benchmark.")
+parser.add_argument("-f", "--file", help="The name of the audit file to generate. Default is a temporary file that is removed afterwards.")
+parser.add_argument("-s", "--seed", type=int, default=1, help="The seed for the random number generator. Default is 1.")
+parser.add_argument("-k", "--keep", action="store_true", help="Keep the generated audit file.")
+parser.add_argument("-o", "--outputFields", help="A comma separated list of the fields to include when comparing the output formats. Default is all of them.")
+args = parser.parse_args()
+
+if args.file != None:
+    fileName = args.file
+else:
+    (fd, fileName) = tempfile.mkstemp(prefix="audit_fsx_D", suffix=".xml")
+    os.close(fd)
+
+evtxFileName = None
+try:
+    startTime = time.perf_counter()
+    mix = parseEventMix(args.mix) if args.mix != None else eventMix
+    maxBytes = int(args.size * 1024 * 1024) if args.size != None else None
+    (fileSize, numEvents) = generateAuditFile(fileName, args.events, args.seed, mix, maxBytes)
+    print(f"Generated {numEvents:,} events ({fileSize/1024/1024:.1f} MiB) in {time.perf_counter() - startTime:.2f} s.")
+    if args.evtx:
+        evtxFileName = os.path.splitext(fileName)[0] + ".evtx"
+        startTime = time.perf_counter()
+        evtxFileSize = convertToEvtx(fileName, evtxFileName)
+        print(f"Converted them to EVTX ({evtxFileSize/1024/1024:.1f} MiB, {evtxFileSize/fileSize*100:.0f}% of the XML) in {time.perf_counter() - startTime:.2f} s.")
+    #
+    # Run the whole program first, so its peak memory use isn't hidden by the other benchmarks.
+    if args.evtx:
+        benchmarkLambdaHandler(evtxFileName, evtxFileSize, numEvents, args.files, args.svms, args.latency / 1000)
+    else:
+        benchmarkLambdaHandler(fileName, fileSize, numEvents, args.files, args.svms, args.latency / 1000)
+    if args.lambdaOnly:
+        sys.exit(0)
+    #
+    # Parse only. Keep a sample of the parsed events for the formatting benchmarks.
+    sample = []
+    sampleSize = min(numEvents, 100000)
+    numEvents = 0
+    startTime = time.perf_counter()
+    for (event, byteOffset) in ingest_audit_log.parseAuditEvents(readChunks(fileName)):
+        if numEvents < sampleSize:
+            sample.append(event)
+        numEvents += 1
+    report("Parse", numEvents, time.perf_counter() - startTime, fileSize)
+    #
+    # Parse the EVTX version, and make sure it produces the same events.
+    if args.evtx:
+        numEvents = 0
+        mismatches = 0
+        startTime = time.perf_counter()
+        for (event, byteOffset) in evtx_reader.parseEvtxEvents(readChunks(evtxFileName)):
+            if numEvents < sampleSize and event != sample[numEvents]:
+                mismatches += 1
+            numEvents += 1
+        report("Parse (EVTX)", numEvents, time.perf_counter() - startTime, evtxFileSize)
+        if mismatches > 0:
+            print(f"Warning: {mismatches} EVTX events were different than the XML ones.")
+    #
+    # Format only, the old way and the new way.
+    for (name, formatter) in [("Format (legacy createCWEvent)", legacyCreateCWEvent), ("Format (createCWEvent)", ingest_audit_log.createCWEvent)]:
+        startTime = time.perf_counter()
+        for event in sample:
+            formatter(event)
+        report(name, len(sample), time.perf_counter() - startTime)
+    #
+    # Make sure the new way produces the same results as the old way.
+    mismatches = sum(1 for event in sample if legacyCreateCWEvent(event) != ingest_audit_log.createCWEvent(event))
+    if mismatches > 0:
+        print(f"Warning: {mismatches} events were formatted differently than the legacy createCWEvent.")
+    #
+    # Compare the output formats.
+    outputFields = args.outputFields.split(',') if args.outputFields != None else None
+    for outputFormat in ingest_audit_log.outputFormats:
+        if outputFormat == 'none':
+            continue
+        formatter = ingest_audit_log.compileCWEventFormatter(outputFormat, outputFields)
+        startTime = time.perf_counter()
+        messageBytes = 0
+        for event in sample:
+            cwEvent = formatter(event)
+            if cwEvent != None:
+                messageBytes += len(cwEvent['message'].encode('utf-8'))
+        report(f"Format ({outputFormat})", len(sample), time.perf_counter() - startTime)
+        print(f"{'':<40} average message size {messageBytes/len(sample):.0f} bytes")
+    #
+    # Parse and format.
+    numEvents = 0
+    startTime = time.perf_counter()
+    for (event, byteOffset) in ingest_audit_log.parseAuditEvents(readChunks(fileName)):
+        ingest_audit_log.createCWEvent(event)
+        numEvents += 1
+    report("Parse and format", numEvents, time.perf_counter() - startTime, fileSize)
+    #
+    # Decode the multipart responses, the old way, if requests_toolbelt is installed, and the new way.
+    responses = createMultipartResponses(fileName)
+    decoders = [("Decode (decodeMultipart)", decode)]
+    try:
+        import requests_toolbelt     # pylint: disable=C0415,W0611
+        decoders.insert(0, ("Decode (requests_toolbelt)", legacyDecode))
+    except ImportError:
+        print("Skipping the requests_toolbelt decoder since it isn't installed.")
+    for (name, decoder) in decoders:
+        startTime = time.perf_counter()
+        bytesRead = 0
+        for (contentType, data) in responses:
+            (length, chunks) = decoder(contentType, data)
+            bytesRead += sum(len(chunk) for chunk in chunks)
+        elapsed = time.perf_counter() - startTime
+        if bytesRead != fileSize:
+            print(f"Warning: {name} returned {bytesRead} bytes instead of {fileSize}.")
+        print(f"{name:<40} {elapsed:8.2f} s {len(responses)/elapsed:12,.0f} responses/s {fileSize/elapsed/1024/1024:8.1f} MiB/s")
+finally:
+    if args.file == None and not args.keep:
+        os.remove(fileName)
+        if evtxFileName != None and os.path.exists(evtxFileName):
+            os.remove(evtxFileName)
+    else:
+        print(f"\nThe audit file is {fileName}.")
+        if evtxFileName != None:
+            print(f"The EVTX version of it is {evtxFileName}.")
@@ -0,0 +1,378 @@
+################################################################################
+# This module parses NAS audit log files that ONTAP wrote in the EVTX format
+# into the same events ingest_audit_log.py parses from the XML format. That
+# is, the same dictionaries its elementToDict() and parseAuditEvents()
+# functions create. It is part of the ingest_audit_log.py Lambda function, so
+# it has to be included in the same deployment package.
+################################################################################
+#
+import struct
+import time
+
+################################################################################
+# The layout of an EVTX audit log file. It starts with a file header,
+# followed by fixed size chunks. Each chunk starts with a header, followed by
+# the event records. Each record holds an event in the Binary XML (BinXML)
+# format, which is usually an instance of a template, defined earlier in
+# the chunk, along with the values to substitute into it. The element and
+# attribute names are also only stored once per chunk. All the offsets in a
+# chunk are relative to the start of the chunk, so each chunk can be parsed
+# on its own.
+################################################################################
+evtxFileSignature = b'ElfFile\x00'
+evtxChunkSignature = b'ElfChnk\x00'
+evtxRecordSignature = b'\x2a\x2a\x00\x00'
+evtxChunkSize = 64*1024
+evtxChunkHeaderSize = 512
+evtxEntities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+################################################################################
+# These functions convert the binary values in an EVTX record into the same
+# strings that they would be in the XML version of the audit log.
+################################################################################
+def formatEvtxFileTime(data):
+    fileTime = int.from_bytes(data, 'little')
+    seconds = fileTime // 10000000 - 11644473600  # FILETIMEs are in 100ns intervals since 1601.
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f'.{fileTime % 10000000:07d}00Z'
+
+def formatEvtxSystemTime(data):
+    (year, month, dayOfWeek, day, hour, minute, second, millisecond) = struct.unpack('<8H', data)  # pylint: disable=W0612
+    return f'{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}.{millisecond:03d}Z'
+
+def formatEvtxSid(data):
+    subAuthorities = struct.unpack_from(f'<{data[1]}I', data, 8)
+    return f"S-{data[0]}-{int.from_bytes(data[2:8], 'big')}" + ''.join(f'-{subAuthority}' for subAuthority in subAuthorities)
+
+def formatEvtxGuid(data):
+    (data1, data2, data3) = struct.unpack_from('<IHH', data)
+    return f'{{{data1:08X}-{data2:04X}-{data3:04X}-{bytes(data[8:10]).hex().upper()}-{bytes(data[10:16]).hex().upper()}}}'
+
+evtxValueFormatters = {
+    0x01: lambda data: data.decode('utf-16-le').rstrip('\x00'),
+    0x02: lambda data: data.decode('latin-1').rstrip('\x00'),
+    0x03: lambda data: str(int.from_bytes(data, 'little', signed=True)),
+    0x04: lambda data: str(int.from_bytes(data, 'little')),
+    0x05: lambda data: str(int.from_bytes(data, 'little', signed=True)),
+    0x06: lambda data: str(int.from_bytes(data, 'little')),
+    0x07: lambda data: str(int.from_bytes(data, 'little', signed=True)),
+    0x08: lambda data: str(int.from_bytes(data, 'little')),
+    0x09: lambda data: str(int.from_bytes(data, 'little', signed=True)),
+    0x0a: lambda data: str(int.from_bytes(data, 'little')),
+    0x0b: lambda data: repr(struct.unpack('<f', data)[0]),
+    0x0c: lambda data: repr(struct.unpack('<d', data)[0]),
+    0x0d: lambda data: 'true' if int.from_bytes(data, 'little') != 0 else 'false',
+    0x0e: lambda data: data.hex().upper(),
+    0x0f: formatEvtxGuid,
+    0x10: lambda data: f"0x{int.from_bytes(data, 'little'):x}",
+    0x11: formatEvtxFileTime,
+    0x12: formatEvtxSystemTime,
+    0x13: formatEvtxSid,
+    0x14: lambda data: f"0x{int.from_bytes(data, 'little'):08x}",
+    0x15: lambda data: f"0x{int.from_bytes(data, 'little'):016x}"
+}
+#
+# The size of each item in an array of a fixed size type.
+evtxValueSizes = {0x03: 1, 0x04: 1, 0x05: 2, 0x06: 2, 0x07: 4, 0x08: 4, 0x09: 8, 0x0a: 8, 0x0b: 4, 0x0c: 8, 0x0d: 4,
+                  0x0f: 16, 0x10: 8, 0x11: 8, 0x12: 16, 0x14: 4, 0x15: 8}
+
+################################################################################
+# This class parses the event records in a single EVTX chunk. The templates
+# are compiled the first time they are used into a tree of elements, where
+# each element is a (name, attributes, content) tuple. The attributes are a
+# list of (name, parts) tuples, and the content, and parts, are lists of
+# strings, child elements, and the index of the value to substitute. Each
+# record then only has to decode its values and fill them into the tree.
+################################################################################
+class EvtxChunk:
+    def __init__(self, data):
+        self.data = data
+        self.names = {}
+        self.templates = {}
+
+    ############################################################################
+    # This method returns the name stored at 'offset', and the offset just
+    # past it.
+    ############################################################################
+    def readName(self, offset):
+        (length,) = struct.unpack_from('<H', self.data, offset + 6)
+        end = offset + 8 + 2*length + 2
+        name = self.names.get(offset)
+        if name == None:
+            name = self.data[offset + 8:end - 2].decode('utf-16-le')
+            self.names[offset] = name
+        return (name, end)
+
+    ############################################################################
+    # This method reads a name reference at 'offset'. If the name is stored
+    # right after the reference, which it is the first time it is used, it is
+    # skipped. It returns the name and the offset past it.
+    ############################################################################
+    def readNameReference(self, offset):
+        (nameOffset,) = struct.unpack_from('<I', self.data, offset)
+        offset += 4
+        (name, end) = self.readName(nameOffset)
+        return (name, end if nameOffset == offset else offset)
+
+    ############################################################################
+    # This method compiles the element that starts at 'offset', and returns
+    # it and the offset just past it.
+    ############################################################################
+    def compileElement(self, offset):
+        data = self.data
+        token = data[offset]
+        (name, offset) = self.readNameReference(offset + 7)
+        if token & 0x40:
+            offset += 4     # Skip the size of the attribute list.
+        attributes = []
+        while data[offset] & 0xbf == 0x06:
+            (attributeName, offset) = self.readNameReference(offset + 1)
+            parts = []
+            offset = self.compileContent(offset, parts, inAttribute=True)
+            if attributeName != 'xmlns' and not attributeName.startswith('xmlns:'):
+                attributes.append((attributeName, parts))
+
+        content = []
+        if data[offset] == 0x03:     # Close empty element.
+            return ((name, attributes, content), offset + 1)
+        if data[offset] != 0x02:     # Close start element.
+            raise Exception(f'Unexpected BinXML token 0x{data[offset]:02x} at chunk offset {offset}.')
+        offset = self.compileContent(offset + 1, content)
+        if data[offset] != 0x04:     # End element.
+            raise Exception(f'Unexpected BinXML token 0x{data[offset]:02x} at chunk offset {offset}.')
+        return ((name, attributes, content), offset + 1)
+
+    ############################################################################
+    # This method compiles the content of an element, or the value of an
+    # attribute, that starts at 'offset' into 'content', and returns the
+    # offset of the token that ended it.
+    ############################################################################
+    def compileContent(self, offset, content, inAttribute=False):
+        data = self.data
+        while True:
+            token = data[offset] & 0xbf
+            if token == 0x05:                       # Value.
+                if data[offset + 1] != 0x01:
+                    raise Exception(f'Unsupported BinXML value type 0x{data[offset + 1]:02x} at chunk offset {offset}.')
+                (length,) = struct.unpack_from('<H', data, offset + 2)
+                content.append(data[offset + 4:offset + 4 + 2*length].decode('utf-16-le'))
+                offset += 4 + 2*length
+            elif token == 0x0d or token == 0x0e:    # Normal, or optional, substitution.
+                (index,) = struct.unpack_from('<H', data, offset + 1)
+                content.append(index)
+                offset += 4
+            elif token == 0x08:                     # Character reference.
+                (character,) = struct.unpack_from('<H', data, offset + 1)
+                content.append(chr(character))
+                offset += 3
+            elif token == 0x09:                     # Entity reference.
+                (entity, offset) = self.readNameReference(offset + 1)
+                content.append(evtxEntities.get(entity, f'&{entity};'))
+            elif inAttribute:
+                return offset
+            elif token == 0x01:                     # Child element.
+                (element, offset) = self.compileElement(offset)
+                content.append(element)
+            elif token == 0x07:                     # CDATA section.
+                (length,) = struct.unpack_from('<H', data, offset + 1)
+                content.append(data[offset + 3:offset + 3 + 2*length].decode('utf-16-le'))
+                offset += 3 + 2*length
+            elif token == 0x0a:                     # Processing instruction target.
+                offset = self.readNameReference(offset + 1)[1]
+            elif token == 0x0b:                     # Processing instruction data.
+                (length,) = struct.unpack_from('<H', data, offset + 1)
+                offset += 3 + 2*length
+            else:
+                return offset
+
+    ############################################################################
+    # This method parses the BinXML fragment at 'offset' and returns its
+    # root element, as a (name, dictionary) tuple, and the offset just past
+    # the fragment. The dictionary has the same structure elementToDict()
+    # creates for the XML version of the element.
+    ############################################################################
+    def parseFragment(self, offset):
+        data = self.data
+        if data[offset] == 0x0f:        # Fragment header.
+            offset += 4
+        if data[offset] == 0x0c:        # Template instance.
+            (templateOffset,) = struct.unpack_from('<I', data, offset + 6)
+            offset += 10
+            template = self.templates.get(templateOffset)
+            if template == None:
+                template = self.compileElement(templateOffset + 24 + (4 if data[templateOffset + 24] == 0x0f else 0))[0]
+                self.templates[templateOffset] = template
+            if templateOffset == offset:
+                #
+                # The template is defined here, the first time it is used, so skip it.
+                (templateSize,) = struct.unpack_from('<I', data, templateOffset + 20)
+                offset += 24 + templateSize
+            (values, offset) = self.readValues(offset)
+        else:
+            (template, offset) = self.compileElement(offset)
+            values = []
+        if offset < len(data) and data[offset] == 0x00:     # End of fragment.
+            offset += 1
+
+        return ((template[0], renderEvtxElement(template, values)), offset)
+
+    ############################################################################
+    # This method reads the values to substitute into a template, that start
+    # at 'offset', and returns them and the offset just past them. Each value
+    # is a string, None if it is empty, or a list of (name, dictionary)
+    # tuples for a value that is itself a BinXML fragment.
+    ############################################################################
+    def readValues(self, offset):
+        data = self.data
+        (count,) = struct.unpack_from('<I', data, offset)
+        descriptors = struct.unpack_from('<' + 'HBx'*count, data, offset + 4)
+        offset += 4 + 4*count
+        values = []
+        for i in range(0, 2*count, 2):
+            (size, valueType) = descriptors[i:i + 2]
+            if size == 0 or valueType == 0x00:
+                values.append(None)
+            elif valueType == 0x21:             # BinXML.
+                values.append([self.parseFragment(offset)[0]])
+            elif valueType & 0x80:              # Array.
+                values.append(formatEvtxArray(valueType & 0x7f, data[offset:offset + size]))
+            else:
+                formatter = evtxValueFormatters.get(valueType)
+                values.append(formatter(data[offset:offset + size]) if formatter != None else data[offset:offset + size].hex())
+            offset += size
+        return (values, offset)
+
+################################################################################
+# This function formats an array value from an EVTX record as a comma
+# separated list of its items.
+################################################################################
+def formatEvtxArray(valueType, data):
+    if valueType == 0x01:
+        items = [item for item in data.decode('utf-16-le').split('\x00') if item != '']
+    else:
+        itemSize = evtxValueSizes.get(valueType)
+        formatter = evtxValueFormatters.get(valueType)
+        if itemSize == None or formatter == None:
+            return data.hex()
+        items = [formatter(data[i:i + itemSize]) for i in range(0, len(data), itemSize)]
+    return ', '.join(items)
+
+################################################################################
+# This function fills the values into a compiled template element, and
+# returns the same dictionary elementToDict() creates for the element.
+# Attributes whose values are all empty substitutions are left out.
+################################################################################
+def renderEvtxElement(element, values):
+    (name, attributes, content) = element     # pylint: disable=W0612
+    result = {}
+    for (attributeName, parts) in attributes:
+        value = None
+        for part in parts:
+            if part.__class__ is int:
+                part = values[part] if part < len(values) else None
+                if part == None:
+                    continue
+                if part.__class__ is list:
+                    part = ''.join(str(item[1]) for item in part)
+            value = part if value == None else value + part
+        if value != None:
+            result['@' + attributeName] = value
+
+    text = ''
+    for item in content:
+        if item.__class__ is int:
+            item = values[item] if item < len(values) else None
+            if item == None:
+                continue
+            if item.__class__ is str:
+                text += item
+                continue
+            children = item
+        elif item.__class__ is str:
+            text += item
+            continue
+        else:
+            children = [(item[0], renderEvtxElement(item, values))]
+
+        for (tag, value) in children:
+            if tag in result:
+                if not isinstance(result[tag], list):
+                    result[tag] = [result[tag]]
+                result[tag].append(value)
+            else:
+                result[tag] = value
+
+    text = text.strip()
+    if len(result) == 0:
+        return text if text != '' else None
+
+    if text != '':
+        result['#text'] = text
+    return result
+
+################################################################################
+# This function is a generator that parses the events in a single EVTX chunk.
+# It yields each event, as a dictionary, along with 'endOffset' for the last
+# event in the chunk and None for all the others, since parsing can only
+# be resumed from the start of a chunk.
+################################################################################
+def parseEvtxChunk(data, endOffset):
+    if data[0:8] != evtxChunkSignature:
+        #
+        # Chunks that haven't been used yet are all zeros.
+        if data.count(0) != len(data):
+            print(f'Warning: Skipping an EVTX chunk, ending at byte {endOffset}, with an invalid signature.')
+        return
+
+    (lastRecordOffset, freeSpaceOffset) = struct.unpack_from('<II', data, 44)
+    chunk = EvtxChunk(data)
+    offset = evtxChunkHeaderSize
+    while offset < min(freeSpaceOffset, len(data)) and data[offset:offset + 4] == evtxRecordSignature:
+        (size,) = struct.unpack_from('<I', data, offset + 4)
+        if size < 28 or offset + size > len(data):
+            print(f'Warning: Skipping the rest of an EVTX chunk, ending at byte {endOffset}, that has a record with an invalid size.')
+            return
+        try:
+            ((name, event), end) = chunk.parseFragment(offset + 24)   # pylint: disable=W0612
+        except Exception as err:
+            print(f'Warning: Skipping an EVTX record, {offset} bytes into the chunk ending at byte {endOffset}: {err}')
+        else:
+            yield (event, endOffset if offset >= lastRecordOffset else None)
+        offset += size
+
+################################################################################
+# This function is a generator that parses the EVTX audit log data, passed in
+# as an iterable of byte chunks, and yields each event, as the same dictionary
+# parseAuditEvents() yields for the XML version of the event, as soon as the
+# EVTX chunk holding it has been read. Since the event records in an EVTX
+# chunk refer to templates and names stored earlier in the chunk, events are
+# only yielded with an offset, to resume from, for the last event in each
+# chunk. That offset can be passed as 'startOffset' along with the data that
+# follows it. Only one EVTX chunk is held in memory at a time.
+################################################################################
+def parseEvtxEvents(chunks, startOffset=0):
+    buffer = bytearray()
+    offset = startOffset            # The offset in the file of the start of the buffer.
+    needHeader = startOffset == 0
+    for data in chunks:
+        buffer += data
+        if needHeader:
+            if len(buffer) < 128:
+                continue
+            if buffer[0:8] != evtxFileSignature:
+                raise Exception('The audit log file is not in the EVTX format.')
+            (headerSize,) = struct.unpack_from('<H', buffer, 40)
+            if len(buffer) < headerSize:
+                continue
+            del buffer[:headerSize]
+            offset += headerSize
+            needHeader = False
+
+        start = 0
+        while len(buffer) - start >= evtxChunkSize:
+            yield from parseEvtxChunk(bytes(buffer[start:start + evtxChunkSize]), offset + start + evtxChunkSize)
+            start += evtxChunkSize
+        del buffer[:start]
+        offset += start
+
+    if len(buffer) > 0:
+        print(f'Warning: Ignoring {len(buffer)} bytes at the end of the EVTX audit log file, since it is not a whole chunk.')
@@ -1,35 +1,64 @@
 #!/bin/python3
 #
 ################################################################################
-# This script is used to ingest all the NAS audit logs from all the FSx for
-# ONTAP File Systems from the specified volume into a specified CloudWatch log
-# group. It will create a log stream for each FSxN audit logfile it finds.
+# This script is used to ingest all the NAS audit logs from all the SVMs, that
+# have auditing configured, on all the FSx for ONTAP File Systems into a
+# specified CloudWatch log group. The SVMs, and the volumes their audit logs
+# are written to, are found automatically. By default it will create a log stream for each FSxN audit logfile it
+# finds, but it can also group the events into a log stream per file system,
+# or SVM, per day or hour.
 # It will attempt to process every FSxN within the region. It leverage AWS
 # secrets manager to get the credentials for the fsxadmin user on each FSxNs.
-# It will store the last read file for each FSxN in the specified S3 bucket so
-# that it will not process the same file twice. It will skip any FSxN file
-# system that it doesn't have credentials for. It will also skip any FSxN file
-# system that doesn't have the specified volume.
+# It will store the last read file for each SVM in the specified S3 bucket so
+# that it will not process the same file twice. It also periodically stores
+# how far into a file it has gotten, so if it runs out of time, it can stop
+# and the next run will continue from where it left off. Each audit file is
+# leased before it is processed, so several copies of this script can run at
+# the same time, each processing different files. It will skip any FSxN file
+# system that it doesn't have credentials for.
 #
 # It assumes:
-#  - That there is only one data vserver per FSxN file system and that it
-#    is named 'fsx'.
 #  - That the administrator username is 'fsxadmin'.
 #  - That the audit log files will be named in the following format:
 #      audit_fsx_D2024-09-24-T13-00-03_0000000000.xml
-#    Where 'fsx' is the vserver name.
+#    Where 'fsx' is the vserver name. The files can be in either the XML
+#    or the EVTX format, in which case they end with ".evtx" instead.
+#
+# The EVTX parser, the aggregates, and the state of each SVM, are in the
+# evtx_reader.py, audit_aggregates.py and audit_state.py modules, which have
+# to be included in the Lambda deployment package along with this script.
 #
 ################################################################################
 #
-from requests_toolbelt.multipart import decoder
 import urllib3
 import datetime
-import xmltodict
+import re
+import xml.etree.ElementTree as ET
+import urllib.parse
 import os
 import json
+import time
+import collections
+import concurrent.futures
+import threading
+import queue
 from urllib3.util import Retry
 import boto3
 import botocore
+from botocore.config import Config
+from evtx_reader import parseEvtxEvents
+from audit_aggregates import aggregateFieldNames, AuditAggregator, AuditFileCounter, formatAggregateSummary
+from audit_state import getAuditFileSvm, LeaseLost, S3StateStore, LocalStateStore, StateManager
+#
+# The pyarrow package is only imported if the audit events are archived.
+pa = None
+pq = None
+#
+# The S3 client for the archive. It is only created if the audit events are archived.
+archiveS3Client = None
+#
+# The state of each FSxN, and SVM. It is created by lambda_handler().
+stateManager = None
 
 ################################################################################
 # You can configure this script by either setting the following variables, or
@@ -42,7 +71,9 @@ import botocore
 #secretRegion = "us-west-2"
 #secretArn = "arn:aws:secretsmanager:us-west-2:759995470648:secret:FSXN_passwords-MJixz9"
 #
-# Where to store last read stats.
+# Where to store last read stats. The stats for each SVM are stored in
+# "<statsName>/<FSxN management DNS name>/<SVM name>.json", and the audited
+# SVMs found on each FSxN in "<statsName>/<FSxN management DNS name>.json".
 #s3BucketRegion = "us-west-2"
 #s3BucketName = "keith-test-mon-ems-events"
 #statsName = "lastFileRead"
@@ -50,198 +81,1367 @@ import botocore
 # The region to process the FSxNs in.
 #fsxRegion = "us-west-2"
 #
-# The name of the volume that holds the audit logs. Assumed to be the same on
-# all FSxNs.
-#volumeName = "audit_logs"
-#
-# The name of the vserver that holds the audit logs. Assumed to be the same on 
-# all FSxNs.
+# The SVMs, also known as vservers, that have auditing configured are found
+# automatically on each FSxN, along with the volume their audit logs are
+# written to. To only ingest the audit logs of some of them, set this to a
+# comma separated list of their names. Optional, the default is all of them.
 #vserverName = "fsx"
 #
+# How often, in seconds, to look for SVMs with auditing configured. In
+# between, the SVMs found, and their audit log volumes, are remembered in the
+# stats for each FSxN. Optional, the default is 3600.
+#auditDiscoveryInterval = 3600
+#
 # The CloudWatch log group to store the audit logs in.
 #logGroupName = "/fsx/audit_logs"
+#
+# The maximum number of concurrent API calls to make to an FSxN when
+# downloading an audit log file. Optional, the default is 4.
+#downloadParallelism = 4
+#
+# The maximum number of SVMs to process concurrently, across all the FSxNs.
+# Optional, the default is 8.
+#fileSystemParallelism = 8
+#
+# The minimum number of seconds between saving checkpoints to the stats
+# file in S3. Optional, the default is 30.
+#checkpointInterval = 30
+#
+# How many seconds before the Lambda function times out to stop processing
+# audit files, so there is time to save a checkpoint. Optional, the default
+# is 60.
+#timeLimitMargin = 60
+#
+# The format of the events sent to CloudWatch. Either "kv" for a comma
+# separated list of name=value pairs, "json" for a JSON object, or "emf" for
+# a JSON object in the CloudWatch Embedded Metric Format. Optional, the
+# default is "kv".
+#outputFormat = "kv"
+#
+# A comma separated list of the fields to include in the events sent to
+# CloudWatch. Optional, the default is to include all of them.
+#outputFields = "Date,Event,fs,svm,Result,UserName,volume,name"
+#
+# The CloudWatch metric namespace to use with the "emf" output format.
+# Optional, the default is "FSxN/AuditLogs".
+#emfNamespace = "FSxN/AuditLogs"
+#
+# To also archive the audit events as Parquet files in S3, set the name of
+# the bucket to store them in. Optional, the default is to not archive them.
+# The pyarrow package is required to archive the audit events.
+#archiveBucketName = "my-audit-archive"
+#
+# The region of the archive bucket. Optional, the default is s3BucketRegion.
+#archiveBucketRegion = "us-west-2"
+#
+# The prefix to put in front of the archived files' object keys. Optional,
+# the default is "audit_logs/".
+#archivePrefix = "audit_logs/"
+#
+# The endpoint URL to use for the archive bucket. Optional, the default is
+# the AWS S3 endpoint for the region. It can be set to a local S3 compatible
+# service for testing.
+#archiveS3EndpointUrl = "http://localhost:9000"
+#
+# The number of events to buffer before writing them to the archive.
+# Optional, the default is 50000.
+#archiveFlushEvents = 50000
+#
+# The compression to use for the Parquet files. Optional, the default is
+# "zstd".
+#archiveCompression = "zstd"
+#
+# How many seconds a lease on an audit file lasts. While an invocation of
+# the Lambda function holds the lease on a file, no other invocation will
+# process it. The lease is renewed each time a checkpoint is saved, so it
+# should be several times checkpointInterval. Optional, the default is 300.
+#leaseDuration = 300
+#
+# Set to "true" if several copies of the Lambda function might run at the
+# same time. The state of each FSxN is then written to the S3 bucket with S3
+# conditional writes, so the copies can't overwrite each other's leases. That
+# requires a version of boto3 that supports the IfMatch and IfNoneMatch
+# parameters of put_object. Optional, the default is "false".
+#concurrentInvocations = "false"
+#
+# By default, the state of each FSxN is stored in the S3 bucket. To test
+# running several copies of this script at the same time on one machine, it
+# can be stored in a local directory instead. Optional.
+#stateDirectory = "/tmp/audit_state"
+#
+# How to divide the events into log streams. Either "file" for a log stream
+# per audit file, named after the file, or "fs-day", "fs-hour", "svm-day" or
+# "svm-hour" for a log stream per file system, or SVM, per day, or hour.
+# Optional, the default is "file".
+#logStreamStrategy = "file"
+#
+# Rules for audit events that shouldn't be sent to CloudWatch, as a JSON list.
+# An event is dropped if it matches all the conditions of any of the rules.
+# The conditions are "events", "results", "users", "sids" and "pathPrefixes",
+# each with a list of values. Each rule can also have a "name", used to report
+# how many events it dropped. Optional, the default is to not drop any events.
+#eventFilters = '[{"name": "attribute reads", "events": ["Get Object Attributes"]}, {"name": "backup", "users": ["svc_backup"], "pathPrefixes": ["/backups/"]}]'
+#
+# A comma separated list of the fields to keep aggregates of: "user", "ip",
+# "path" and "event". For each file system, and each interval, a summary of
+# the number of events, and the values of those fields with the most events,
+# from all the audit files processed by an invocation, is sent to the
+# "<file system ID>/aggregates" log stream. Optional, the default is to not
+# keep aggregates.
+#aggregateFields = "user,ip,path,event"
+#
+# The length of the aggregate intervals, in seconds. Optional, the default is 3600.
+#aggregateInterval = 3600
+#
+# The number of values, with the most events, to include for each aggregated
+# field. Optional, the default is 10.
+#aggregateTopN = 10
+#
+# How to send the aggregate summaries. Either "json" for a JSON object per
+# summary, or "emf" for an event per value in the CloudWatch Embedded Metric
+# Format, so they are also available as CloudWatch metrics. Optional, the
+# default is "json".
+#aggregateOutput = "json"
 
 ################################################################################
-# This function returns the epoch time from the filename. It assumes the
-# filename is in the format of:
-#   audit_fsx_D2024-09-24-T13-00-03_0000000000.xml
+# This function returns the boundary that separates the parts of a
+# multipart response. It is normally specified in the Content-Type header,
+# but if it isn't, the first delimiter line in the data is used.
 ################################################################################
-def getEpoch(filename):
-    dateStr = filename.split('_')[2][1:]
-    year = int(dateStr.split('-')[0])
-    month = int(dateStr.split('-')[1])
-    day = int(dateStr.split('-')[2])
+def getMultipartBoundary(contentType, data):
+    for param in (contentType or '').split(';')[1:]:
+        (name, _, value) = param.strip().partition('=')
+        if name.lower() == 'boundary' and value != '':
+            return value.strip('"').encode('utf-8')
 
-    hour = int(dateStr.split('-')[3][1:])
-    minute = int(dateStr.split('-')[4])
-    second = int(dateStr.split('-')[5])
+    start = data.find(b'--')
+    end = data.find(b'\r\n', start)
+    if start < 0 or end < 0:
+        raise Exception('Could not find the multipart boundary in the response.')
+    return data[start+2:end]
 
-    return datetime.datetime(year, month, day, hour, minute, second).timestamp()
+################################################################################
+# This function is a generator that yields the body of each part of a
+# multipart response, in order. The bodies are returned as memoryview slices
+# of the data so none of it is copied. The headers of each part are skipped.
+# It raises an exception if the data is truncated.
+################################################################################
+def decodeMultipart(data, boundary):
+    view = memoryview(data)
+    delimiter = b'\r\n--' + boundary
+    #
+    # The first delimiter doesn't have to be preceded by a CRLF.
+    position = data.find(b'--' + boundary)
+    if position < 0:
+        raise Exception('Multipart boundary not found in the response.')
+    position += 2 + len(boundary)
+    while data[position:position+2] != b'--':   # The last delimiter is followed by '--'.
+        #
+        # Skip the rest of the delimiter line, and the part's headers, which end with a blank line.
+        lineEnd = data.find(b'\r\n', position)
+        headersEnd = data.find(b'\r\n\r\n', lineEnd) if lineEnd >= 0 else -1
+        if headersEnd < 0:
+            raise Exception('Truncated multipart response.')
+        bodyStart = headersEnd + 4
+        bodyEnd = data.find(delimiter, bodyStart)
+        if bodyEnd < 0:
+            raise Exception('Truncated multipart response.')
+        yield view[bodyStart:bodyEnd]
+        position = bodyEnd + len(delimiter)
 
 ################################################################################
-# This function copies a file from the FSxN file system, using the ONTAP
-# APIs, and then calls the ingestAuditFile function to upload the audit
-# log entires to the CloudWatch log group.
+# This function reads a range of bytes from a file on the FSxN file system,
+# using the ONTAP APIs. It returns a tuple with the number of bytes read, as
+# reported by ONTAP, an iterable of the data chunks, and the time it took.
+# The chunks are slices of the response, so they aren't copied. It raises
+# an exception if the API call fails.
 ################################################################################
-def processFile(ontapAdminServer, headers, volumeUUID, filePath):
+def readFileRange(ontapAdminServer, headers, volumeUUID, filePath, offset, length):
     global http
+
+    endpoint = f'https://{ontapAdminServer}/api/storage/volumes/{volumeUUID}/files/{urllib.parse.quote(filePath, safe="")}?length={length}&byte_offset={offset}'
+    startTime = time.monotonic()
     #
-    # Create the tempoary file to hold the contents from the ONTAP/FSxN file.
-    tmpFileName = "/tmp/testout"
-    f = open(tmpFileName, "wb")
+    # Allow 5 seconds per MiB requested.
+    response = http.request('GET', endpoint, headers=headers, timeout=5.0 * max(1, length / (1024*1024)))
+    if response.status != 200:
+        raise Exception(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+
+    data = response.data
+    parts = decodeMultipart(data, getMultipartBoundary(response.headers.get('Content-Type'), data))
     #
-    # Number of bytes to read for each API call.
-    blockSize=1024*1024
+    # The first part returned from ONTAP contains the amount of data in the response.
+    bytesRead = int(bytes(next(parts, b'0')))
 
-    bytesRead = 0
-    requestSize = 1   # Set to > 0 to start the loop.
-    while requestSize > 0:
-        endpoint = f'https://{ontapAdminServer}/api/storage/volumes/{volumeUUID}/files/{filePath}?length={blockSize}&byte_offset={bytesRead}'
-        response = http.request('GET', endpoint, headers=headers, timeout=5.0)
-        if response.status == 200:
-            bytesRead += blockSize
-            data = response.data
-            #
-            # Get the multipart boundary separator from the first part of the file.
-            boundary = data[4:20].decode('utf-8')
-            #
-            # Get MultipartDecoder to decode the data.
-            contentType = f"multipart/form-data; boundary={boundary}"
-            multipart_data = decoder.MultipartDecoder(data, contentType)
+    return (bytesRead, parts, time.monotonic() - startTime)
+
+################################################################################
+# This function is a generator that reads a file from the FSxN file system,
+# using the ONTAP APIs, and yields its contents as a series of byte chunks,
+# in order, as they are read. If the size of the file is known, up to
+# 'downloadParallelism' ranges of the file are read concurrently. The size of
+# the ranges adapts to how long each API call takes, and to the largest
+# range ONTAP will return in a single call. Reading starts at 'startOffset'
+# bytes into the file. It raises an exception if any of the API calls fail.
+################################################################################
+def readAuditFile(ontapAdminServer, headers, volumeUUID, filePath, fileSize=None, startOffset=0):
+    global config
+    #
+    # The initial, minimum, and maximum number of bytes to read for each API call.
+    blockSize = 1024*1024
+    minBlockSize = 64*1024
+    maxBlockSize = 8*1024*1024
+    #
+    # If the file size isn't known, read it one block at a time until ONTAP
+    # says there isn't any more data.
+    if fileSize == None or config['downloadParallelism'] <= 1:
+        bytesRead = startOffset
+        requestSize = 1   # Set to > 0 to start the loop.
+        while requestSize > 0:
+            (requestSize, chunks, elapsed) = readFileRange(ontapAdminServer, headers, volumeUUID, filePath, bytesRead, blockSize)
+            bytesRead += requestSize
+            for chunk in chunks:
+                yield chunk
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config['downloadParallelism']) as executor:
+        inFlight = collections.deque()  # Holds (offset, length, future) in file order.
+        nextOffset = startOffset
+        try:
+            while nextOffset < fileSize or len(inFlight) > 0:
+                #
+                # Keep the window of outstanding API calls full.
+                while nextOffset < fileSize and len(inFlight) < config['downloadParallelism']:
+                    length = min(blockSize, fileSize - nextOffset)
+                    future = executor.submit(readFileRange, ontapAdminServer, headers, volumeUUID, filePath, nextOffset, length)
+                    inFlight.append((nextOffset, length, future))
+                    nextOffset += length
+                #
+                # Yield the oldest range once it has been read, so the data is returned in order.
+                (offset, length, future) = inFlight.popleft()
+                (bytesRead, chunks, elapsed) = future.result()
+                for chunk in chunks:
+                    yield chunk
+                #
+                # If ONTAP returned less than was asked for, it has a limit on how much it will return,
+                # so read the rest of the range now and don't ask for more than that from now on.
+                if bytesRead < length:
+                    if bytesRead == 0:
+                        raise Exception(f'Unexpected end of file {filePath} at byte {offset} of {fileSize}.')
+                    blockSize = max(minBlockSize, bytesRead)
+                    offset += bytesRead
+                    length -= bytesRead
+                    while length > 0:
+                        (bytesRead, chunks, elapsed) = readFileRange(ontapAdminServer, headers, volumeUUID, filePath, offset, length)
+                        if bytesRead == 0:
+                            raise Exception(f'Unexpected end of file {filePath} at byte {offset} of {fileSize}.')
+                        for chunk in chunks:
+                            yield chunk
+                        offset += bytesRead
+                        length -= bytesRead
+                #
+                # Otherwise, ask for more data per API call if they are fast, and less if they are slow.
+                elif elapsed < 1.0 and length == blockSize:
+                    blockSize = min(maxBlockSize, blockSize * 2)
+                elif elapsed > 3.0:
+                    blockSize = max(minBlockSize, blockSize // 2)
+        finally:
+            for (offset, length, future) in inFlight:
+                future.cancel()
+
+################################################################################
+# This function reads a file from the FSxN file system, using the ONTAP
+# APIs, and passes its contents, as they are read, to the ingestAuditFile
+# function to upload the audit log entries to the CloudWatch log group.
+# The file is never stored locally, nor held in memory in its entirety. If
+# a checkpoint is passed in, processing resumes from it. It returns True if
+# the whole file was processed, and False if it ran out of time.
+################################################################################
+def processFile(ontapAdminServer, headers, volumeUUID, filePath, fileSize=None, checkpoint=None, onCheckpoint=None):
+    startOffset = checkpoint['byteOffset'] if checkpoint != None else 0
+    chunks = readAuditFile(ontapAdminServer, headers, volumeUUID, filePath, fileSize, startOffset)
+    return ingestAuditFile(chunks, filePath.rsplit('/', 1)[-1], checkpoint, onCheckpoint)
+
+################################################################################
+# This function converts an XML element into the same dictionary structure
+# that xmltodict.parse() creates for it. That is:
+#   - Attributes are stored with an '@' prepended to their name.
+#   - Child elements are stored under their name. If there is more than one
+#     child with the same name, they are stored as a list.
+#   - If the element has attributes, or children, its text is stored
+#     under '#text', otherwise the element is simply its text, or None
+#     if it doesn't have any.
+# Any namespace is removed from the element names.
+################################################################################
+def elementToDict(element):
+    result = {}
+    for name, value in element.attrib.items():
+        result['@' + name] = value
+
+    for child in element:
+        tag = child.tag.rsplit('}', 1)[-1]
+        value = elementToDict(child)
+        if tag in result:
+            if not isinstance(result[tag], list):
+                result[tag] = [result[tag]]
+            result[tag].append(value)
+        else:
+            result[tag] = value
+
+    text = element.text.strip() if element.text != None else ''
+    if len(result) == 0:
+        return text if text != '' else None
+
+    if text != '':
+        result['#text'] = text
+    return result
+
+################################################################################
+# This matches the end tag of an audit event. Since '<' can't appear, as is,
+# in the text or attributes of an XML element, every match in the audit log
+# data is the end of an event.
+################################################################################
+eventEndTag = re.compile(rb'</(?:[\w.-]+:)?Event\s*>')
+eventEndTagMaxLen = 64      # The longest end tag that is expected, including any namespace prefix.
+
+################################################################################
+# This function is a generator that parses the XML audit log data, passed in
+# as an iterable of byte chunks, and yields each <Event>, as a dictionary, as
+# soon as it has been read, along with the offset in the file just past the
+# end of the event. Parsing can be resumed from that offset by passing it as
+# 'startOffset' along with the data that follows it. Once an event has been
+# yielded, it is removed from the parse tree so the amount of memory used
+# doesn't depend on the size of the audit log file.
+################################################################################
+def parseAuditEvents(chunks, startOffset=0):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    if startOffset > 0:
+        #
+        # The data starts part way into the file, so give the parser a root element.
+        parser.feed(b'<Events>')
+    root = None
+    depth = 0
+    offset = startOffset         # The offset in the file of the next chunk.
+    eventEnds = collections.deque()  # The offset in the file just past each event end tag found.
+    tail = b''                   # The end of the previous chunk, in case an end tag spans two chunks.
+    for chunk in chunks:
+        #
+        # Find the end tags that start in the previous chunk and end in this one,
+        # then the ones that are entirely within this chunk.
+        if len(tail) > 0:
+            probe = tail + bytes(chunk[:eventEndTagMaxLen])
+            for match in eventEndTag.finditer(probe):
+                if match.start() < len(tail) and match.end() > len(tail):
+                    eventEnds.append(offset - len(tail) + match.end())
+        for match in eventEndTag.finditer(chunk):
+            eventEnds.append(offset + match.end())
+        offset += len(chunk)
+        tail = (tail + bytes(chunk[-eventEndTagMaxLen:]))[-eventEndTagMaxLen:]
+
+        parser.feed(chunk)
+        for (action, element) in parser.read_events():
+            if action == 'start':
+                if root == None:
+                    root = element
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1 and element.tag.rsplit('}', 1)[-1] == 'Event':
+                    yield (elementToDict(element), eventEnds.popleft() if len(eventEnds) > 0 else None)
+                    root.remove(element)
+    parser.close()
+
+################################################################################
+# The audit event data fields that aren't included in the CloudWatch event:
+#   ObjectServer: Always just seems to be: 'Security'.
+#   HandleID: Is some odd string of numbers.
+#   InformationRequested: A verbose string of information.
+#   AccessList: A string of numbers that I'm not sure what they represent.
+#   AccessMask: A number that represent the access mask.
+#   DesiredAccess: A verbose list of strings represent the desired access.
+#   Attributes: A verbose list of strings representing the attributes.
+#   DirHandleID: A string of numbers that I'm not sure what they represent.
+#   SearchFilter: Always seems to be null.
+#   SearchPattern: Always seems to be set to "Not Present".
+#   SubjectPort: Just the TCP port that the user came in on.
+#   OldDirHandle and NewDirHandle: Are the UUIDs of the directory. The OldPath and NewPath are human readable.
+################################################################################
+ignoredDataFields = {"ObjectServer", "HandleID", "InformationRequested", "AccessList", "AccessMask", "DesiredAccess", "Attributes", "DirHandleID", "SearchFilter", "SearchPattern", "SubjectPort", "OldDirHandle", "NewDirHandle"}
+
+################################################################################
+# This function returns the fields for the ObjectName and FileName data
+# fields, which are in the format of "(volume);path".
+################################################################################
+def getObjectNameFields(data):
+    (volume, _, name) = data['#text'].partition(';')
+    return [('volume', volume.replace('(', '').replace(')', '')), ('name', name)]
+
+################################################################################
+# The fields, from the System section of an audit event, that are included
+# in the CloudWatch event, in order, and the function that gets each of them.
+# Spaces are replaced with dashes in the event name and result.
+################################################################################
+systemFieldMap = [
+    ('Date', lambda system: system['TimeCreated']['@SystemTime']),
+    ('Event', lambda system: system['EventName'].replace(' ', '-')),
+    ('fs', lambda system: system['Computer'].partition('/')[0]),
+    ('svm', lambda system: system['Computer'].partition('/')[2]),
+    ('Result', lambda system: system['Result'].replace(' ', '-'))
+]
+
+################################################################################
+# The audit event data fields that require special handling, the fields
+# they become in the CloudWatch event, and the function that gets them, as
+# a list of (name, value) tuples. All other data fields keep their name, and
+# their value is their text.
+################################################################################
+dataFieldMap = {
+    'SubjectIP': (['IP'], lambda data: [('IP', data['#text'])]),
+    'SubjectUnix': (['UnixID', 'GroupID'], lambda data: [('UnixID', data['@Uid']), ('GroupID', data['@Gid'])]),
+    'SubjectUserSid': (['UserSid'], lambda data: [('UserSid', data['#text'])]),
+    'SubjectUserName': (['UserName'], lambda data: [('UserName', data['#text'])]),
+    'SubjectDomainName': (['Domain'], lambda data: [('Domain', data['#text'])]),
+    'ObjectName': (['volume', 'name'], getObjectNameFields),
+    'FileName': (['volume', 'name'], getObjectNameFields),
+    'InformationSet': (['InformationSet'], lambda data: [('InformationSet', data.get('#text') if data.get('#text') != None else 'Null')])
+}
+
+################################################################################
+# This function formats the ObjectName and FileName data fields, which are in
+# the format of "(volume);path", for the kv output format.
+################################################################################
+def formatKVObjectName(data):
+    (volume, _, name) = data['#text'].partition(';')
+    return f"volume={volume.replace('(', '').replace(')', '')}, name={name}"
+
+################################################################################
+# The same data fields as the dataFieldMap, and the function that formats
+# each of them as "name=value" pairs for the kv output format. Since kv is
+# the default format, the pairs are formatted directly instead of going
+# through the (name, value) tuples.
+################################################################################
+kvDataFieldFormatters = {
+    'SubjectIP': lambda data: f"IP={data['#text']}",
+    'SubjectUnix': lambda data: f"UnixID={data['@Uid']}, GroupID={data['@Gid']}",
+    'SubjectUserSid': lambda data: f"UserSid={data['#text']}",
+    'SubjectUserName': lambda data: f"UserName={data['#text']}",
+    'SubjectDomainName': lambda data: f"Domain={data['#text']}",
+    'ObjectName': formatKVObjectName,
+    'FileName': formatKVObjectName,
+    'InformationSet': lambda data: f"InformationSet={data['#text']}" if data.get('#text') != None else "InformationSet=Null"
+}
+
+################################################################################
+# The output formats that are supported:
+#   kv: A comma separated list of "name=value" pairs.
+#   json: A compact JSON object.
+#   emf: A JSON object in the CloudWatch Embedded Metric Format, so a count
+#        of the audit events, by file system, SVM and event, is also
+#        available as a CloudWatch metric.
+#   none: The events aren't sent. This is meant to be used with the
+#        aggregates, to only send summaries of the events.
+################################################################################
+outputFormats = ['kv', 'json', 'emf', 'none']
+emfDimensions = ['fs', 'svm', 'Event']
+
+################################################################################
+# This function returns a function that returns the fields of an XML audit
+# log event, as a list of (name, value) tuples. Only the fields listed in
+# 'outputFields' are included, or all of them if it is None. All the
+# decisions about which fields to include are made here, once, so the
+# function that is returned only does the work needed for each event.
+################################################################################
+def compileFieldExtractor(outputFields=None):
+    wanted = set(outputFields) if outputFields != None else None
+    #
+    # Get the System fields to include.
+    systemGetters = tuple((name, getter) for (name, getter) in systemFieldMap if wanted == None or name in wanted)
+    #
+    # Get the data fields to include. The special ones are skipped if none of
+    # the fields they become are wanted, or trimmed if only some of them are.
+    skippedData = set(ignoredDataFields)
+    dataGetters = {}
+    for (dataName, (names, getter)) in dataFieldMap.items():
+        if wanted == None or all(name in wanted for name in names):
+            dataGetters[dataName] = getter
+        elif any(name in wanted for name in names):
+            dataGetters[dataName] = lambda data, getter=getter: [field for field in getter(data) if field[0] in wanted]
+        else:
+            skippedData.add(dataName)
+
+    def getFields(event):
+        system = event['System']
+        fields = [(name, getter(system)) for (name, getter) in systemGetters]
+        eventData = event.get('EventData')
+        dataList = eventData.get('Data', []) if eventData != None else []
+        if isinstance(dataList, dict):   # A single data field isn't in a list.
+            dataList = [dataList]
+        for data in dataList:
+            name = data['@Name']
+            if name in skippedData:
+                continue
+            getter = dataGetters.get(name)
+            if getter != None:
+                fields.extend(getter(data))
+            elif wanted == None or name in wanted:
+                fields.append((name, data.get('#text', '')))
+        return fields
+
+    return getFields
+
+################################################################################
+# This function returns a function that converts an XML audit log event into
+# a CloudWatch event in the kv output format, or None if the event doesn't
+# have any of the fields to include. Only the fields listed in
+# 'outputFields' are included, or all of them if it is None.
+################################################################################
+def compileKVEventFormatter(outputFields=None):
+    if outputFields == None:
+        def formatAllFields(event):
+            system = event['System']
+            systemTime = system['TimeCreated']['@SystemTime']
+            (fs, _, svm) = system['Computer'].partition('/')
             #
-            # The first part returned from ONTAP contains the amount of data in the response. When it is 0, we have read the entire file.
-            firstPart = True
-            for part in multipart_data.parts:
-                if(firstPart):
-                    requestSize = int(part.text)
-                    firstPart = False
+            # Spaces are replaced with dashes in the event name and result.
+            fields = [
+                f"Date={systemTime}",
+                f"Event={system['EventName'].replace(' ', '-')}",
+                f"fs={fs}",
+                f"svm={svm}",
+                f"Result={system['Result'].replace(' ', '-')}"
+            ]
+            eventData = event.get('EventData')
+            dataList = eventData.get('Data', []) if eventData != None else []
+            if isinstance(dataList, dict):   # A single data field isn't in a list.
+                dataList = [dataList]
+            for data in dataList:
+                name = data['@Name']
+                if name in ignoredDataFields:
+                    continue
+                formatter = kvDataFieldFormatters.get(name)
+                if formatter != None:
+                    fields.append(formatter(data))
                 else:
-                    f.write(part.content)
+                    fields.append(f"{name}={data.get('#text', '')}")
+
+            return {'timestamp': getEventTimestamp(systemTime), 'message': ", ".join(fields)}
+
+        return formatAllFields
+
+    wanted = set(outputFields)
+    systemFormatters = tuple((f"{name}=", getter) for (name, getter) in systemFieldMap if name in wanted)
+    #
+    # The special data fields are skipped if none of the fields they become
+    # are wanted, or trimmed if only some of them are.
+    skippedData = set(ignoredDataFields)
+    dataFormatters = {}
+    for (dataName, (names, getter)) in dataFieldMap.items():
+        if all(name in wanted for name in names):
+            dataFormatters[dataName] = kvDataFieldFormatters[dataName]
+        elif any(name in wanted for name in names):
+            dataFormatters[dataName] = lambda data, getter=getter: ", ".join([f"{name}={value}" for (name, value) in getter(data) if name in wanted])
         else:
-            print(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
-            break
-
-    f.close()
-    #
-    # Upload the audit events to CloudWatch.
-    ingestAuditFile(tmpFileName, filePath)
-
-################################################################################
-# This function returns a CloudWatch event from the XML audit log event.
-################################################################################
-def createCWEvent(event):
-    # ObjectServer: Always just seems to be: 'Security'.
-    # HandleID: Is some odd string of numbers.
-    # InformationRequested: A verbose string of information.
-    # AccessList: A string of numbers that I'm not sure what they represent.
-    # AccessMask: A number that represent the access mask.
-    # DesiredAccess: A verbose list of strings represent the desired access.
-    # Attributes: A verbose list of strings representing the attributes.
-    # DirHandleID: A string of numbers that I'm not sure what they represent.
-    # SearchFilter: Always seems to be null.
-    # SearchPattern: Always seems to be set to "Not Present".
-    # SubjectPort: Just the TCP port that the user came in on.
-    # OldDirHandle and NewDirHandle: Are the UUIDs of the directory. The OldPath and NewPath are human readable.
-    ignoredDataFields = ["ObjectServer", "HandleID", "InformationRequested", "AccessList", "AccessMask", "DesiredAccess", "Attributes", "DirHandleID", "SearchFilter", "SearchPattern", "SubjectPort", "OldDirHandle", "NewDirHandle"]
-    #
-    # Convert the timestamp from the XML file to a timestamp in milliseconds.
-    # An example format of the time is: 2024-09-22T21:05:27.263864000Z
-    year = int(event['System']['TimeCreated']['@SystemTime'].split('-')[0])
-    month = int( event['System']['TimeCreated']['@SystemTime'].split('-')[1])
-    day =  int(event['System']['TimeCreated']['@SystemTime'].split('-')[2].split('T')[0])
-    hour =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[0])
-    minute =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[1])
-    second =  int(event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[0])
-    msecond = event['System']['TimeCreated']['@SystemTime'].split('T')[1].split(':')[2].split('.')[1].split('Z')[0]
-    t = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).timestamp()
-    #
-    # Convert the timestep from a float in seconds to an integer in milliseconds.
-    msecond = int(msecond)/(10 ** (len(msecond) - 3))
-    t = int(t * 1000 + msecond)
-    #
-    # Build the message to send to CloudWatch.
-    cwData  = f"Date={event['System']['TimeCreated']['@SystemTime']}, "
-    cwData += f"Event={event['System']['EventName'].replace(' ', '-')}, " # Replace spaces with dashes.
-    cwData += f"fs={event['System']['Computer'].split('/')[0]}, "
-    cwData += f"svm={event['System']['Computer'].split('/')[1]}, "
-    cwData += f"Result={event['System']['Result'].replace(' ', '-')}"     # Replace spaces with dashes.
-    #
-    # Add the data fields to the message. Some fields are ignored. Some required special handling.
-    for data in event['EventData']['Data']:
-        if data['@Name'] not in ignoredDataFields:
-            if data['@Name'] == 'SubjectIP':
-                cwData += f", IP={data['#text']}"
-            elif data['@Name'] == 'SubjectUnix':
-                cwData += f", UnixID={data['@Uid']}, GroupID={data['@Gid']}"
-            elif data['@Name'] == 'SubjectUserSid':
-                cwData += f", UserSid={data['#text']}"
-            elif data['@Name'] == 'SubjectUserName':
-                cwData += f", UserName={data['#text']}"
-            elif data['@Name'] == 'SubjectDomainName':
-                cwData += f", Domain={data['#text']}"
-            elif data['@Name'] == 'ObjectName' or data['@Name'] == 'FileName':
-                cwData += f", volume={data['#text'].split(';')[0].replace('(', '').replace(')', '')}, name={data['#text'].split(';')[1]}"
-            elif data['@Name'] == 'InformationSet':
-                if data.get('#text') == None:
-                    cwData += ", InformationSet=Null"
-                else:
-                    cwData += f", InformationSet={data['#text']}"
-            else: # Assume the rest of the fields don't need special handling.
-                cwData += f", {data['@Name']}={data['#text']}"
+            skippedData.add(dataName)
+
+    def formatProjectedFields(event):
+        system = event['System']
+        fields = [prefix + getter(system) for (prefix, getter) in systemFormatters]
+        eventData = event.get('EventData')
+        dataList = eventData.get('Data', []) if eventData != None else []
+        if isinstance(dataList, dict):
+            dataList = [dataList]
+        for data in dataList:
+            name = data['@Name']
+            if name in skippedData:
+                continue
+            formatter = dataFormatters.get(name)
+            if formatter != None:
+                fields.append(formatter(data))
+            elif name in wanted:
+                fields.append(f"{name}={data.get('#text', '')}")
+        #
+        # CloudWatch doesn't accept empty events.
+        if len(fields) == 0:
+            return None
+        return {'timestamp': getEventTimestamp(system['TimeCreated']['@SystemTime']), 'message': ", ".join(fields)}
 
-    return {'timestamp': t, 'message': cwData}
+    return formatProjectedFields
 
 ################################################################################
-# This function uploads the audit log events stored in XML format to a
-# CloudWatch log stream.
+# This function returns a function that converts an XML audit log event into
+# a CloudWatch event in the specified output format, or None if the event
+# doesn't have any of the fields to include. Only the fields listed in
+# 'outputFields' are included, or all of them if it is None.
 ################################################################################
-def ingestAuditFile(auditLogPath, auditLogName):
-    global cwLogsClient, config
+def compileCWEventFormatter(outputFormat='kv', outputFields=None, emfNamespace='FSxN/AuditLogs'):
+    if outputFormat not in outputFormats:
+        raise Exception(f"Unknown output format '{outputFormat}'. It must be one of: {', '.join(outputFormats)}.")
+    if outputFormat == 'none':
+        return lambda event: None
+    if outputFormat == 'kv':
+        return compileKVEventFormatter(outputFields)
+
+    if outputFields != None and outputFormat == 'emf':
+        outputFields = list(outputFields) + emfDimensions   # The metric needs its dimensions.
+    getFields = compileFieldExtractor(outputFields)
+
     #
-    # Convert the XML audit log file into a dictionary.
-    f = open(auditLogPath, 'r')
-    data = f.read()
-    dictData = xmltodict.parse(data)
+    # CloudWatch doesn't accept empty events, so None is returned if none of the wanted fields are in the event.
+    if outputFormat == 'json':
+        encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+        def formatEvent(event):
+            fields = getFields(event)
+            if len(fields) == 0:
+                return None
+            return {'timestamp': getEventTimestamp(event['System']['TimeCreated']['@SystemTime']),
+                    'message': encoder.encode(dict(fields))}
+    else:
+        encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+        #
+        # Only the timestamp in the metadata changes, so the rest is encoded once.
+        metricDirectives = encoder.encode([{'Namespace': emfNamespace, 'Dimensions': [emfDimensions], 'Metrics': [{'Name': 'AuditEvents', 'Unit': 'Count'}]}])
+        def formatEvent(event):
+            timestamp = getEventTimestamp(event['System']['TimeCreated']['@SystemTime'])
+            fields = encoder.encode(dict(getFields(event)))   # There is always at least the dimensions.
+            return {'timestamp': timestamp,
+                    'message': f'{{"_aws":{{"Timestamp":{timestamp},"CloudWatchMetrics":{metricDirectives}}},"AuditEvents":1,{fields[1:]}'}
 
-    if dictData.get('Events') == None or dictData['Events'].get('Event') == None:
-        print(f"No events found in {auditLogName}")
-        return
+    return formatEvent
+
+################################################################################
+# Converting the date portion of an event's timestamp is the expensive part,
+# and all the events in an audit file are typically from the same day or
+# two, so the epoch, in milliseconds, of midnight UTC is cached by date.
+################################################################################
+dateEpochCache = {}
+
+################################################################################
+# This function converts the timestamp of an audit event into milliseconds
+# since the epoch. An example format of the time is:
+#   2024-09-22T21:05:27.263864000Z
+################################################################################
+def getEventTimestamp(systemTime):
+    date = systemTime[0:10]
+    dateEpoch = dateEpochCache.get(date)
+    if dateEpoch == None:
+        if len(dateEpochCache) > 1000:
+            dateEpochCache.clear()
+        dateEpoch = int(datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), tzinfo=datetime.timezone.utc).timestamp()) * 1000
+        dateEpochCache[date] = dateEpoch
+
+    seconds = int(systemTime[11:13])*3600 + int(systemTime[14:16])*60 + int(systemTime[17:19])
     #
-    # Ensure the logstream exists.
+    # Only the first three digits of the fractional seconds are needed to get milliseconds.
+    msecond = 0
+    if systemTime[19:20] == '.':
+        fraction = systemTime[20:23].rstrip('Z')
+        msecond = int(fraction.ljust(3, '0'))
+
+    return dateEpoch + seconds * 1000 + msecond
+
+################################################################################
+# This function returns all the fields of an XML audit log event, for the
+# archive.
+################################################################################
+getArchiveFields = compileFieldExtractor()
+
+################################################################################
+# This function returns a CloudWatch event from the XML audit log event. It
+# is replaced with one for the configured output format when the Lambda
+# function runs.
+################################################################################
+createCWEvent = compileCWEventFormatter()
+
+################################################################################
+# The conditions an event filter rule can have. An event matches a rule if
+# it matches all of the rule's conditions, and matches a condition if it
+# matches any of its values:
+#   events: The event name. E.g. "Read Object" or "Read-Object".
+#   results: The result. E.g. "Audit Success" or "Audit-Success".
+#   users: The user name, ignoring case.
+#   sids: The user's SID.
+#   pathPrefixes: The start of the path of the object.
+# Each rule can also have a "name", which is used when reporting how many
+# events it dropped.
+################################################################################
+eventFilterConditions = ['events', 'results', 'users', 'sids', 'pathPrefixes']
+
+################################################################################
+# The price, in US dollars, of ingesting a GB of data into the standard log
+# class of CloudWatch Logs, in most regions. It is only used to estimate the
+# savings from the event filters.
+################################################################################
+cwLogsPricePerGB = 0.50
+
+################################################################################
+# This function returns the data fields of an audit event that the event
+# filters use, as a (user name, SID, path) tuple.
+################################################################################
+def getEventFilterFields(event):
+    (userName, sid, path) = ('', '', '')
+    dataFields = (event.get('EventData') or {}).get('Data') or []
+    if isinstance(dataFields, dict):
+        dataFields = [dataFields]
+    for data in dataFields:
+        name = data.get('@Name')
+        if name == 'SubjectUserName':
+            userName = (data.get('#text') or '').lower()
+        elif name == 'SubjectUserSid':
+            sid = data.get('#text') or ''
+        elif name == 'ObjectName' or name == 'FileName':
+            path = (data.get('#text') or '').partition(';')[2]
+    return (userName, sid, path)
+
+################################################################################
+# This function returns a function that returns the index of the first rule,
+# in 'rules', that an XML audit log event matches, or None if it doesn't
+# match any of them. Events that match a rule are dropped. The rules are
+# converted into sets, and tuples of prefixes, once, so matching an event
+# is just a few lookups. It returns None if there aren't any rules.
+################################################################################
+def compileEventFilter(rules=None):
+    if rules == None or len(rules) == 0:
+        return None
+
+    compiledRules = []
+    needData = False
+    for (index, rule) in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise Exception(f"Event filter rule {index + 1} must be a JSON object.")
+        unknown = set(rule) - set(eventFilterConditions) - {'name'}
+        if len(unknown) > 0:
+            raise Exception(f"Unknown condition(s) '{', '.join(sorted(unknown))}' in event filter rule {index + 1}. The conditions are: {', '.join(eventFilterConditions)}.")
+        conditions = {}
+        for condition in eventFilterConditions:
+            values = rule.get(condition)
+            if values == None:
+                conditions[condition] = None
+                continue
+            if isinstance(values, str):
+                values = [values]
+            if condition in ('events', 'results'):
+                #
+                # Allow the names with either spaces, as they are in the audit log, or dashes, as they are in the CloudWatch events.
+                conditions[condition] = {value.replace('-', ' ') for value in values} | {value.replace(' ', '-') for value in values}
+            elif condition == 'users':
+                conditions[condition] = {value.lower() for value in values}
+            elif condition == 'sids':
+                conditions[condition] = set(values)
+            else:
+                conditions[condition] = tuple(values)
+            if condition in ('users', 'sids', 'pathPrefixes'):
+                needData = True
+        compiledRules.append((index, conditions['events'], conditions['results'], conditions['users'], conditions['sids'], conditions['pathPrefixes']))
+
+    def matchEventFilter(event):
+        system = event['System']
+        eventName = system.get('EventName')
+        result = system.get('Result')
+        dataFields = None
+        for (index, events, results, users, sids, pathPrefixes) in compiledRules:
+            if events != None and eventName not in events:
+                continue
+            if results != None and result not in results:
+                continue
+            if needData:
+                if dataFields == None:
+                    dataFields = getEventFilterFields(event)
+                if users != None and dataFields[0] not in users:
+                    continue
+                if sids != None and dataFields[1] not in sids:
+                    continue
+                if pathPrefixes != None and not dataFields[2].startswith(pathPrefixes):
+                    continue
+            return index
+        return None
+
+    return matchEventFilter
+
+################################################################################
+# This function returns the index of the event filter rule an event matches,
+# or it is None if there aren't any rules. It is replaced with one for the
+# configured rules when the Lambda function runs.
+################################################################################
+matchEventFilter = compileEventFilter()
+#
+# The number of events, and estimated CloudWatch bytes, each event filter
+# rule has dropped during this invocation of the Lambda function.
+eventFilterDrops = collections.Counter()
+eventFilterDropBytes = collections.Counter()
+eventFilterDropsLock = threading.Lock()
+
+################################################################################
+# This function returns a description of the events dropped by the event
+# filters. 'drops' and 'dropBytes' are the number of events, and their
+# estimated CloudWatch bytes, dropped by each rule.
+################################################################################
+def describeEventFilterDrops(drops, dropBytes):
+    totalBytes = sum(dropBytes.values())
+    rules = ', '.join(f"'{getEventFilterRuleName(index)}' {count}" for (index, count) in sorted(drops.items()))
+    return (f"{sum(drops.values())} events (about {totalBytes/1024/1024:.1f} MiB, or ${totalBytes/1e9*cwLogsPricePerGB:.4f}, of CloudWatch "
+            f"ingestion; {rules})")
+
+################################################################################
+# This function returns the name of an event filter rule.
+################################################################################
+def getEventFilterRuleName(index):
+    global config
+    return config['eventFilters'][index].get('name', f"rule {index + 1}")
+
+################################################################################
+# The log streams that are known to exist, as (log group, log stream)
+# tuples. It is kept between invocations of the Lambda function, so
+# create_log_stream is only called for log streams it hasn't seen before.
+################################################################################
+knownLogStreams = set()
+knownLogStreamsLock = threading.Lock()
+
+################################################################################
+# This function makes sure a log stream exists, creating it if it isn't
+# known to exist. If 'refresh' is set, it is created even if it is known.
+################################################################################
+def ensureLogStream(logGroupName, logStreamName, refresh=False):
+    global cwLogsClient, config, knownLogStreams
+
+    with knownLogStreamsLock:
+        if not refresh and (logGroupName, logStreamName) in knownLogStreams:
+            return
+
     try:
-        cwLogsClient.create_log_stream(logGroupName=config['logGroupName'], logStreamName=auditLogName)
+        cwLogsClient.create_log_stream(logGroupName=logGroupName, logStreamName=logStreamName)
     except cwLogsClient.exceptions.ResourceAlreadyExistsException:
         #
-        # This really shouldn't happen, since we should only be processing
-        # each file once, but during testing it happens all the time.
-        print(f"Log stream {auditLogName} already exists")
-    #
-    # If there is only one event, then the dict['Events']['Event'] will be a
-    # dictionary, otherwise it will be a list of dictionaries.
-    if isinstance(dictData['Events']['Event'], list):
-        cwEvents = []
-        for event in dictData['Events']['Event']:
-            cwEvents.append(createCWEvent(event))
-            if len(cwEvents) == 5000:  # The real maximum is 10000 events, but there is also a size limit, so we will use 5000.
-                print("Putting 5000 events")
-                response = cwLogsClient.put_log_events(logGroupName=config['logGroupName'], logStreamName=auditLogName, logEvents=cwEvents)
-                if response.get('rejectedLogEventsInfo') != None:
-                    if response['rejectedLogEventsInfo'].get('tooNewLogEventStartIndex') > 0:
-                        print(f"Warning: Too new log event start index: {response['rejectedLogEventsInfo']['tooNewLogEventStartIndex']}")
-                    if response['rejectedLogEventsInfo'].get('tooOldLogEventStartIndex') > 0:
-                        print(f"Warning: Too old log event start index: {response['rejectedLogEventsInfo']['tooOldLogEventStartIndex']}")
-                cwEvents = []
+        # Log streams are shared between audit files, and invocations, unless
+        # there is one per file, in which case this really shouldn't happen,
+        # unless resuming a partially processed file, but during testing it
+        # happens all the time.
+        if config['logStreamStrategy'] == 'file':
+            print(f"Log stream {logStreamName} already exists")
+
+    with knownLogStreamsLock:
+        if len(knownLogStreams) > 10000:
+            knownLogStreams.clear()
+        knownLogStreams.add((logGroupName, logStreamName))
+
+################################################################################
+# The ways the events can be divided into log streams, and the format of the
+# log stream names:
+#   file: One per audit file, named after the file.
+#   fs-day: One per file system per day. E.g. fs-0123456789abcdef0/2024-09-22
+#   fs-hour: One per file system per hour. E.g. fs-0123456789abcdef0/2024-09-22T21
+#   svm-day: One per SVM per day. E.g. fs-0123456789abcdef0/fsx/2024-09-22
+#   svm-hour: One per SVM per hour. E.g. fs-0123456789abcdef0/fsx/2024-09-22T21
+# The day and hour are from the time of the event, in UTC.
+################################################################################
+logStreamStrategies = ['file', 'fs-day', 'fs-hour', 'svm-day', 'svm-hour']
+
+################################################################################
+# This function returns a function that returns the name of the log stream
+# an event should be sent to, using the specified strategy. It is passed the
+# name of the audit file, the XML audit log event, and its timestamp.
+################################################################################
+def compileLogStreamNamer(strategy='file'):
+    if strategy not in logStreamStrategies:
+        raise Exception(f"Unknown log stream strategy '{strategy}'. It must be one of: {', '.join(logStreamStrategies)}.")
+
+    if strategy == 'file':
+        return lambda auditLogName, event, timestamp: auditLogName
+
+    (scope, period) = strategy.split('-')
+    periodMs = 24*60*60*1000 if period == 'day' else 60*60*1000
+    periodFormat = '%Y-%m-%d' if period == 'day' else '%Y-%m-%dT%H'
+    periodNames = {}   # The name of each period, by its number since the epoch.
+    def getLogStreamName(auditLogName, event, timestamp):
+        periodNumber = timestamp // periodMs
+        periodName = periodNames.get(periodNumber)
+        if periodName == None:
+            if len(periodNames) > 1000:
+                periodNames.clear()
+            periodName = datetime.datetime.fromtimestamp(periodNumber * periodMs / 1000, tz=datetime.timezone.utc).strftime(periodFormat)
+            periodNames[periodNumber] = periodName
+        computer = event['System']['Computer']
+        source = computer.partition('/')[0] if scope == 'fs' else computer
+        return f"{source}/{periodName}"
+
+    return getLogStreamName
+
+################################################################################
+# This function returns the name of the log stream an event should be sent
+# to. It is replaced with one for the configured strategy when the Lambda
+# function runs.
+################################################################################
+getLogStreamName = compileLogStreamNamer()
+
+#
+# The aggregator for the current invocation of the Lambda function, if
+# aggregates are being kept.
+auditAggregator = None
+
+################################################################################
+# This function returns True if the Lambda function is close enough to its
+# time limit that it should stop processing audit files.
+################################################################################
+def outOfTime():
+    global deadline
+
+    return deadline != None and time.monotonic() > deadline
+
+################################################################################
+# This function uploads the audit log events stored in XML format to a
+# CloudWatch log stream, and to the archive if one is configured. The XML
+# data is passed in as an iterable of byte chunks, which are parsed as they
+# arrive. If a checkpoint is passed in, the chunks are expected to start at
+# its byte offset. Each time the events up to a point have been sent to
+# CloudWatch, and the archive, 'onCheckpoint' is called with a checkpoint
+# just past the last of them. If the Lambda function runs out of time, the
+# events read so far are sent and False is returned, otherwise True is
+# returned once the whole file has been processed.
+################################################################################
+def ingestAuditFile(chunks, auditLogName, checkpoint=None, onCheckpoint=None):
+    global config
+
+    numSinks = 2 if config['archiveBucketName'] != None else 1
+    sinkCheckpoints = {}
+    sinkCheckpointsLock = threading.Lock()
+    archivedEventIndex = 0
+    if checkpoint != None:
+        startOffset = checkpoint['byteOffset']
+        eventIndex = checkpoint['eventIndex']
+        print(f"Resuming {auditLogName} at event {eventIndex}, byte {startOffset}.")
+        #
+        # Both CloudWatch and the archive had all the events before the checkpoint.
+        for sink in ['cloudwatch', 'archive'][0:numSinks]:
+            sinkCheckpoints[sink] = {'byteOffset': startOffset, 'eventIndex': eventIndex}
+        archivedEventIndex = checkpoint.get('archivedEventIndex', eventIndex)
     else:
-        cwEvents = [createCWEvent(dictData['Events']['Event'])]
+        startOffset = 0
+        eventIndex = 0
+    #
+    # A checkpoint can only be saved once both CloudWatch and the archive have
+    # all the events before it, so keep track of how far each has gotten. The
+    # archive can get ahead of CloudWatch, so the index of the last event it
+    # has written is saved with the checkpoint, and when resuming, the
+    # archive skips the events up to it, instead of writing them again.
+    def onSinkCheckpoint(sink, newCheckpoint, lastEventIndex=None):
+        nonlocal archivedEventIndex
+        with sinkCheckpointsLock:
+            sinkCheckpoints[sink] = newCheckpoint
+            if lastEventIndex != None:
+                archivedEventIndex = max(archivedEventIndex, lastEventIndex)
+            if onCheckpoint != None and len(sinkCheckpoints) == numSinks:
+                resumeCheckpoint = min(sinkCheckpoints.values(), key=lambda checkpoint: checkpoint['eventIndex'])
+                resumeCheckpoint = {'byteOffset': resumeCheckpoint['byteOffset'], 'eventIndex': resumeCheckpoint['eventIndex']}
+                if numSinks > 1:
+                    resumeCheckpoint['archivedEventIndex'] = archivedEventIndex
+                onCheckpoint(resumeCheckpoint)
 
-    if len(cwEvents) > 0:
-        print(f"Putting {len(cwEvents)} events")
-        response = cwLogsClient.put_log_events(logGroupName=config['logGroupName'], logStreamName=auditLogName, logEvents=cwEvents)
-        if response.get('rejectedLogEventsInfo') != None:
-            if response['rejectedLogEventsInfo'].get('tooNewLogEventStartIndex') > 0:   
-                print(f"Warning: Too new log event start index: {response['rejectedLogEventsInfo']['tooNewLogEventStartIndex']}")
-            if response['rejectedLogEventsInfo'].get('tooOldLogEventStartIndex') > 0:   
-                print(f"Warning: Too old log event start index: {response['rejectedLogEventsInfo']['tooOldLogEventStartIndex']}")
+    completed = True
+    batcher = None
+    archive = None
+    drops = collections.Counter()   # The number of events dropped by each event filter rule.
+    counter = None
+    #
+    # ONTAP can write the audit logs in either the XML or the EVTX format.
+    if auditLogName.endswith('.evtx'):
+        events = parseEvtxEvents(chunks, startOffset)
+    else:
+        events = parseAuditEvents(chunks, startOffset)
+    try:
+        for (event, byteOffset) in events:
+            if batcher == None:
+                batcher = CWLogBatcher(config['logGroupName'], onUpload=lambda newCheckpoint: onSinkCheckpoint('cloudwatch', newCheckpoint), checkpoint=checkpoint)
+                if numSinks > 1:
+                    archive = ArchiveWriter(auditLogName, config['archiveFlushEvents'], onFlush=lambda newCheckpoint, lastEventIndex: onSinkCheckpoint('archive', newCheckpoint, lastEventIndex), skipThrough=archivedEventIndex)
+                if auditAggregator != None:
+                    counter = AuditFileCounter(auditAggregator, auditLogName)
+
+            eventIndex += 1
+            eventCheckpoint = {'byteOffset': byteOffset, 'eventIndex': eventIndex} if byteOffset != None else None
+            #
+            # The aggregates include all the events, even the ones that are filtered out.
+            if counter != None:
+                counter.add(event, getEventTimestamp(event['System']['TimeCreated']['@SystemTime']))
+            #
+            # Drop the events that match an event filter before formatting them.
+            cwEvent = None
+            dropRule = matchEventFilter(event) if matchEventFilter != None else None
+            if dropRule != None:
+                drops[dropRule] += 1
+            else:
+                cwEvent = createCWEvent(event)
+            if cwEvent != None:
+                batcher.add(cwEvent, eventCheckpoint, getLogStreamName(auditLogName, event, cwEvent['timestamp']))
+            else:
+                batcher.skip(eventCheckpoint)
+            if archive != None:
+                archive.add(event, getEventTimestamp(event['System']['TimeCreated']['@SystemTime']), eventIndex, eventCheckpoint)
+            #
+            # Only stop after an event that processing can be resumed from.
+            if eventCheckpoint != None and outOfTime():
+                print(f"Running out of time. Stopping {auditLogName} after event {eventIndex}, byte {byteOffset}.")
+                completed = False
+                break
+    except:
+        if batcher != None:
+            batcher.close(flush=False)
+        raise
+    finally:
+        events.close()
+
+    if batcher == None:
+        if completed:
+            print(f"No events found in {auditLogName}")
+        return completed
+
+    if counter != None:
+        counter.flush()
+    batcher.close()
+    print(f"Sent {batcher.eventsSent} events from {auditLogName}. {batcher.eventsRejected} were rejected.")
+    if len(drops) > 0:
+        #
+        # Estimate how much the dropped events would have cost from the average size of the events that were sent.
+        averageBytes = batcher.bytesAdded / batcher.eventsAdded if batcher.eventsAdded > 0 else 0
+        dropBytes = collections.Counter({index: int(count * averageBytes) for (index, count) in drops.items()})
+        print(f"The event filters dropped {describeEventFilterDrops(drops, dropBytes)} from {auditLogName}.")
+        with eventFilterDropsLock:
+            eventFilterDrops.update(drops)
+            eventFilterDropBytes.update(dropBytes)
+    if archive != None:
+        archive.close()
+        print(f"Archived {archive.eventsArchived} events from {auditLogName} in {archive.filesArchived} files.")
+    return completed
+
+################################################################################
+# This class is used to send events to a CloudWatch log stream in batches
+# that are as large as CloudWatch allows. That is, a batch is sent once
+# adding another event would make it more than 1 MiB (where each event
+# counts as the UTF-8 size of its message plus 26 bytes), more than 10,000
+# events, or span more than 24 hours. The events in each batch are sorted by
+# time, as CloudWatch requires. The batches are sent by a separate thread so
+# the caller can keep parsing events while a batch is being uploaded. At most
+# 'maxInFlight' batches are queued, after that add() waits for the
+# uploads to catch up. Each event can be added with a checkpoint, and once
+# a batch has been uploaded, 'onUpload' is called, from the upload thread,
+# with the latest checkpoint that all the events before it have been sent.
+# Each event can be sent to a different log stream, in which case a separate
+# batch is kept for each log stream, so events for several log streams can
+# be interleaved without making the batches smaller. A batch that hasn't
+# had any events added to it for a while is sent, so it doesn't hold back
+# the checkpoint. The log streams are created as needed.
+################################################################################
+class CWLogBatcher:
+    maxBatchBytes = 1024*1024
+    eventOverhead = 26
+    maxBatchEvents = 10000
+    maxBatchSpan = 24*60*60*1000      # In milliseconds.
+    maxEventBytes = 256*1024 - 26
+    maxOpenBatches = 16
+    retryableErrors = ['ThrottlingException', 'ServiceUnavailableException']
+    maxRetries = 6
+
+    def __init__(self, logGroupName, logStreamName=None, maxInFlight=2, onUpload=None, checkpoint=None):
+        self.logGroupName = logGroupName
+        self.logStreamName = logStreamName
+        self.onUpload = onUpload
+        self.batches = {}            # The batch being built for each log stream.
+        self.checkpoint = checkpoint # The checkpoint of the last event added.
+        self.queuedCheckpoint = checkpoint  # The checkpoint of the last batch queued.
+        self.eventsAdded = 0
+        self.bytesAdded = 0
+        self.eventsSent = 0
+        self.eventsRejected = 0
+        self.error = None
+        self.discard = False
+        self.queue = queue.Queue(maxsize=maxInFlight)
+        self.thread = threading.Thread(target=self.uploader, daemon=True)
+        self.thread.start()
+
+    ############################################################################
+    # This method adds an event to the batch for its log stream, sending the
+    # batch first if the event won't fit in it.
+    ############################################################################
+    def add(self, event, checkpoint=None, logStreamName=None):
+        if logStreamName == None:
+            logStreamName = self.logStreamName
+
+        message = event['message']
+        size = len(message) if message.isascii() else len(message.encode('utf-8'))
+        if size > self.maxEventBytes:
+            print(f"Warning: Truncating a {size} byte event to {self.maxEventBytes} bytes.")
+            message = message.encode('utf-8')[:self.maxEventBytes].decode('utf-8', errors='ignore')
+            event = {'timestamp': event['timestamp'], 'message': message}
+            size = len(message.encode('utf-8'))
+        size += self.eventOverhead
+
+        timestamp = event['timestamp']
+        batch = self.batches.get(logStreamName)
+        if (batch != None and
+            (len(batch['events']) == self.maxBatchEvents or batch['bytes'] + size > self.maxBatchBytes or
+             max(batch['maxTimestamp'], timestamp) - min(batch['minTimestamp'], timestamp) > self.maxBatchSpan)):
+            self.flush(logStreamName)
+            batch = None
+
+        if batch == None:
+            #
+            # Send any batches that haven't had events added to them for a while.
+            if len(self.batches) > 0:
+                for (name, openBatch) in list(self.batches.items()):
+                    if len(self.batches) >= self.maxOpenBatches or self.eventsAdded - openBatch['lastAdded'] > self.maxBatchEvents:
+                        self.flush(name)
+            #
+            # The checkpoint before the first event in the batch is how far it
+            # is safe to resume from until the batch has been sent.
+            batch = {'events': [], 'bytes': 0, 'minTimestamp': timestamp, 'maxTimestamp': timestamp, 'startCheckpoint': self.checkpoint}
+            self.batches[logStreamName] = batch
+
+        batch['events'].append(event)
+        batch['bytes'] += size
+        self.bytesAdded += size
+        batch['lastAdded'] = self.eventsAdded
+        if timestamp < batch['minTimestamp']:
+            batch['minTimestamp'] = timestamp
+        if timestamp > batch['maxTimestamp']:
+            batch['maxTimestamp'] = timestamp
+        self.eventsAdded += 1
+        if checkpoint != None:
+            self.checkpoint = checkpoint
+
+    ############################################################################
+    # This method records that an event, that isn't going to be sent, has
+    # been processed, so its checkpoint can be reported once all the events
+    # before it have been sent.
+    ############################################################################
+    def skip(self, checkpoint):
+        if checkpoint != None:
+            self.checkpoint = checkpoint
+
+    ############################################################################
+    # This method queues the batch for a log stream, or all the batches if
+    # no log stream is specified, to be sent by the upload thread. Each batch
+    # is queued with the checkpoint that will be safe to resume from once it
+    # has been sent. That is, the checkpoint before the first event in the
+    # oldest batch still being built, or the last checkpoint if there isn't
+    # one. Since the batches are sent in order, those checkpoints never go
+    # backwards.
+    ############################################################################
+    def flush(self, logStreamName=None):
+        if self.error != None:
+            raise self.error
+
+        names = list(self.batches.keys()) if logStreamName == None else [logStreamName]
+        for name in names:
+            batch = self.batches.pop(name, None)
+            if batch == None:
+                continue
+
+            checkpoint = self.checkpoint
+            for openBatch in self.batches.values():
+                if openBatch['startCheckpoint'] == None:
+                    checkpoint = None
+                    break
+                if checkpoint != None and openBatch['startCheckpoint']['eventIndex'] < checkpoint['eventIndex']:
+                    checkpoint = openBatch['startCheckpoint']
+
+            batch['events'].sort(key=lambda event: event['timestamp'])
+            self.queue.put((name, batch['events'], checkpoint))
+            if checkpoint != None:
+                self.queuedCheckpoint = checkpoint
+        #
+        # If events were skipped after the last one queued, report their checkpoint too.
+        if logStreamName == None and self.checkpoint != None and self.checkpoint is not self.queuedCheckpoint:
+            self.queue.put((None, [], self.checkpoint))
+            self.queuedCheckpoint = self.checkpoint
+
+    ############################################################################
+    # This method sends any remaining events, and waits for the upload thread
+    # to finish. It raises any error the upload thread encountered. If 'flush'
+    # is False, any batches that haven't been sent yet are discarded instead.
+    ############################################################################
+    def close(self, flush=True):
+        try:
+            if flush:
+                self.flush()
+            else:
+                self.discard = True
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+
+        if flush and self.error != None:
+            raise self.error
+
+    ############################################################################
+    # This method runs in its own thread and sends the queued batches. Once an
+    # error has occurred, or the batcher was closed without flushing, any
+    # remaining batches are discarded.
+    ############################################################################
+    def uploader(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                return
+            if self.error != None or self.discard:
+                continue
+            (logStreamName, batch, checkpoint) = item
+            try:
+                if len(batch) > 0:
+                    self.putEvents(logStreamName, batch)
+                if self.onUpload != None and checkpoint != None:
+                    self.onUpload(checkpoint)
+            except Exception as err:
+                self.error = err
+
+    ############################################################################
+    # This method sends a batch of events to a log stream, retrying, with an
+    # exponential backoff, if CloudWatch is throttling the requests. If the
+    # log stream doesn't exist, which can happen if it was deleted after it
+    # was cached as existing, it is created and the batch sent again.
+    ############################################################################
+    def putEvents(self, logStreamName, batch):
+        global cwLogsClient
+
+        ensureLogStream(self.logGroupName, logStreamName)
+        retries = 0
+        recreated = False
+        while True:
+            try:
+                response = cwLogsClient.put_log_events(logGroupName=self.logGroupName, logStreamName=logStreamName, logEvents=batch)
+                break
+            except cwLogsClient.exceptions.ResourceNotFoundException:
+                if recreated:
+                    raise
+                ensureLogStream(self.logGroupName, logStreamName, refresh=True)
+                recreated = True
+            except botocore.exceptions.ClientError as err:
+                if err.response['Error']['Code'] not in self.retryableErrors or retries >= self.maxRetries:
+                    raise err
+                time.sleep(0.25 * 2**retries)
+                retries += 1
+        #
+        # Account for any events CloudWatch rejected.
+        rejected = 0
+        info = response.get('rejectedLogEventsInfo')
+        if info != None:
+            if info.get('tooNewLogEventStartIndex') != None:
+                rejected += len(batch) - info['tooNewLogEventStartIndex']
+                print(f"Warning: {len(batch) - info['tooNewLogEventStartIndex']} events were too new for {logStreamName}.")
+            if info.get('tooOldLogEventEndIndex') != None:
+                rejected += info['tooOldLogEventEndIndex']
+                print(f"Warning: {info['tooOldLogEventEndIndex']} events were too old for {logStreamName}.")
+            if info.get('expiredLogEventEndIndex') != None:
+                #
+                # Expired events are also too old, so don't count them twice.
+                if info.get('tooOldLogEventEndIndex') == None or info['expiredLogEventEndIndex'] > info['tooOldLogEventEndIndex']:
+                    rejected += info['expiredLogEventEndIndex'] - (info.get('tooOldLogEventEndIndex') or 0)
+                print(f"Warning: {info['expiredLogEventEndIndex']} events were older than the retention period of {self.logGroupName}.")
+        self.eventsRejected += rejected
+        self.eventsSent += len(batch) - rejected
+
+################################################################################
+# This class is used to archive audit events to S3 as Parquet files, which
+# are much cheaper to keep long term than CloudWatch logs, and can be
+# queried with tools like Amazon Athena. The events are buffered, and once
+# 'maxEvents' have been added, they are written as one Parquet file per file
+# system, SVM and day, using Hive style partitioning. For example:
+#   <archivePrefix>fs=fs-0123456789abcdef0/svm=fsx/date=2024-09-22/audit_fsx_D2024-09-22-T21-00-03_0000000000-000000001.parquet
+# where the number at the end is the index of the first event in the audit
+# log file that is in the Parquet file. Each event can be added with a
+# checkpoint, and once the events have been written, 'onFlush' is called
+# with the checkpoint of the last event added, and the index of the last
+# event written. When resuming, that index is passed back in as
+# 'skipThrough', so the events that were already written are skipped
+# instead of being written again to differently named objects.
+#
+# The pyarrow package is only imported when the archive is used, since it
+# isn't part of the Lambda runtime and is large.
+################################################################################
+class ArchiveWriter:
+    columns = ['Date', 'Event', 'fs', 'svm', 'Result', 'IP', 'UnixID', 'GroupID', 'UserSid', 'UserName', 'Domain', 'volume', 'name', 'InformationSet', 'ObjectType', 'OldPath', 'NewPath']
+
+    def __init__(self, auditLogName, maxEvents, onFlush=None, skipThrough=0):
+        global pa, pq
+
+        if pa == None:
+            try:
+                import pyarrow as pa                # pylint: disable=W0621,C0415
+                import pyarrow.parquet as pq        # pylint: disable=W0621,C0415
+            except ImportError as err:
+                raise Exception("The pyarrow package is required to archive the audit events. Either add it to the Lambda function, or unset archiveBucketName.") from err
+
+        self.auditLogName = auditLogName.rsplit('.', 1)[0]
+        self.maxEvents = maxEvents
+        self.onFlush = onFlush
+        self.schema = pa.schema([('timestamp', pa.timestamp('ms', tz='UTC'))] + [(name, pa.string()) for name in self.columns] + [('extra', pa.string())])
+        self.columnSet = set(self.columns)
+        self.partitions = {}
+        self.numEvents = 0
+        self.checkpoint = None
+        self.skipThrough = skipThrough
+        self.lastEventIndex = skipThrough
+        self.eventsArchived = 0
+        self.filesArchived = 0
+
+    ############################################################################
+    # This method adds an event, writing out the buffered events if there
+    # are 'maxEvents' of them. Events at, or before, the 'skipThrough' event
+    # index were already written by a previous run, so they are skipped.
+    ############################################################################
+    def add(self, event, timestamp, eventIndex, checkpoint=None):
+        if eventIndex <= self.skipThrough:
+            if checkpoint != None:
+                self.checkpoint = checkpoint
+            return
+
+        fields = dict(getArchiveFields(event))
+        partitionKey = (fields.get('fs'), fields.get('svm'), fields.get('Date', '')[0:10])
+        partition = self.partitions.get(partitionKey)
+        if partition == None:
+            partition = {name: [] for name in self.schema.names}
+            partition['firstEventIndex'] = eventIndex
+            self.partitions[partitionKey] = partition
+
+        partition['timestamp'].append(timestamp)
+        for name in self.columns:
+            partition[name].append(fields.get(name))
+        #
+        # Any fields that don't have a column of their own are stored as a JSON object.
+        extra = {name: value for (name, value) in fields.items() if name not in self.columnSet}
+        partition['extra'].append(json.dumps(extra, separators=(',', ':'), ensure_ascii=False) if len(extra) > 0 else None)
+
+        self.numEvents += 1
+        self.lastEventIndex = eventIndex
+        if checkpoint != None:
+            self.checkpoint = checkpoint
+        if self.numEvents >= self.maxEvents:
+            self.flush()
+
+    ############################################################################
+    # This method writes the buffered events to S3.
+    ############################################################################
+    def flush(self):
+        global archiveS3Client, config
+
+        for ((fs, svm, date), partition) in self.partitions.items():
+            firstEventIndex = partition.pop('firstEventIndex')
+            table = pa.Table.from_pydict(partition, schema=self.schema)
+            buffer = pa.BufferOutputStream()
+            pq.write_table(table, buffer, compression=config['archiveCompression'])
+            key = f"{config['archivePrefix']}fs={fs}/svm={svm}/date={date}/{self.auditLogName}-{firstEventIndex:09d}.parquet"
+            archiveS3Client.put_object(Bucket=config['archiveBucketName'], Key=key, Body=buffer.getvalue().to_pybytes())
+            self.eventsArchived += table.num_rows
+            self.filesArchived += 1
+
+        self.partitions = {}
+        self.numEvents = 0
+        if self.onFlush != None and self.checkpoint != None:
+            self.onFlush(self.checkpoint, self.lastEventIndex)
+        self.checkpoint = None
+
+    ############################################################################
+    # This method writes any remaining events to S3.
+    ############################################################################
+    def close(self):
+        self.flush()
 
 ################################################################################
 # This function checks that all the required configuration variables are set.
@@ -250,15 +1450,13 @@ def checkConfig():
     global config
 
     config = {
-        'volumeName': volumeName if 'volumeName' in globals() else None,               # pylint: disable=E0602
         'logGroupName': logGroupName if 'logGroupName' in globals() else None,         # pylint: disable=E0602
         'fsxRegion': fsxRegion if 'fsxRegion' in globals() else None,                  # pylint: disable=E0602
         'secretRegion': secretRegion if 'secretRegion' in globals() else None,         # pylint: disable=E0602
         'secretArn': secretArn if 'secretArn' in globals() else None,                  # pylint: disable=E0602
         's3BucketRegion': s3BucketRegion if 's3BucketRegion' in globals() else None,   # pylint: disable=E0602
         's3BucketName': s3BucketName if 's3BucketName' in globals() else None,         # pylint: disable=E0602
-        'statsName': statsName if 'statsName' in globals() else None,                  # pylint: disable=E0602
-        'vserverName': vserverName if 'vserverName' in globals() else None             # pylint: disable=E0602
+        'statsName': statsName if 'statsName' in globals() else None                   # pylint: disable=E0602
     }
 
     for item in config:
@@ -266,17 +1464,340 @@ def checkConfig():
             config[item] = os.environ.get(item)
         if config[item] == None:
             raise Exception(f"{item} is not set.")
+    #
+    # These variables are optional. The second value is the default to use if it isn't set.
+    optionalConfig = {
+        'downloadParallelism': (downloadParallelism if 'downloadParallelism' in globals() else None, 4),        # pylint: disable=E0602
+        'fileSystemParallelism': (fileSystemParallelism if 'fileSystemParallelism' in globals() else None, 8),  # pylint: disable=E0602
+        'checkpointInterval': (checkpointInterval if 'checkpointInterval' in globals() else None, 30),          # pylint: disable=E0602
+        'timeLimitMargin': (timeLimitMargin if 'timeLimitMargin' in globals() else None, 60),                   # pylint: disable=E0602
+        'outputFormat': (outputFormat if 'outputFormat' in globals() else None, 'kv'),                          # pylint: disable=E0602
+        'outputFields': (outputFields if 'outputFields' in globals() else None, None),                          # pylint: disable=E0602
+        'emfNamespace': (emfNamespace if 'emfNamespace' in globals() else None, 'FSxN/AuditLogs'),              # pylint: disable=E0602
+        'archiveBucketName': (archiveBucketName if 'archiveBucketName' in globals() else None, None),           # pylint: disable=E0602
+        'archiveBucketRegion': (archiveBucketRegion if 'archiveBucketRegion' in globals() else None, None),     # pylint: disable=E0602
+        'archivePrefix': (archivePrefix if 'archivePrefix' in globals() else None, 'audit_logs/'),              # pylint: disable=E0602
+        'archiveS3EndpointUrl': (archiveS3EndpointUrl if 'archiveS3EndpointUrl' in globals() else None, None),  # pylint: disable=E0602
+        'archiveFlushEvents': (archiveFlushEvents if 'archiveFlushEvents' in globals() else None, 50000),       # pylint: disable=E0602
+        'archiveCompression': (archiveCompression if 'archiveCompression' in globals() else None, 'zstd'),      # pylint: disable=E0602
+        'leaseDuration': (leaseDuration if 'leaseDuration' in globals() else None, 300),                        # pylint: disable=E0602
+        'concurrentInvocations': (concurrentInvocations if 'concurrentInvocations' in globals() else None, 'false'), # pylint: disable=E0602
+        'stateDirectory': (stateDirectory if 'stateDirectory' in globals() else None, None),                    # pylint: disable=E0602
+        'logStreamStrategy': (logStreamStrategy if 'logStreamStrategy' in globals() else None, 'file'),         # pylint: disable=E0602
+        'eventFilters': (eventFilters if 'eventFilters' in globals() else None, None),                          # pylint: disable=E0602
+        'aggregateFields': (aggregateFields if 'aggregateFields' in globals() else None, None),                 # pylint: disable=E0602
+        'aggregateInterval': (aggregateInterval if 'aggregateInterval' in globals() else None, 3600),           # pylint: disable=E0602
+        'aggregateTopN': (aggregateTopN if 'aggregateTopN' in globals() else None, 10),                         # pylint: disable=E0602
+        'aggregateOutput': (aggregateOutput if 'aggregateOutput' in globals() else None, 'json'),               # pylint: disable=E0602
+        'vserverName': (vserverName if 'vserverName' in globals() else None, None),                             # pylint: disable=E0602
+        'auditDiscoveryInterval': (auditDiscoveryInterval if 'auditDiscoveryInterval' in globals() else None, 3600) # pylint: disable=E0602
+    }
+
+    for item, (value, default) in optionalConfig.items():
+        if value == None:
+            value = os.environ.get(item)
+        if value == None:
+            value = default
+        elif isinstance(default, int):
+            value = int(value)
+        config[item] = value
+    #
+    # The output fields are a comma separated list.
+    if isinstance(config['outputFields'], str):
+        config['outputFields'] = [field.strip() for field in config['outputFields'].split(',') if field.strip() != '']
+        if len(config['outputFields']) == 0:
+            config['outputFields'] = None
+    #
+    # The SVMs to ingest the audit logs of are a comma separated list.
+    if isinstance(config['vserverName'], str):
+        config['vserverName'] = [svm.strip() for svm in config['vserverName'].split(',') if svm.strip() != '']
+        if len(config['vserverName']) == 0:
+            config['vserverName'] = None
+    #
+    # The aggregate fields are a comma separated list.
+    if isinstance(config['aggregateFields'], str):
+        config['aggregateFields'] = [field.strip() for field in config['aggregateFields'].split(',') if field.strip() != '']
+        if len(config['aggregateFields']) == 0:
+            config['aggregateFields'] = None
+    if config['aggregateFields'] != None:
+        for field in config['aggregateFields']:
+            if field not in aggregateFieldNames:
+                raise Exception(f"Unknown aggregate field '{field}'. It must be one of: {', '.join(aggregateFieldNames)}.")
+        if config['aggregateInterval'] <= 0 or config['aggregateTopN'] <= 0:
+            raise Exception("aggregateInterval and aggregateTopN must be greater than 0.")
+        if config['aggregateOutput'] not in ['json', 'emf']:
+            raise Exception(f"Unknown aggregate output '{config['aggregateOutput']}'. It must be either json or emf.")
+    #
+    # The event filters are a JSON list of rules.
+    if isinstance(config['eventFilters'], str):
+        try:
+            config['eventFilters'] = json.loads(config['eventFilters']) if config['eventFilters'].strip() != '' else None
+        except json.JSONDecodeError as err:
+            raise Exception(f"eventFilters is not valid JSON: {err}") from err
+    if config['eventFilters'] != None and not isinstance(config['eventFilters'], list):
+        raise Exception("eventFilters must be a list of rules.")
+    #
+    # Whether several copies of the Lambda function might run at the same time.
+    config['concurrentInvocations'] = str(config['concurrentInvocations']).strip().lower() in ['true', 'yes', '1']
+    #
+    # The archive is in the same region as the stats bucket unless specified otherwise.
+    if config['archiveBucketRegion'] == None:
+        config['archiveBucketRegion'] = config['s3BucketRegion']
+
+################################################################################
+# This function returns the records from an ONTAP API call that returns a
+# collection. If ONTAP returns them in pages, every page is read. If
+# 'allowMissing' is set, it returns None if ONTAP says the collection
+# doesn't exist, instead of raising an exception.
+################################################################################
+def getOntapRecords(fsxn, headers, endpoint, allowMissing=False):
+    global http
+
+    records = []
+    endpoint = f"https://{fsxn}{endpoint}"
+    while endpoint != None:
+        response = http.request('GET', endpoint, headers=headers, timeout=5.0)
+        if response.status == 404 and allowMissing and len(records) == 0:
+            return None
+        if response.status != 200:
+            raise Exception(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
+
+        data = json.loads(response.data.decode('utf-8'))
+        records.extend(data.get('records', []))
+        #
+        # The next page, if there is one, is given as a path relative to the host.
+        nextHref = data.get('_links', {}).get('next', {}).get('href')
+        endpoint = f"https://{fsxn}{nextHref}" if nextHref != None else None
+
+    return records
+
+################################################################################
+# This function asks an FSxN which of its SVMs have auditing configured, and
+# where they write their audit logs. Since the audit log path is a path in
+# the SVM's namespace, it is matched against the junction paths of the
+# SVM's volumes to find the volume, and the directory in it, the audit logs
+# are in. Both are looked up for all the SVMs at once. SVMs with auditing
+# disabled are included, since they may still have audit logs that haven't
+# been processed. It returns a list with, for each SVM:
+#   svm: The name of the SVM.
+#   volume: The name of the volume that holds its audit logs.
+#   uuid: The UUID of that volume.
+#   directory: The directory in the volume that holds the audit logs, or
+#     an empty string if it is the root of the volume.
+################################################################################
+def discoverAuditSvms(fsxn, headers):
+    global config
+
+    auditConfigs = []
+    for record in getOntapRecords(fsxn, headers, "/api/protocols/audit?fields=svm.name,log_path,enabled"):
+        if record.get('log_path') == None:
+            continue
+        if config['vserverName'] != None and record['svm']['name'] not in config['vserverName']:
+            continue
+        auditConfigs.append(record)
+
+    if len(auditConfigs) == 0:
+        return []
+    #
+    # Get the junction paths of all the volumes on the audited SVMs.
+    svmNames = urllib.parse.quote('|'.join(record['svm']['name'] for record in auditConfigs))
+    junctions = collections.defaultdict(list)
+    for volume in getOntapRecords(fsxn, headers, f"/api/storage/volumes?svm.name={svmNames}&fields=name,uuid,svm.name,nas.path"):
+        junctionPath = volume.get('nas', {}).get('path')
+        if junctionPath != None:
+            junctions[volume['svm']['name']].append((junctionPath.rstrip('/'), volume))
+
+    auditSvms = []
+    for record in auditConfigs:
+        svm = record['svm']['name']
+        logPath = record['log_path'].rstrip('/')
+        #
+        # The audit logs are in the volume with the longest junction path that contains the log path.
+        matches = [(junctionPath, volume) for (junctionPath, volume) in junctions[svm] if logPath == junctionPath or logPath.startswith(junctionPath + '/')]
+        if len(matches) == 0:
+            print(f"Warning: No volume found for the audit log path {record['log_path']} of SVM {svm} on {fsxn}.")
+            continue
+        (junctionPath, volume) = max(matches, key=lambda match: len(match[0]))
+        auditSvms.append({'svm': svm, 'volume': volume['name'], 'uuid': volume['uuid'], 'directory': logPath[len(junctionPath):].strip('/')})
+
+    return auditSvms
+
+################################################################################
+# This function returns the SVMs on an FSxN that have auditing configured,
+# as returned by discoverAuditSvms(). Since they rarely change, they are
+# cached in the FSxN's state, and only looked for again every
+# 'auditDiscoveryInterval' seconds, if the SVMs to include change, or if
+# 'refresh' is set.
+################################################################################
+def getAuditSvms(fsxn, headers, refresh=False):
+    global config
+
+    (state, version) = stateManager.read(fsxn)
+    cached = state.get('auditSvms')
+    if not refresh and cached != None and cached.get('vserverName') == config['vserverName'] and time.time() - cached['discovered'] < config['auditDiscoveryInterval']:
+        return cached['svms']
+
+    auditSvms = discoverAuditSvms(fsxn, headers)
+    def update(state):
+        state['auditSvms'] = {'discovered': time.time(), 'vserverName': config['vserverName'], 'svms': auditSvms}
+        return (True, None)
+    stateManager.update(fsxn, update)
+    return auditSvms
+
+################################################################################
+# This function returns the name and size of the audit log files of an SVM
+# that come after 'startName', including it, in name order. Since the names
+# contain the time the file was created, they are in time order. ONTAP is
+# asked to only return those files. If 'startName' is None, all the audit
+# log files are returned. It returns None if the volume doesn't exist.
+################################################################################
+def listAuditFiles(fsxn, headers, auditSvm, startName=None):
+    #
+    # All the audit log files start with "audit_<vserver>_D", so ending the
+    # range at "audit_<vserver>_E" excludes the active audit log file. They
+    # end with ".xml" or ".evtx", depending on the format ONTAP writes them in.
+    # Since the files of an SVM whose name starts with "<vserver>_D" would
+    # also be in that range, only the ones for this SVM are kept.
+    if startName == None:
+        nameQuery = f"audit_{auditSvm['svm']}_D*"
+    else:
+        nameQuery = f"{startName}..audit_{auditSvm['svm']}_E"
+
+    directory = f"/{urllib.parse.quote(auditSvm['directory'], safe='')}" if auditSvm['directory'] != '' else ''
+    endpoint = f"/api/storage/volumes/{auditSvm['uuid']}/files{directory}?name={nameQuery}&order_by=name%20asc&fields=name,size"
+    records = getOntapRecords(fsxn, headers, endpoint, allowMissing=True)
+    if records == None:
+        return None
+
+    return [file for file in records if getAuditFileSvm(file['name']) == auditSvm['svm']]
+
+################################################################################
+# This function gets ready to process an FSxN. It returns the headers to use
+# with its ONTAP APIs, and the SVMs on it that have auditing configured, or
+# None if it can't be processed.
+################################################################################
+def prepareFileSystem(fsxn, secrets):
+    if outOfTime():
+        print(f"Running out of time. Skipping {fsxn}.")
+        return None
+
+    username = "fsxadmin"
+    fsId = fsxn.split('.')[1]
+    #
+    # Get the password
+    password = secrets.get(fsId)
+    if password == None:
+        print(f'Warning: No password found for {fsId}.')
+        return None
+    #
+    # Create a header with the basic authentication.
+    headers = urllib3.make_headers(basic_auth=f'{username}:{password}')
+    auditSvms = getAuditSvms(fsxn, headers)
+    if len(auditSvms) == 0:
+        print(f"Warning: No SVMs with auditing configured found on FsID: {fsId}.")
+        return None
+
+    return (headers, auditSvms)
+
+################################################################################
+# This function processes all the new audit log files of a single SVM. It
+# is run concurrently for all the audited SVMs on all the FSxNs, and other
+# invocations of the Lambda function can be processing the same SVM at the
+# same time, so each audit file is leased before it is processed. Progress
+# is saved, and the lease renewed, at most every 'checkpointInterval'
+# seconds. If the Lambda function runs out of time, it stops at a
+# checkpoint so processing can be resumed from there.
+################################################################################
+def processAuditSvm(fsxn, headers, auditSvm):
+    global config
+
+    if outOfTime():
+        print(f"Running out of time. Skipping SVM {auditSvm['svm']} on {fsxn}.")
+        return
+
+    fsId = fsxn.split('.')[1]
+    source = f"{fsxn}/{auditSvm['svm']}"
+    headersDownload = { **headers, 'Accept': 'multipart/form-data' }
+    #
+    # Get the audit log files from the last one processed. If the volume
+    # isn't found, it may have been recreated, or auditing may have been
+    # moved to another one, so look for it again.
+    (state, version) = stateManager.read(source)
+    startName = state.get('lastFile')
+    files = listAuditFiles(fsxn, headers, auditSvm, startName)
+    if files == None:
+        auditSvm = next((newAuditSvm for newAuditSvm in getAuditSvms(fsxn, headers, refresh=True) if newAuditSvm['svm'] == auditSvm['svm']), None)
+        if auditSvm != None:
+            files = listAuditFiles(fsxn, headers, auditSvm, startName)
+
+    if auditSvm == None or files == None:
+        print(f"Warning: The audit log volume for {source} wasn't found.")
+        return
+
+    if len(files) == 0 and startName == None:
+        print(f"Warning: No audit log files found on FsID: {fsId}; SvmID: {auditSvm['svm']}; Volume: {auditSvm['volume']}.")
+        return
+
+    while not outOfTime():
+        (file, checkpoint) = stateManager.leaseNextFile(source, files)
+        if file == None:
+            return
+        fileName = file['name']
+        filePath = f"{auditSvm['directory']}/{fileName}" if auditSvm['directory'] != '' else fileName
+        #
+        # Save the checkpoints, which also renews the lease, at most every checkpointInterval seconds.
+        progress = {'checkpoint': None, 'saved': time.monotonic()}
+        def onCheckpoint(newCheckpoint, progress=progress, fileName=fileName):
+            progress['checkpoint'] = newCheckpoint
+            if time.monotonic() - progress['saved'] >= config['checkpointInterval']:
+                stateManager.saveFileProgress(source, fileName, newCheckpoint)
+                progress['saved'] = time.monotonic()
+        #
+        # Process the file. If it fails, save how far it got, and release the
+        # lease, so it can be picked up again without waiting for the lease to expire.
+        try:
+            completed = processFile(fsxn, headersDownload, auditSvm['uuid'], filePath, file.get('size'), checkpoint, onCheckpoint)
+        except LeaseLost:
+            raise
+        except Exception:
+            stateManager.saveFileProgress(source, fileName, progress['checkpoint'], release=True)
+            raise
+
+        if not completed:
+            print(f"Running out of time. Stopping {source} in {fileName}.")
+            stateManager.saveFileProgress(source, fileName, progress['checkpoint'], release=True)
+            return
+        stateManager.saveFileProgress(source, fileName, done=True)
+
+    print(f"Running out of time. Stopping {source}.")
 
 ################################################################################
 # This is the main function that checks that everything is configured correctly
 # and then processes all the FSxNs.
 ################################################################################
 def lambda_handler(event, context):     # pylint: disable=W0613
-    global http, cwLogsClient, config
+    global http, cwLogsClient, archiveS3Client, config, stateManager, deadline, createCWEvent, getLogStreamName, matchEventFilter, auditAggregator
     #
     # Check that we have all the configuration variables we need.
     checkConfig()
     #
+    # Create the function that formats the events.
+    createCWEvent = compileCWEventFormatter(config['outputFormat'], config['outputFields'], config['emfNamespace'])
+    getLogStreamName = compileLogStreamNamer(config['logStreamStrategy'])
+    matchEventFilter = compileEventFilter(config['eventFilters'])
+    with eventFilterDropsLock:
+        eventFilterDrops.clear()
+        eventFilterDropBytes.clear()
+    #
+    # Leave enough time before the Lambda function times out to finish
+    # uploading the events that have been read, and to save a checkpoint.
+    # With a short timeout, leave a quarter of it instead.
+    if context != None:
+        remainingTime = context.get_remaining_time_in_millis() / 1000
+        deadline = time.monotonic() + remainingTime - min(config['timeLimitMargin'], remainingTime / 4)
+    else:
+        deadline = None
+    #
     # Create a Secrets Manager client.
     session = boto3.session.Session()
     secretsClient = session.client(service_name='secretsmanager', region_name=config['secretRegion'])
@@ -284,21 +1805,41 @@ def lambda_handler(event, context):     # pylint: disable=W0613
     # Get the fsxadmin passwords for all the file systems.
     secretsInfo = secretsClient.get_secret_value(SecretId=config['secretArn'])
     secrets = json.loads(secretsInfo['SecretString'])
-    username = "fsxadmin"
     #
     # Create a S3 client.
     s3Client = boto3.client('s3', config['s3BucketRegion'])
     #
+    # Create a S3 client for the archive. The endpoint can be set to use an S3
+    # compatible service, like a local one for testing.
+    if config['archiveBucketName'] != None:
+        archiveS3Client = boto3.client('s3', config['archiveBucketRegion'], endpoint_url=config['archiveS3EndpointUrl'])
+    #
     # Create a FSx client.
     fsxClient = boto3.client('fsx', config['fsxRegion'])
     #
-    # Create a CloudWatch client.
-    cwLogsClient = boto3.client('logs', config['fsxRegion'])
+    # Create a CloudWatch client. It is shared by all the threads processing
+    # the SVMs, so make sure it has enough connections for them.
+    cwLogsClient = boto3.client('logs', config['fsxRegion'], config=Config(max_pool_connections=max(10, config['fileSystemParallelism'])))
+    #
+    # The aggregates combine the events from all the audit files of a file
+    # system, so their summaries are sent by their own batcher.
+    if config['aggregateFields'] != None:
+        aggregateBatcher = CWLogBatcher(config['logGroupName'])
+        def onSummary(summary, timestamp):
+            for cwEvent in formatAggregateSummary(summary, timestamp, config['aggregateOutput'], config['emfNamespace']):
+                aggregateBatcher.add(cwEvent, None, f"{summary['fs']}/aggregates")
+        auditAggregator = AuditAggregator(config['aggregateFields'], config['aggregateInterval'], config['aggregateTopN'], onSummary)
+    else:
+        auditAggregator = None
     #
     # Disable warning about connecting to servers with self-signed SSL certificates.
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
+    #
+    # The connection pool is shared by all the threads, and several SVMs on
+    # the same FSxN can be processed at once, so allow a connection per
+    # concurrent download, per SVM being processed.
+    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries, num_pools=max(10, config['fileSystemParallelism']), maxsize=config['downloadParallelism'] * config['fileSystemParallelism'])
     #
     # Get a list of FSxNs in the region.
     fsxNs = []   # Holds the FQDN of the FSxNs management ports.
@@ -312,64 +1853,62 @@ def lambda_handler(event, context):     # pylint: disable=W0613
         for fsx in fsxResponse['FileSystems']:
             fsxNs.append(fsx['OntapConfiguration']['Endpoints']['Management']['DNSName'])
     #
-    # Get the last read stats file.
+    # The state of each FSxN, and SVM, is kept in its own object, so several
+    # invocations of the Lambda function can work on them at the same time.
+    if config['stateDirectory'] != None:
+        stateStore = LocalStateStore(os.path.join(config['stateDirectory'], config['statsName']))
+    else:
+        stateStore = S3StateStore(s3Client, config['s3BucketName'], config['statsName'] + '/', config['concurrentInvocations'])
+    workerId = context.aws_request_id if context != None else f"{os.uname().nodename}-{os.getpid()}-{time.time()}"
+    #
+    # Older versions of this script kept the state for all the FSxNs in a
+    # single stats file. If it exists, it is used to start the state of any
+    # FSxN that doesn't have one yet.
     try:
         response = s3Client.get_object(Bucket=config['s3BucketName'], Key=config['statsName'])
     except botocore.exceptions.ClientError as err:
-        #
-        # If the error is that the object doesn't exist, then this must be the
-        # first time this script has run so create an empty lastFileRead.
         if err.response['Error']['Code'] == "NoSuchKey":
-            lastFileRead = {}
+            legacyLastFileRead = {}
         else:
             raise err
     else:
-        lastFileRead = json.loads(response['Body'].read().decode('utf-8'))
+        legacyLastFileRead = json.loads(response['Body'].read().decode('utf-8'))
+    stateManager = StateManager(stateStore, workerId, config['leaseDuration'], legacyLastFileRead, config['vserverName'])
     #
-    # Process each FSxN.
-    for fsxn in fsxNs:
-        fsId = fsxn.split('.')[1]
-        #
-        # Get the password
-        password = secrets.get(fsId)
-        if password == None:
-            print(f'Warning: No password found for {fsId}.')
-            continue
-        #
-        # Create a header with the basic authentication.
-        auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
-        headersDownload = { **auth, 'Accept': 'multipart/form-data' }
-        headersQuery = { **auth }
-        #
-        # Get the volume UUID for the audit_logs volume.
-        volumeUUID = None
-        endpoint = f"https://{fsxn}/api/storage/volumes?name={config['volumeName']}&svm={config['vserverName']}"
-        response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-        if response.status == 200:
-            data = json.loads(response.data.decode('utf-8'))
-            if data['num_records'] > 0:
-                volumeUUID = data['records'][0]['uuid']  # Since we specified the volume, and vserver name, there should only be one record.
-
-        if volumeUUID == None:
-            print(f"Warning: Volume {config['volumeName']} not found for {fsId} under SVM: {config['vserverName']}.")
-            continue
-        #
-        # Get all the files in the volume that match the audit file pattern.
-        endpoint = f"https://{fsxn}/api/storage/volumes/{volumeUUID}/files?name=audit_{config['vserverName']}_D*.xml&order_by=name%20asc&fields=name"
-        response = http.request('GET', endpoint, headers=headersQuery, timeout=5.0)
-        data = json.loads(response.data.decode('utf-8'))
-        if data.get('num_records') == 0:
-            print(f"Warning: No XML audit log files found on FsID: {fsId}; SvmID: {config['vserverName']}; Volume: {config['volumeName']}.")
-            continue
+    # Find the audited SVMs on the FSxNs concurrently, and as they are found,
+    # process them concurrently too. A failure with one FSxN, or SVM, doesn't
+    # stop the others from being processed.
+    failedSources = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config['fileSystemParallelism']) as executor:
+        futures = {executor.submit(prepareFileSystem, fsxn, secrets): (fsxn, None) for fsxn in fsxNs}
+        while len(futures) > 0:
+            (done, notDone) = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (fsxn, svm) = futures.pop(future)
+                source = fsxn if svm == None else f"{fsxn}/{svm}"
+                try:
+                    result = future.result()
+                except LeaseLost as err:
+                    print(f'Warning: Stopped processing {source}: {err}')
+                except Exception as err:
+                    print(f'Error: Failed to process {source}: {err}')
+                    failedSources.append(source)
+                else:
+                    if svm == None and result != None:
+                        (headers, auditSvms) = result
+                        for auditSvm in auditSvms:
+                            futures[executor.submit(processAuditSvm, fsxn, headers, auditSvm)] = (fsxn, auditSvm['svm'])
 
-        for file in data['records']:
-            filePath = file['name']
-            if lastFileRead.get(fsxn) == None or getEpoch(filePath) > lastFileRead[fsxn]:
-                #
-                # Process the file.
-                processFile(fsxn, headersDownload, volumeUUID, filePath)
-                lastFileRead[fsxn] = getEpoch(filePath)
-                s3Client.put_object(Key=config['statsName'], Bucket=config['s3BucketName'], Body=json.dumps(lastFileRead).encode('UTF-8'))
+    if auditAggregator != None:
+        auditAggregator.close()
+        aggregateBatcher.close()
+        print(f"Sent {auditAggregator.summaries} aggregate summaries.")
+
+    if len(eventFilterDrops) > 0:
+        print(f"In total, the event filters dropped {describeEventFilterDrops(eventFilterDrops, eventFilterDropBytes)}.")
+
+    if len(failedSources) > 0:
+        raise Exception(f'Failed to process the following FSxNs and SVMs: {", ".join(failedSources)}.')
 #
 # If this script is not running as a Lambda function, then call the lambda_handler function.
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') == None:
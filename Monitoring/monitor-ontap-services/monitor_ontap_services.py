@@ -26,8 +26,10 @@ import json
 import re
 import os
 import datetime
+import time
+import gzip
+import base64
 import logging
-from logging.handlers import SysLogHandler
 import urllib3
 from urllib3.util import Retry
 import botocore
@@ -42,6 +44,39 @@ eventResilience = 4 # Times an event has to be missing before it is removed
 initialVersion = "Initial Run"  # The version to store if this is the first
                                 # time the program has been run against a
                                 # FSxN.
+#
+# The AWS clients, HTTP connection pool, and ONTAP credentials are created on
+# first use and then reused by subsequent invocations of the Lambda function.
+s3Client = None
+snsClient = None
+secretsClient = None
+http = None
+headers = None
+#
+# The ONTAP API endpoints, and the fields from them, that each service uses.
+# They are declared before any of the services run, so the first API call to
+# an endpoint retrieves all the fields any of the rules will need from it,
+# and the calls made for the other rules can be served from the cache.
+serviceOntapFields = {
+    "systemhealth": [("/api/network/ip/interfaces", ["state"])],
+    "snapmirror": [("/api/snapmirror/relationships", ["*"])],
+    "storage": [("/api/storage/aggregates", ["space"]), ("/api/storage/volumes", ["space", "svm"])],
+    "quota": [("/api/storage/quota/reports", ["*"])]
+}
+#
+# The per run ONTAP API response cache. See ontapGet() for more information.
+ontapCache = {}
+ontapDeclaredFields = {}
+ontapCacheStats = {"apiCalls": 0, "cacheHits": 0}
+#
+# The alert severities, from most to least severe. Alerts at, or above, the
+# alertDigestBypassSeverity are always sent immediately.
+alertSeverities = ["emergency", "alert", "critical", "error", "warning", "notice", "informational", "debug"]
+pendingAlerts = []  # Alerts waiting to be added to a digest. See sendAlert().
+#
+# The ONTAP API calls recorded, or to be replayed, during this run. See ontapRequest().
+ontapRecording = []
+ontapReplay = {}
 
 ################################################################################
 # This function is used to extract the one-, two-, or three-digit number from
@@ -139,6 +174,352 @@ def eventExist (events, uniqueIdentifier):
 
     return False
 
+################################################################################
+# This function resets the ONTAP API response cache. It should be called at
+# the start of each run, since a Lambda function can reuse the global
+# variables from a previous invocation.
+################################################################################
+def resetOntapCache():
+    global ontapCache, ontapDeclaredFields, ontapCacheStats
+
+    ontapCache = {}
+    ontapDeclaredFields = {}
+    ontapCacheStats = {"apiCalls": 0, "cacheHits": 0}
+
+################################################################################
+# This function is used by the services to declare the fields they need from
+# an ONTAP API endpoint. All the fields declared for the same endpoint are
+# merged together into a single "fields=" request.
+################################################################################
+def declareOntapFields(path, fields):
+
+    if ontapDeclaredFields.get(path) == None:
+        ontapDeclaredFields[path] = set()
+    ontapDeclaredFields[path].update(fields)
+
+################################################################################
+# This function returns True if a response retrieved with the 'have' fields
+# can satisfy a request for the 'want' fields. A value of None means that
+# no fields were specified, so ONTAP returned its default set of fields.
+################################################################################
+def fieldsCovered(have, want):
+
+    if have == None or want == None:
+        return have == want
+
+    return "*" in have or want.issubset(have)
+
+################################################################################
+# This function issues a GET API call to the ONTAP cluster and returns the
+# response. If ontapReplayFilename is set, the response is served from the
+# API calls recorded by a previous run instead, so no access to the cluster
+# is needed. If ontapRecordFilename is set, the API call and its response are
+# added to the recording that saveOntapRecording() will store. Only the path
+# of the API call, and the status and body of the response, are recorded. In
+# other words, the hostname and credentials are never recorded.
+################################################################################
+def ontapRequest(requestPath, timeout):
+    global config, http, headers, ontapRecording, ontapReplay
+
+    if config["ontapReplayFilename"] != None:
+        recordings = ontapReplay.get(requestPath)
+        if recordings == None:
+            recorded = None
+        elif len(recordings) > 1:
+            recorded = recordings.pop(0)
+        else:
+            recorded = recordings[0]  # Keep serving the last response for any additional calls.
+
+        if recorded == None:
+            print(f'Warning: No recorded response found for {requestPath}.')
+            return urllib3.HTTPResponse(body=b'{"error": {"message": "No recorded response found."}}', status=404, preload_content=True)
+
+        if config["ontapReplayLatency"] == "realistic":
+            time.sleep(recorded["elapsed"])
+
+        if recorded.get("bodyEncoding") == "base64":
+            body = base64.b64decode(recorded["body"])
+        else:
+            body = recorded["body"].encode('UTF-8')
+        return urllib3.HTTPResponse(body=body, status=recorded["status"], preload_content=True)
+
+    endpoint = f'https://{config["OntapAdminServer"]}{requestPath}'
+    startTime = time.monotonic()
+    if timeout != None:
+        response = http.request('GET', endpoint, headers=headers, timeout=timeout)
+    else:
+        response = http.request('GET', endpoint, headers=headers)
+    #
+    # Since the credentials are reused between runs, get them again, and
+    # retry the API call, in case the secret has been rotated.
+    if response.status == 401 and getOntapHeaders(refresh=True) != None:
+        if timeout != None:
+            response = http.request('GET', endpoint, headers=headers, timeout=timeout)
+        else:
+            response = http.request('GET', endpoint, headers=headers)
+
+    if config["ontapRecordFilename"] != None:
+        recorded = {
+            "method": "GET",
+            "path": requestPath,
+            "status": response.status,
+            "elapsed": round(time.monotonic() - startTime, 6)
+            }
+        try:
+            recorded["body"] = response.data.decode('UTF-8')
+        except UnicodeDecodeError:
+            recorded["body"] = base64.b64encode(response.data).decode('UTF-8')
+            recorded["bodyEncoding"] = "base64"
+        ontapRecording.append(recorded)
+
+    return response
+
+################################################################################
+# This function reads the ONTAP API calls, recorded by a previous run, from
+# the ontapReplayFilename S3 object. The recording is a gzip compressed file
+# with one JSON object per line, per API call.
+################################################################################
+def loadOntapRecording():
+    global config, s3Client, ontapReplay
+
+    data = s3Client.get_object(Key=config["ontapReplayFilename"], Bucket=config["s3BucketName"])
+    ontapReplay = {}
+    for line in gzip.decompress(data["Body"].read()).decode('UTF-8').splitlines():
+        if line.strip() == "":
+            continue
+        recorded = json.loads(line)
+        if ontapReplay.get(recorded["path"]) == None:
+            ontapReplay[recorded["path"]] = []
+        ontapReplay[recorded["path"]].append(recorded)
+    print(f'Replaying ONTAP API calls from s3://{config["s3BucketName"]}/{config["ontapReplayFilename"]}.')
+
+################################################################################
+# This function stores the ONTAP API calls recorded during this run in the
+# ontapRecordFilename S3 object.
+################################################################################
+def saveOntapRecording():
+    global config, s3Client, ontapRecording
+
+    if config["ontapRecordFilename"] == None:
+        return
+
+    lines = [json.dumps(recorded) for recorded in ontapRecording]
+    ontapRecording = []
+    body = gzip.compress(("\n".join(lines) + "\n").encode('UTF-8'))
+    s3Client.put_object(Key=config["ontapRecordFilename"], Bucket=config["s3BucketName"], Body=body)
+    print(f'Recorded {len(lines)} ONTAP API calls to s3://{config["s3BucketName"]}/{config["ontapRecordFilename"]}.')
+
+################################################################################
+# This function returns the ONTAP API cache statistics for the current run.
+################################################################################
+def getOntapCacheStats():
+
+    return dict(ontapCacheStats)
+
+################################################################################
+# This function makes a GET API call to the ONTAP cluster and returns the
+# response. The responses are cached for the duration of a single run, so
+# if the same information is needed more than once (e.g. the warning and
+# critical percent used rules of the storage service both need the
+# aggregates, and the volumes, and the version change rule of the
+# systemHealth service uses the /api/cluster response retrieved by
+# checkSystem()) only one API call is made. If the fields are specified,
+# they are merged with the ones declared, by the services, for the same
+# endpoint. Only successful responses are cached. Since the services run
+# one after another, there is never an identical request in flight when
+# this is called, so there is no need to coalesce them.
+################################################################################
+def ontapGet(path, fields=None, timeout=None):
+    global config, http, headers, ontapCacheStats
+
+    if fields != None:
+        want = set(fields)
+        if ontapDeclaredFields.get(path) != None:
+            want.update(ontapDeclaredFields[path])
+        if "*" in want:
+            want = {"*"}
+        want = frozenset(want)
+    else:
+        want = None
+
+    for (have, response) in ontapCache.get(path, []):
+        if fieldsCovered(have, want):
+            ontapCacheStats["cacheHits"] += 1
+            return response
+
+    requestPath = path
+    if want != None:
+        separator = "&" if "?" in path else "?"
+        requestPath += f'{separator}fields={",".join(sorted(want))}'
+    response = ontapRequest(requestPath, timeout)
+
+    ontapCacheStats["apiCalls"] += 1
+    if response.status == 200:
+        if ontapCache.get(path) == None:
+            ontapCache[path] = []
+        ontapCache[path].append((want, response))
+
+    return response
+
+################################################################################
+# This function returns the SNS client, creating it the first time it is
+# needed. Since most runs don't send any alerts, this saves having to create
+# it on every run.
+################################################################################
+def getSnsClient():
+    global config, snsClient
+
+    if snsClient == None:
+        snsRegion = config["snsTopicArn"].split(":")[3]
+        snsClient = boto3.client('sns', region_name=snsRegion, endpoint_url=f'https://{config["snsEndPointHostname"]}')
+
+    return snsClient
+
+################################################################################
+# This function returns the HTTP headers, with the ONTAP credentials, to use
+# with the ONTAP API calls. The credentials are retrieved from the Secrets
+# Manager the first time they are needed, or if 'refresh' is True (e.g. the
+# secret was rotated), and are otherwise reused from the previous invocation.
+# It returns None if the credentials couldn't be found in the secret.
+################################################################################
+def getOntapHeaders(refresh=False):
+    global config, secretsClient, headers
+
+    if headers != None and not refresh:
+        return headers
+
+    if secretsClient == None:
+        secretRegion = config["secretArn"].split(":")[3]
+        secretsClient = boto3.client('secretsmanager', region_name=secretRegion, endpoint_url=f'https://{config["secretsManagerEndPointHostname"]}')
+    #
+    # Get the username and password of the ONTAP/FSxN system.
+    secretsInfo = secretsClient.get_secret_value(SecretId=config["secretArn"])
+    secrets = json.loads(secretsInfo['SecretString'])
+    if secrets.get(config['secretUsernameKey']) == None:
+        print(f'Error, "{config["secretUsernameKey"]}" not found in secret "{config["secretArn"]}".')
+        headers = None
+        return None
+
+    if secrets.get(config['secretPasswordKey']) == None:
+        print(f'Error, "{config["secretPasswordKey"]}" not found in secret "{config["secretArn"]}".')
+        headers = None
+        return None
+
+    username = secrets[config['secretUsernameKey']]
+    password = secrets[config['secretPasswordKey']]
+    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
+    headers = { **auth }
+    return headers
+
+################################################################################
+# This function sends an alert. If alert digests are enabled (i.e. the
+# alertDigestWindow is set) the alert is held so it can be combined with the
+# other alerts for the same cluster, service and severity into a single
+# digest message. See flushAlerts(). Alerts at, or above, the
+# alertDigestBypassSeverity are always sent immediately.
+################################################################################
+def sendAlert(service, severity, message):
+    global config, snsClient, clusterName, pendingAlerts
+
+    if severity in alertSeverities:
+        severityIndex = alertSeverities.index(severity)
+    else:
+        severityIndex = len(alertSeverities)
+
+    if config["alertDigestWindow"] == None or severityIndex <= alertSeverities.index(config["alertDigestBypassSeverity"]):
+        getSnsClient().publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+    else:
+        pendingAlerts.append({
+            "cluster": clusterName,
+            "service": service,
+            "severity": severity,
+            "time": int(datetime.datetime.now().timestamp()),
+            "message": message
+            })
+
+################################################################################
+# This function adds the alerts held by sendAlert() to the alert digests
+# that are stored in S3 and then sends any digest whose window has expired.
+# A digest holding a single alert is sent as a regular alert message.
+################################################################################
+def flushAlerts():
+    global config, s3Client, snsClient, pendingAlerts
+
+    if config["alertDigestWindow"] == None:
+        return
+
+    changedDigests = False
+    #
+    # Get the digests that are still within their window from previous runs.
+    try:
+        data = s3Client.get_object(Key=config["alertDigestFilename"], Bucket=config["s3BucketName"])
+    except botocore.exceptions.ClientError as err:
+        # If the error is that the object doesn't exist, then it will get created once an alert is held.
+        if err.response['Error']['Code'] == "NoSuchKey":
+            digests = {}
+        else:
+            raise err
+    else:
+        digests = json.loads(data["Body"].read().decode('UTF-8'))
+    #
+    # Add the new alerts to the digests.
+    for alert in pendingAlerts:
+        key = f'{alert["cluster"]}|{alert["service"]}|{alert["severity"]}'
+        if digests.get(key) == None:
+            digests[key] = {
+                "cluster": alert["cluster"],
+                "service": alert["service"],
+                "severity": alert["severity"],
+                "firstTime": alert["time"],
+                "lastTime": alert["time"],
+                "count": 0,
+                "samples": []
+                }
+        digest = digests[key]
+        digest["count"] += 1
+        digest["lastTime"] = alert["time"]
+        if len(digest["samples"]) < config["alertDigestSamples"]:
+            digest["samples"].append(alert["message"])
+        changedDigests = True
+    pendingAlerts = []
+    #
+    # Send the digests whose window has expired.
+    curTime = int(datetime.datetime.now().timestamp())
+    for key in list(digests.keys()):
+        digest = digests[key]
+        if curTime - digest["firstTime"] < config["alertDigestWindow"]:
+            continue
+
+        if digest["count"] == 1:
+            getSnsClient().publish(TopicArn=config["snsTopicArn"], Message=digest["samples"][0], Subject=f'Monitor ONTAP Services Alert for cluster {digest["cluster"]}')
+        else:
+            firstTime = datetime.datetime.fromtimestamp(digest["firstTime"], datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            lastTime = datetime.datetime.fromtimestamp(digest["lastTime"], datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            message = f'{digest["count"]} {digest["severity"]} {digest["service"]} alerts were generated for cluster {digest["cluster"]} between {firstTime} and {lastTime}.'
+            if len(digest["samples"]) < digest["count"]:
+                message += f' Here are the first {len(digest["samples"])} of them:\n\n'
+            else:
+                message += ' Here they are:\n\n'
+            message += "\n".join(digest["samples"])
+            getSnsClient().publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert Digest for cluster {digest["cluster"]}')
+        print(f'Sent digest of {digest["count"]} {digest["severity"]} {digest["service"]} alerts.')
+        del digests[key]
+        changedDigests = True
+
+    if changedDigests:
+        s3Client.put_object(Key=config["alertDigestFilename"], Bucket=config["s3BucketName"], Body=json.dumps(digests).encode('UTF-8'))
+
+################################################################################
+# This function returns the ONTAP version from the /api/cluster response
+# passed in. It assumes that the format of the "full" version looks like:
+# "NetApp Release 9.13.1P6: Tue Dec 05 16:06:25 UTC 2023". The reason for
+# looking at the "full" instead of the individual keys (generation, major,
+# minor) is because they don't provide the patch level. :-(
+################################################################################
+def getOntapVersion(data):
+
+    return data["version"]["full"].split()[2].replace(":", "")
+
 ################################################################################
 # This function makes an API call to the FSxN to ensure it is up. If the
 # errors out, then it sends an alert, and returns 'False'. Otherwise it returns
@@ -173,8 +554,8 @@ def checkSystem():
     # This is also a way to test that the FSxN cluster is accessible.
     badHTTPStatus = False
     try:
-        endpoint = f'https://{config["OntapAdminServer"]}/api/cluster?fields=version,name'
-        response = http.request('GET', endpoint, headers=headers, timeout=5.0)
+        endpoint = "/api/cluster"
+        response = ontapGet(endpoint, ["version", "name"], timeout=5.0)
         if response.status == 200:
             if not fsxStatus["systemHealth"]:
                 fsxStatus["systemHealth"] = True
@@ -185,13 +566,7 @@ def checkSystem():
                 clusterName = f'{data["name"]}({config["awsAccountId"]})'
             else:
                 clusterName = data['name']
-            #
-            # The following assumes that the format of the "full" version
-            # looks like: "NetApp Release 9.13.1P6: Tue Dec 05 16:06:25 UTC 2023".
-            # The reason for looking at the "full" instead of the individual
-            # keys (generation, major, minor) is because they don't provide
-            # the patch level. :-(
-            clusterVersion = data["version"]["full"].split()[2].replace(":", "")
+            clusterVersion = getOntapVersion(data)
             if fsxStatus["version"] == initialVersion:
                 fsxStatus["version"] = clusterVersion
         else:
@@ -209,7 +584,7 @@ def checkSystem():
             else:
                 message = f'CRITICAL: Failed to issue API against {clusterName}. Cluster could be down.'
             logger.critical(message)
-            snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+            sendAlert("systemHealth", "critical", message)
             fsxStatus["systemHealth"] = False
             changedEvents = True
 
@@ -243,33 +618,42 @@ def checkSystemHealth(service):
         for key in rule.keys():
             lkey = key.lower()
             if lkey == "versionchange":
-                if rule[key] and clusterVersion != fsxStatus["version"]:
-                    message = f'NOTICE: The ONTAP vesion changed on cluster {clusterName} from {fsxStatus["version"]} to {clusterVersion}.'
-                    logger.info(message)
-                    snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
-                    fsxStatus["version"] = clusterVersion
-                    changedEvents = True
+                if rule[key]:
+                    #
+                    # This is served from the response cached by checkSystem().
+                    endpoint = "/api/cluster"
+                    response = ontapGet(endpoint, ["version"])
+                    if response.status == 200:
+                        clusterVersion = getOntapVersion(json.loads(response.data))
+                        if clusterVersion != fsxStatus["version"]:
+                            message = f'NOTICE: The ONTAP vesion changed on cluster {clusterName} from {fsxStatus["version"]} to {clusterVersion}.'
+                            logger.info(message)
+                            sendAlert("systemHealth", "notice", message)
+                            fsxStatus["version"] = clusterVersion
+                            changedEvents = True
+                    else:
+                        print(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
             elif lkey == "failover":
                 #
                 # Check that both nodes are available.
                 # Using the CLI passthrough API because I couldn't find the equivalent API call.
                 if rule[key]:
-                    endpoint = f'https://{config["OntapAdminServer"]}/api/private/cli/system/node/virtual-machine/instance/show-settings'
-                    response = http.request('GET', endpoint, headers=headers)
+                    endpoint = "/api/private/cli/system/node/virtual-machine/instance/show-settings"
+                    response = ontapGet(endpoint)
                     if response.status == 200:
                         data = json.loads(response.data)
                         if data["num_records"] != fsxStatus["numberNodes"]:
                             message = f'Alert: The number of nodes on cluster {clusterName} went from {fsxStatus["numberNodes"]} to {data["num_records"]}.'
                             logger.info(message)
-                            snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                            sendAlert("systemHealth", "critical", message)
                             fsxStatus["numberNodes"] = data["num_records"]
                             changedEvents = True
                     else:
                         print(f'API call to {endpoint} failed. HTTP status code: {response.status}.')
             elif lkey == "networkinterfaces":
                 if rule[key]:
-                    endpoint = f'https://{config["OntapAdminServer"]}/api/network/ip/interfaces?fields=state'
-                    response = http.request('GET', endpoint, headers=headers)
+                    endpoint = "/api/network/ip/interfaces"
+                    response = ontapGet(endpoint, ["state"])
                     if response.status == 200:
                         #
                         # Decrement the refresh field to know if any events have really gone away.
@@ -283,7 +667,7 @@ def checkSystemHealth(service):
                                 if(not eventExist(fsxStatus["downInterfaces"], uniqueIdentifier)): # Resets the refresh key.
                                     message = f'Alert: Network interface {interface["name"]} on cluster {clusterName} is down.'
                                     logger.info(message)
-                                    snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                    sendAlert("systemHealth", "error", message)
                                     event = {
                                         "index": uniqueIdentifier,
                                         "refresh": eventResilience
@@ -335,8 +719,8 @@ def processEMSEvents(service):
         event["refresh"] -= 1
     #
     # Run the API call to get the current list of EMS events.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/support/ems/events'
-    response = http.request('GET', endpoint, headers=headers)
+    endpoint = "/api/support/ems/events"
+    response = ontapGet(endpoint)
     if response.status == 200:
         data = json.loads(response.data)
         #
@@ -365,7 +749,7 @@ def processEMSEvents(service):
                             print(f'Received unknown severity from ONTAP "{record["message"]["severity"]}". The message received is next.')
                             logger.info(f'Received unknown severity from ONTAP "{record["message"]["severity"]}". The message received is next.')
                             logger.info(message)
-                        snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                        sendAlert("ems", record["message"]["severity"].lower(), message)
                         changedEvents = True
                         event = {
                                 "index": record["index"],
@@ -455,8 +839,8 @@ def processSnapMirrorRelationships(service):
     curTime = int(datetime.datetime.now().timestamp())
     #
     # Run the API call to get the current state of all the snapmirror relationships.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/snapmirror/relationships?fields=*'
-    response = http.request('GET', endpoint, headers=headers)
+    endpoint = "/api/snapmirror/relationships"
+    response = ontapGet(endpoint, ["*"])
     if response.status == 200:
         data = json.loads(response.data)
 
@@ -480,7 +864,7 @@ def processSnapMirrorRelationships(service):
                                 if not eventExist(events, uniqueIdentifier):  # This resets the "refresh" field if found.
                                     message = f'Snapmirror Lag Alert: {sourceClusterName}::{record["source"]["path"]} -> {clusterName}::{record["destination"]["path"]} has a lag time of {lagSeconds} seconds.'
                                     logger.warning(message)
-                                    snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                    sendAlert("snapmirror", "warning", message)
                                     changedEvents=True
                                     event = {
                                         "index": uniqueIdentifier,
@@ -497,7 +881,7 @@ def processSnapMirrorRelationships(service):
                                 logger.warning(message)  # Intentionally put this before adding the reasons, since I'm not sure how syslog will handle a multi-line message.
                                 for reason in record["unhealthy_reason"]:
                                     message += "\n" + reason["message"]
-                                snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                sendAlert("snapmirror", "error", message)
                                 changedEvents=True
                                 event = {
                                     "index": uniqueIdentifier,
@@ -524,7 +908,7 @@ def processSnapMirrorRelationships(service):
                                         if not eventExist(events, uniqueIdentifier):
                                             message = f'Snapmiorror transfer has stalled: {sourceClusterName}::{sourcePath} -> {clusterName}::{destPath}.'
                                             logger.warning(message)
-                                            snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject='Monitor ONTAP Services Alert for cluster {clusterName}')
+                                            sendAlert("snapmirror", "warning", message)
                                             changedEvents=True
                                             event = {
                                                 "index": uniqueIdentifier,
@@ -616,8 +1000,8 @@ def processStorageUtilization(service):
             if lkey == "aggrwarnpercentused" or lkey == 'aggrcriticalpercentused':
                 #
                 # Run the API call to get the physical storage used.
-                endpoint = f'https://{config["OntapAdminServer"]}/api/storage/aggregates?fields=space'
-                response = http.request('GET', endpoint, headers=headers)
+                endpoint = "/api/storage/aggregates"
+                response = ontapGet(endpoint, ["space"])
                 if response.status == 200:
                     data = json.loads(response.data)
                     for aggr in data["records"]:
@@ -627,7 +1011,7 @@ def processStorageUtilization(service):
                                 alertType = 'Warning' if lkey == "aggrwarnpercentused" else 'Critical'
                                 message = f'Aggregate {alertType} Alert: Aggregate {aggr["name"]} on {clusterName} is {aggr["space"]["block_storage"]["used_percent"]}% full, which is more or equal to {rule[key]}% full.'
                                 logger.warning(message)
-                                snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                sendAlert("storage", alertType.lower(), message)
                                 changedEvents = True
                                 event = {
                                         "index": uniqueIdentifier,
@@ -641,8 +1025,8 @@ def processStorageUtilization(service):
             elif lkey == "volumewarnpercentused" or lkey == "volumecriticalpercentused":
                 #
                 # Run the API call to get the volume information.
-                endpoint = f'https://{config["OntapAdminServer"]}/api/storage/volumes?fields=space,svm'
-                response = http.request('GET', endpoint, headers=headers)
+                endpoint = "/api/storage/volumes"
+                response = ontapGet(endpoint, ["space", "svm"])
                 if response.status == 200:
                     data = json.loads(response.data)
                     for record in data["records"]:
@@ -653,7 +1037,7 @@ def processStorageUtilization(service):
                                     alertType = 'Warning' if lkey == "volumewarnpercentused" else 'Critical'
                                     message = f'Volume Usage {alertType} Alert: volume {record["svm"]["name"]}:/{record["name"]} on {clusterName} is {record["space"]["percent_used"]}% full, which is more or equal to {rule[key]}% full.'
                                     logger.warning(message)
-                                    snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                    sendAlert("storage", alertType.lower(), message)
                                     changedEvents = True
                                     event = {
                                             "index": uniqueIdentifier,
@@ -711,8 +1095,8 @@ def processQuotaUtilization(service):
         event["refresh"] -= 1
     #
     # Run the API call to get the quota report.
-    endpoint = f'https://{config["OntapAdminServer"]}/api/storage/quota/reports?fields=*'
-    response = http.request('GET', endpoint, headers=headers)
+    endpoint = "/api/storage/quota/reports"
+    response = ontapGet(endpoint, ["*"])
     if response.status == 200:
         data = json.loads(response.data)
         for record in data["records"]:
@@ -743,7 +1127,7 @@ def processQuotaUtilization(service):
                                     user=''
                                 message = f'Quota Inode Usage Alert: Quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["files"]["used"]["hard_limit_percent"]}% which is more than {rule[key]}% of its inodes.'
                                 logger.warning(message)
-                                snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                sendAlert("quota", "warning", message)
                                 changedEvents=True
                                 event = {
                                         "index": uniqueIdentifier,
@@ -773,7 +1157,7 @@ def processQuotaUtilization(service):
                                     user=''
                                 message = f'Quota Space Usage Alert: Hard quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["space"]["used"]["hard_limit_percent"]}% which is more than {rule[key]}% of its allocaed space.'
                                 logger.warning(message)
-                                snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                sendAlert("quota", "warning", message)
                                 changedEvents=True
                                 event = {
                                         "index": uniqueIdentifier,
@@ -803,7 +1187,7 @@ def processQuotaUtilization(service):
                                     user=''
                                 message = f'Quota Space Usage Alert: Soft quota of type "{record["type"]}" on {record["svm"]["name"]}:/{record["volume"]["name"]}{qtree}{user}on {clusterName} is using {record["space"]["used"]["soft_limit_percent"]}% which is more than {rule[key]}% of its allocaed space.'
                                 logger.info(message)
-                                snsClient.publish(TopicArn=config["snsTopicArn"], Message=message, Subject=f'Monitor ONTAP Services Alert for cluster {clusterName}')
+                                sendAlert("quota", "notice", message)
                                 changedEvents=True
                                 event = {
                                     "index": uniqueIdentifier,
@@ -956,7 +1340,13 @@ def readInConfig():
         "secretsManagerEndPointHostname": None,
         "snsEndPointHostname": None,
         "syslogIP": None,
-        "awsAccountId": None
+        "awsAccountId": None,
+        "alertDigestWindow": None,
+        "alertDigestSamples": None,
+        "alertDigestBypassSeverity": None,
+        "ontapRecordFilename": None,
+        "ontapReplayFilename": None,
+        "ontapReplayLatency": None
         }
 
     filenameVariables = {
@@ -966,7 +1356,8 @@ def readInConfig():
         "conditionsFilename": None,
         "storageEventsFilename": None,
         "quotaEventsFilename": None,
-        "systemStatusFilename": None
+        "systemStatusFilename": None,
+        "alertDigestFilename": None
         }
 
     config = {
@@ -992,8 +1383,9 @@ def readInConfig():
         if config[var] == None:
             raise Exception (f'\n\nMissing required environment variable "{var}".')
     #
-    # Open a client to the s3 service.
-    s3Client = boto3.client('s3', config["s3BucketRegion"])
+    # Open a client to the s3 service, if one wasn't created by a previous invocation.
+    if s3Client == None:
+        s3Client = boto3.client('s3', config["s3BucketRegion"])
     #
     # Calculate the config filename if it hasn't already been provided.
     defaultConfigFilename = config["OntapAdminServer"] + "-config"
@@ -1060,6 +1452,30 @@ def readInConfig():
     if config["snsEndPointHostname"] == None or config["snsEndPointHostname"] == "":
         config["snsEndPointHostname"] = f'sns.{snsRegion}.amazonaws.com'
     #
+    # Set the alert digest defaults.
+    if config["alertDigestWindow"] != None:
+        config["alertDigestWindow"] = int(config["alertDigestWindow"])
+    if config["alertDigestSamples"] == None:
+        config["alertDigestSamples"] = 10
+    else:
+        config["alertDigestSamples"] = int(config["alertDigestSamples"])
+    if config["alertDigestBypassSeverity"] == None:
+        config["alertDigestBypassSeverity"] = "critical"
+    else:
+        config["alertDigestBypassSeverity"] = config["alertDigestBypassSeverity"].lower()
+        if config["alertDigestBypassSeverity"] not in alertSeverities:
+            raise Exception(f'Unknown alertDigestBypassSeverity "{config["alertDigestBypassSeverity"]}". It must be one of: {", ".join(alertSeverities)}.')
+    #
+    # Set the ONTAP API record and replay defaults.
+    if config["ontapReplayLatency"] == None:
+        config["ontapReplayLatency"] = "zero"
+    else:
+        config["ontapReplayLatency"] = config["ontapReplayLatency"].lower()
+        if config["ontapReplayLatency"] not in ["zero", "realistic"]:
+            raise Exception(f'Unknown ontapReplayLatency "{config["ontapReplayLatency"]}". It must be either "zero" or "realistic".')
+    if config["ontapRecordFilename"] != None and config["ontapReplayFilename"] != None:
+        raise Exception('Only one of "ontapRecordFilename" or "ontapReplayFilename" can be set.')
+    #
     # Now, check that all the configuration parameters have been set.
     for key in config:
         if config[key] == None and key not in optionalVariables:
@@ -1071,7 +1487,7 @@ def readInConfig():
 def lambda_handler(event, context):
     #
     # Define global variables so we don't have to pass them to all the functions.
-    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger
+    global config, s3Client, snsClient, http, headers, clusterName, clusterVersion, logger, ontapRecording
     #
     # Read in the configuraiton.
     readInConfig()   # This defines the s3Client variable.
@@ -1079,7 +1495,7 @@ def lambda_handler(event, context):
     # Set up loging.
     logger = logging.getLogger("mon_fsxn_service")
     logger.setLevel(logging.DEBUG)       # Anything at this level and above this get logged.
-    if config["syslogIP"] != None:
+    if config["syslogIP"] != None and len(logger.handlers) == 0:  # The handler is kept between invocations.
         #
         # Due to a bug with the SysLogHandler() of not sending proper framing with a message
         # when using TCP (it should end it with a LF and not a NUL like it does now) you must add 
@@ -1104,7 +1520,10 @@ def lambda_handler(event, context):
         #
         # You might get away with a simple handler.open() after the close(), without having to
         # remove and add the handler. I didn't test that.
-        handler = logging.handlers.SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(config["syslogIP"], 514))
+        #
+        # The import is done here since it is only needed when sending syslog messages.
+        from logging.handlers import SysLogHandler
+        handler = SysLogHandler(facility=SysLogHandler.LOG_LOCAL0, address=(config["syslogIP"], 514))
         formatter = logging.Formatter(
                 fmt="%(name)s:%(funcName)s - Level:%(levelname)s - Message:%(message)s",
                 datefmt="%Y-%m-%d %H:%M:%S"
@@ -1112,38 +1531,20 @@ def lambda_handler(event, context):
         handler.setFormatter(formatter)
         logger.addHandler(handler)
     #
-    # Create a Secrets Manager client.
-    session = boto3.session.Session()
-    secretRegion = config["secretArn"].split(":")[3]
-    client = session.client(service_name='secretsmanager', region_name=secretRegion, endpoint_url=f'https://{config["secretsManagerEndPointHostname"]}')
-    #
-    # Get the username and password of the ONTAP/FSxN system.
-    secretsInfo = client.get_secret_value(SecretId=config["secretArn"])
-    secrets = json.loads(secretsInfo['SecretString'])
-    if secrets.get(config['secretUsernameKey']) == None:
-        print(f'Error, "{config["secretUsernameKey"]}" not found in secret "{config["secretArn"]}".')
-        return
-
-    if secrets.get(config['secretPasswordKey']) == None:
-        print(f'Error, "{config["secretPasswordKey"]}" not found in secret "{config["secretArn"]}".')
+    # The ONTAP credentials aren't needed when replaying recorded API calls.
+    if config["ontapReplayFilename"] != None:
+        loadOntapRecording()
+        headers = {}
+    elif getOntapHeaders() == None:
         return
-
-    username = secrets[config['secretUsernameKey']]
-    password = secrets[config['secretPasswordKey']]
-    #
-    # Create clients to the other AWS services we will be using.
-    #s3Client = boto3.client('s3', config["s3BucketRegion"])  # Defined in readInConfig()
-    snsRegion = config["snsTopicArn"].split(":")[3]
-    snsClient = boto3.client('sns', region_name=snsRegion, endpoint_url=f'https://{config["snsEndPointHostname"]}')
-    #
-    # Create a http handle to make ONTAP/FSxN API calls with.
-    auth = urllib3.make_headers(basic_auth=f'{username}:{password}')
-    headers = { **auth }
     #
-    # Disable warning about connecting to servers with self-signed SSL certificates.
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-    retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
+    # Create a http handle to make ONTAP/FSxN API calls with, if one wasn't created by a previous invocation.
+    if http == None:
+        #
+        # Disable warning about connecting to servers with self-signed SSL certificates.
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        retries = Retry(total=None, connect=1, read=1, redirect=10, status=0, other=0)  # pylint: disable=E1123
+        http = urllib3.PoolManager(cert_reqs='CERT_NONE', retries=retries)
     #
     # Get the conditions we know what to alert on.
     try:
@@ -1157,23 +1558,48 @@ def lambda_handler(event, context):
             s3Client.put_object(Key=config["conditionsFilename"], Bucket=config["s3BucketName"], Body=json.dumps(matchingConditions, indent=4).encode('UTF-8'))
     else:
         matchingConditions = json.loads(data["Body"].read().decode('UTF-8'))
+    #
+    # Start with an empty ONTAP API response cache and have each of the
+    # configured services declare the fields they need from the cluster.
+    resetOntapCache()
+    ontapRecording = []
+    declareOntapFields("/api/cluster", ["version", "name"])
+    for service in matchingConditions["services"]:
+        for (path, fields) in serviceOntapFields.get(service["name"].lower(), []):
+            declareOntapFields(path, fields)
 
-    if(checkSystem()):
+    #
+    # Each service stores its events file, which records its alerts as sent,
+    # before the next service runs. So, the held alerts have to be added to
+    # the digests even if a later service, or checkSystem(), raises an
+    # exception, otherwise they would never be sent.
+    try:
+        if(checkSystem()):
+            #
+            # Loop on all the configured ONTAP services we want to check on.
+            for service in matchingConditions["services"]:
+                if service["name"].lower() == "systemhealth":
+                    checkSystemHealth(service)
+                elif service["name"].lower() == "ems":
+                    processEMSEvents(service)
+                elif (service["name"].lower() == "snapmirror"):
+                    processSnapMirrorRelationships(service)
+                elif service["name"].lower() == "storage":
+                    processStorageUtilization(service)
+                elif service["name"].lower() == "quota":
+                    processQuotaUtilization(service)
+                else:
+                    print(f'Unknown service "{service["name"]}".')
+    finally:
         #
-        # Loop on all the configured ONTAP services we want to check on.
-        for service in matchingConditions["services"]:
-            if service["name"].lower() == "systemhealth":
-                checkSystemHealth(service)
-            elif service["name"].lower() == "ems":
-                processEMSEvents(service)
-            elif (service["name"].lower() == "snapmirror"):
-                processSnapMirrorRelationships(service)
-            elif service["name"].lower() == "storage":
-                processStorageUtilization(service)
-            elif service["name"].lower() == "quota":
-                processQuotaUtilization(service)
-            else:
-                print(f'Unknown service "{service["name"]}".')
+        # Add the held alerts to the digests and send any digest whose window has expired.
+        flushAlerts()
+    #
+    # Store any ONTAP API calls recorded during this run.
+    saveOntapRecording()
+
+    stats = getOntapCacheStats()
+    print(f'ONTAP API statistics: {stats["apiCalls"]} API calls, {stats["cacheHits"]} cache hits.')
     return
 
 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') == None:
@@ -0,0 +1,106 @@
+#!/bin/python3
+################################################################################
+# This program is used to measure the "cold start" cost of the
+# monitor_ontap_services.py program. It reports:
+#   o The modules that take the longest to import, in the same style as
+#     "python -X importtime".
+#   o The average time it takes to start a new Python interpreter and import
+#     the program, compared to just starting the interpreter.
+#   o The time it takes to create each of the AWS clients the program uses.
+#     Every "cold" run creates the S3 and Secrets Manager clients, but since
+#     the program creates the SNS client only when it sends an alert, and
+#     reuses all the clients between invocations, a cold run that doesn't
+#     send any alerts doesn't pay for the SNS client, and a "warm" run
+#     doesn't pay for any of them.
+#
+# It doesn't make any AWS or ONTAP API calls, so it can be run anywhere
+# that has the same Python packages installed as the Lambda function.
+#
+# Usage: startup_benchmark.py [-r runs] [-t top]
+################################################################################
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+programDir = os.path.dirname(os.path.abspath(__file__))
+programModule = "monitor_ontap_services"
+
+################################################################################
+# This function runs a new Python interpreter with the arguments passed in
+# and returns the completed process and the elapsed wall clock time.
+################################################################################
+def runPython(args):
+    #
+    # Setting AWS_LAMBDA_FUNCTION_NAME prevents the program from calling its
+    # lambda_handler() function when it is imported.
+    env = { **os.environ, "AWS_LAMBDA_FUNCTION_NAME": "startup_benchmark" }
+    startTime = time.perf_counter()
+    process = subprocess.run([sys.executable] + args, cwd=programDir, env=env, capture_output=True, text=True)
+    return (process, time.perf_counter() - startTime)
+
+################################################################################
+# This function parses the output from "python -X importtime" and returns a
+# list of (self, cumulative, module) tuples, in microseconds.
+################################################################################
+def parseImportTime(output):
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        imports.append((int(fields[0]), int(fields[1]), fields[2].rstrip()))
+
+    return imports
+
+################################################################################
+# Main logic
+################################################################################
+parser = argparse.ArgumentParser(description="Measure the cold start cost of the monitor_ontap_services.py program.")
+parser.add_argument("-r", "--runs", type=int, default=10, help="The number of times to start the program to calculate the average. Default is 10.")
+parser.add_argument("-t", "--top", type=int, default=15, help="The number of slowest imports to report. Default is 15.")
+args = parser.parse_args()
+#
+# Get the import times.
+(process, elapsed) = runPython(["-X", "importtime", "-c", f"import {programModule}"])
+if process.returncode != 0:
+    print(f"Failed to import {programModule}:\n{process.stderr}")
+    sys.exit(1)
+
+imports = parseImportTime(process.stderr)
+print(f"Slowest {args.top} imports (microseconds):")
+print(f"{'self':>10} | {'cumulative':>10} | module")
+for (selfTime, cumulativeTime, module) in sorted(imports, key=lambda x: x[1], reverse=True)[:args.top]:
+    print(f"{selfTime:>10} | {cumulativeTime:>10} | {module}")
+print(f"Total import time: {sum(x[0] for x in imports)/1000:.1f} ms for {len(imports)} modules.\n")
+#
+# Get the average cold start time.
+baseline = 0
+startup = 0
+for i in range(args.runs):
+    baseline += runPython(["-c", "pass"])[1]
+    startup += runPython(["-c", f"import {programModule}"])[1]
+baseline /= args.runs
+startup /= args.runs
+print(f"Average interpreter start time: {baseline*1000:.1f} ms.")
+print(f"Average interpreter start and import time: {startup*1000:.1f} ms.")
+print(f"Average cost of importing {programModule}: {(startup - baseline)*1000:.1f} ms.\n")
+#
+# Get the time it takes to create each of the clients. boto3 has already
+# been imported by the program, so it isn't included in these times.
+clientCode = """
+import time
+import boto3
+for service in ['s3', 'secretsmanager', 'sns']:
+    startTime = time.perf_counter()
+    boto3.client(service, region_name='us-west-2')
+    print(f'{service} client: {(time.perf_counter() - startTime)*1000:.1f} ms')
+"""
+(process, elapsed) = runPython(["-c", clientCode])
+if process.returncode != 0:
+    print(f"Failed to create the AWS clients:\n{process.stderr}")
+    sys.exit(1)
+print("Time to create the AWS clients:")
+print(process.stdout)